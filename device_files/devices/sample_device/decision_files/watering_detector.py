@@ -0,0 +1,68 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+On-device copy of the IoT Events sprinkler detector model.
+
+Both this state machine and the CDK IotEventsStack are built from
+detector_model.json, so the debounce rules on the device and in the cloud
+cannot drift apart. In each state the counter goes up by the reading's sample
+count on a "count_reading", resets on a "reset_reading", and once it is greater
+than debounce_threshold the detector moves to "next_state" and the sprinkler is
+switched accordingly.
+
+The cloud detector stays the supervisor: when a shadow delta arrives the device
+follows it and calls sync() so the local detector agrees with the cloud.
+'''
+
+
+import json
+import threading
+
+
+def load_definition(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class WateringDetector:
+    def __init__(self, definition):
+        self.threshold = definition['debounce_threshold']
+        self.states = {state['state_name']: state for state in definition['states']}
+        self.lock = threading.Lock()
+        self.state_name = definition['initial_state']
+        self.counter = 0
+
+    @property
+    def sprinkler_state(self):
+        return self.states[self.state_name]['sprinkler_state']
+
+    def on_reading(self, reading_state, sample_count=1):
+        # Returns the new sprinkler state ("on"/"off") when the reading causes a transition, otherwise None
+        with self.lock:
+            state = self.states[self.state_name]
+            if reading_state == state['count_reading']:
+                self.counter += sample_count
+            elif reading_state == state['reset_reading']:
+                self.counter = 0
+
+            if self.counter > self.threshold:
+                self._enter(state['next_state'])
+                return self.sprinkler_state
+        return None
+
+    def sync(self, sprinkler_state):
+        # Align with the sprinkler state requested by the cloud detector
+        with self.lock:
+            if self.sprinkler_state == sprinkler_state:
+                return
+            for state_name, state in self.states.items():
+                if state['sprinkler_state'] == sprinkler_state:
+                    self._enter(state_name)
+                    return
+
+    def _enter(self, state_name):
+        # Matches the InitializeInputValue on_enter event of the cloud detector
+        self.state_name = state_name
+        self.counter = 0
@@ -0,0 +1,300 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Gateway runtime: one controller, one connection, many sprinkler zones.
+
+Each zone in "gateway_zones" is a child thing named <gateway>_<zone>. Its
+telemetry, shadow and jobs go over the gateway's connection:
+- telemetry on <gateway>_<zone>/sensordata/soil_moisture ("per_child"), or one
+  multi-zone message on <gateway>/sensordata/soil_moisture/batch ("batched")
+- shadow deltas and get responses on wildcard subscriptions, routed to the zone
+- jobs with the UPDATE_ZONE_PARAMETERS task, other tasks are reported FAILED
+
+The gateway certificate needs the gateway policy (see the main README) on top of
+the sprinkler policies. Provision the gateway like a sprinkler first.
+'''
+
+
+#### Import dependencies
+from awscrt import io, mqtt
+import time as t
+import json
+import random
+import argparse
+import sys
+import threading
+import traceback
+
+#### Import telemetry_files/spool.py file
+from telemetry_files.spool import SpoolDrainer
+#### Import runtime_files/device_setup.py file
+from runtime_files.device_setup import (find_parameters, find_certificates, connection_settings, open_spool,
+                                        build_client_bootstrap, build_mqtt3_connection, connect_with_backoff)
+#### Import runtime_files/gateway.py file
+from runtime_files.gateway import Zone, ZoneRouter, multi_child_batch
+#### Import telemetry_files/calibration.py file
+from telemetry_files.calibration import CalibrationTable
+
+parser = argparse.ArgumentParser(description="IoT Enabled Sprinkler Gateway Script.")
+parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port. " +
+                                                      "Ex: \"w6zbse3vjd5b4p-ats.iot.us-west-2.amazonaws.com\"")
+parser.add_argument('--device_name', required=True, help="Gateway thing name, also the prefix of its zone things.")
+args = parser.parse_args()
+
+# Set while the MQTT connection is up, used to pause the spool drainer
+is_connected = threading.Event()
+
+#### Check if parameters file exists. If not exit.
+parameter_path = find_parameters(args.device_name)
+if parameter_path is None:
+    sys.exit("Parameters file does not exist... Exiting")
+with open(parameter_path) as f:
+    parameters = json.load(f)
+
+#### Check if certificate files exist and assign to variables. If not exit.
+certificate_paths = find_certificates(args.device_name)
+if certificate_paths is None:
+    sys.exit("Did not find certificate files. Provision the gateway with iot_sprinkler.py first.")
+PATH_TO_CERT, PATH_TO_KEY, PATH_TO_ROOT = certificate_paths
+
+#### Define ENDPOINT, GATEWAY_NAME and settings ####
+ENDPOINT = args.endpoint
+GATEWAY_NAME = args.device_name
+DELAY=parameters['message_interval']
+SPOOL_DRAIN_RATE=parameters.get('spool_drain_rate', 5)
+KEEP_ALIVE_SECS, RECONNECT_MIN_TIMEOUT, RECONNECT_MAX_TIMEOUT, CONNECT_RETRY_MAX_SECONDS = connection_settings(parameters)
+# Zone names, each one is the child thing <gateway>_<zone>
+GATEWAY_ZONES=parameters.get('gateway_zones', [])
+# Same calibration settings as iot_sprinkler.py, the curve is the starting point of every zone
+CALIBRATION_CURVE=parameters.get('calibration')
+CALIBRATION_ADC_MAX=parameters.get('calibration_adc_max', 4095)
+# "per_child" publishes on each zone's own topic, "batched" sends one message for all zones
+GATEWAY_TELEMETRY=parameters.get('gateway_telemetry', 'per_child')
+# Readings per zone collected before a batched message is sent
+GATEWAY_BATCH_READINGS=max(1, parameters.get('gateway_batch_readings', 1))
+
+#### Define Topics to publish/subscribe ####
+TOPIC_PUB_GATEWAY_BATCH = "{}/sensordata/soil_moisture/batch".format(GATEWAY_NAME)
+# Wildcard subscriptions, the gateway policy only lets messages of its own zones through
+TOPIC_SUB_SHADOW_DELTA = "$aws/things/+/shadow/update/delta"
+TOPIC_SUB_SHADOW_GET = "$aws/things/+/shadow/get/accepted"
+TOPIC_SUB_JOBS_NOTIFY_NEXT = "$aws/things/+/jobs/notify-next"
+TOPIC_SUB_JOBS_START_NEXT = "$aws/things/+/jobs/start-next/accepted"
+
+def topic_sensor_data(zone):
+    return "{}/sensordata/soil_moisture".format(zone.thing_name)
+
+def topic_shadow(zone, action):
+    return "$aws/things/{}/shadow/{}".format(zone.thing_name, action)
+
+def topic_jobs(zone, action):
+    return "$aws/things/{}/jobs/{}".format(zone.thing_name, action)
+
+# One calibration row per zone
+calibration = CalibrationTable(CALIBRATION_ADC_MAX, len(GATEWAY_ZONES))
+zones = ZoneRouter([
+    Zone(GATEWAY_NAME, zone_name, parameters['abs_hydrated_state_value'], parameters['abs_dry_state_value'],
+         parameters['sprinkler_trigger_percentage'], calibration, probe, CALIBRATION_CURVE)
+    for probe, zone_name in enumerate(GATEWAY_ZONES)
+])
+
+
+"""
+    Define all the callback functions for subscribe calls
+"""
+
+##  CONNECTION CALLBACK FUNCTIONS ##
+
+def on_connection_interrupted(connection, error, **kwargs):
+    print("Connection interrupted. error: {}".format(error))
+    is_connected.clear()
+
+def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        is_connected.set()
+
+##  ZONE SHADOW CALLBACK FUNCTIONS ##
+
+# Switch the zone valve from its shadow delta
+def on_delta_message_received(topic, payload, **kwargs):
+    zone = zones.zone_for_topic(topic)
+    if zone is None:
+        return
+    state = json.loads(payload)['state']
+    reported = {}
+    if 'sprinkler_state' in state:
+        ##
+        # Code to open or close the zone valve...
+        ##
+        zone.sprinkler_state = state['sprinkler_state']
+        reported['sprinkler_state'] = zone.sprinkler_state
+        print("Zone {} sprinkler turned {}".format(zone.name, zone.sprinkler_state))
+    if reported:
+        report_shadow(zone, reported)
+
+def on_get_message_received(topic, payload, **kwargs):
+    zone = zones.zone_for_topic(topic)
+    if zone is None:
+        return
+    try:
+        zone.apply_parameters(json.loads(payload)['state'].get('reported', {}))
+        print("Zone {} parameters from shadow: {}".format(zone.name, zone.parameters()))
+    except ValueError as e:
+        print("Ignoring shadow parameters: {}. Keeping {}".format(e, zone.parameters()))
+
+def report_shadow(zone, reported):
+    shadowDoc = {
+        "state": {
+            "reported": reported
+        }
+    }
+    mqtt_connection.publish(topic=topic_shadow(zone, "update"), payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+
+##  ZONE JOBS CALLBACK FUNCTIONS ##
+
+def start_next_job(zone):
+    mqtt_connection.publish(topic=topic_jobs(zone, "start-next"), payload=json.dumps({}), qos=mqtt.QoS.AT_LEAST_ONCE)
+
+def on_next_job_execution_changed(topic, payload, **kwargs):
+    zone = zones.zone_for_topic(topic)
+    if zone is not None and json.loads(payload).get('execution'):
+        start_next_job(zone)
+
+def on_start_next_job_execution_accepted(topic, payload, **kwargs):
+    zone = zones.zone_for_topic(topic)
+    execution = json.loads(payload).get('execution')
+    if zone is None or not execution:
+        return
+    job_id = execution['jobId']
+    job_document = execution.get('jobDocument', {})
+    print("Zone {} starting job {}".format(zone.name, job_id))
+    try:
+        if job_document.get('task') == "UPDATE_ZONE_PARAMETERS":
+            zone.apply_parameters(job_document['payload'])
+            report_shadow(zone, zone.parameters())
+            update = {"status": "SUCCEEDED"}
+        else:
+            update = {"status": "FAILED", "statusDetails": {"reason": "Unsupported task for a gateway zone"}}
+    except Exception as e:
+        update = {"status": "FAILED", "statusDetails": {"reason": str(e)[:1000]}}
+    publish_future, _ = mqtt_connection.publish(topic=topic_jobs(zone, "{}/update".format(job_id)),
+                                                payload=json.dumps(update), qos=mqtt.QoS.AT_LEAST_ONCE)
+    # Pull the zone's next job once this one is updated
+    publish_future.add_done_callback(lambda future: start_next_job(zone))
+
+
+"""
+    Define Publish Function
+"""
+
+# Simulated soil moisture probe per zone, sweeps between the hydrated and dry values
+def simulated_sensor_readings(zone):
+    while True:
+        var = zone.abs_hydrated_state_value
+        delimiter = random.randrange(4, 20, 2) # nosec
+        while(var<zone.abs_dry_state_value):
+            var = var+delimiter
+            yield var
+        delimiter = random.randrange(4, 20, 2) # nosec
+        while(var>zone.abs_hydrated_state_value):
+            var = var-delimiter
+            yield var
+
+def publish_zone_reading(zone, soil_moisture_percentage):
+    message = {
+        "sensorType": "SoilMoistureSensor",
+        "deviceID": zone.thing_name,
+        "sensorReportedState": zone.reported_state(soil_moisture_percentage),
+        "sensorReportedMoisturePercentage": soil_moisture_percentage,
+        "sampleCount": 1
+    }
+    spool.append(topic_sensor_data(zone), json.dumps(message))
+
+def add_batched_reading(zone, soil_moisture_percentage):
+    pending_readings[zone.thing_name].append(
+        [int(t.time() * 1000), soil_moisture_percentage, zone.reported_state(soil_moisture_percentage), 1])
+
+# Publish function used by the spool drainer, returns the PUBACK future
+def publish_spooled(topic, payload):
+    publish_future, _ = mqtt_connection.publish(topic=topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)
+    return publish_future
+
+
+"""
+    Establishing connection and executing gateway code
+"""
+
+if __name__ == '__main__':
+    io.init_logging(io.LogLevel.Error, 'stderr')
+    if not len(zones):
+        sys.exit("No zones configured, add zone names to 'gateway_zones' in parameters.json")
+
+    #### Spin up resources ####
+    client_bootstrap = build_client_bootstrap()
+    mqtt_connection = build_mqtt3_connection(ENDPOINT, PATH_TO_CERT, PATH_TO_KEY, PATH_TO_ROOT, GATEWAY_NAME, client_bootstrap,
+                                             on_connection_interrupted, on_connection_resumed,
+                                             keep_alive_secs=KEEP_ALIVE_SECS,
+                                             reconnect_min_secs=RECONNECT_MIN_TIMEOUT,
+                                             reconnect_max_secs=RECONNECT_MAX_TIMEOUT)
+    spool = open_spool(parameters, parameter_path)
+
+    #### Attempt connecting to AWS IoT ####
+    print("Connecting to {} with client ID '{}' for {} zones...".format(ENDPOINT, GATEWAY_NAME, len(zones)))
+    connect_with_backoff(mqtt_connection, RECONNECT_MIN_TIMEOUT, CONNECT_RETRY_MAX_SECONDS)
+    print("Connected!")
+    is_connected.set()
+
+    #### Subscribe to Topics, four wildcard subscriptions whatever the number of zones ####
+    try:
+        subscribe_futures = []
+        for topic, callback in [(TOPIC_SUB_SHADOW_GET, on_get_message_received),
+                                (TOPIC_SUB_SHADOW_DELTA, on_delta_message_received),
+                                (TOPIC_SUB_JOBS_NOTIFY_NEXT, on_next_job_execution_changed),
+                                (TOPIC_SUB_JOBS_START_NEXT, on_start_next_job_execution_accepted)]:
+            print("Subscribing to topic '{}'...".format(topic))
+            subscribe_future, _ = mqtt_connection.subscribe(topic=topic, qos=mqtt.QoS.AT_LEAST_ONCE, callback=callback)
+            subscribe_futures.append(subscribe_future)
+        for subscribe_future in subscribe_futures:
+            subscribe_future.result()
+    except Exception as e:
+        traceback.print_exception(e.__class__, e, sys.exc_info()[2])
+        sys.exit("Subscribe failed")
+
+    #### Get every zone's shadow and pending jobs ####
+    for zone in zones:
+        mqtt_connection.publish(topic=topic_shadow(zone, "get"), payload=json.dumps({}), qos=mqtt.QoS.AT_LEAST_ONCE)
+        start_next_job(zone)
+
+    spool_drainer = SpoolDrainer(spool, publish_spooled, is_connected, SPOOL_DRAIN_RATE)
+    spool_drainer.start()
+
+    #### Begin infinite publish of Soil Moisture Sensor Data for all zones ####
+    print('Begin Infinite Publish')
+    zone_readings = {zone.thing_name: simulated_sensor_readings(zone) for zone in zones}
+    pending_readings = {zone.thing_name: [] for zone in zones}
+    collected = 0
+    try:
+        while True:
+            # Zones are in probe order, all readings are calibrated in one lookup
+            readings = [next(zone_readings[zone.thing_name]) for zone in zones]
+            for zone, soil_moisture_percentage in zip(zones, calibration.percentages(readings)):
+                if GATEWAY_TELEMETRY == 'batched':
+                    add_batched_reading(zone, soil_moisture_percentage)
+                else:
+                    publish_zone_reading(zone, soil_moisture_percentage)
+            collected += 1
+            if GATEWAY_TELEMETRY == 'batched' and collected >= GATEWAY_BATCH_READINGS:
+                spool.append(TOPIC_PUB_GATEWAY_BATCH,
+                             json.dumps(multi_child_batch(GATEWAY_NAME, pending_readings), separators=(',', ':')))
+                pending_readings = {zone.thing_name: [] for zone in zones}
+                collected = 0
+            t.sleep(DELAY)
+    except KeyboardInterrupt:
+        print("Disconnecting...")
+        spool_drainer.stop()
+        mqtt_connection.disconnect().result()
+        spool.close()
+        print("Disconnected.")
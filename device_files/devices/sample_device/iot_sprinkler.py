@@ -4,10 +4,10 @@
 
 #### Import dependencies
 from awscrt import io, mqtt, auth, http
-from awsiot import mqtt_connection_builder
 from awsiot import iotjobs
 from concurrent.futures import Future
 import time as t
+import asyncio
 import json
 import random
 import os
@@ -17,11 +17,55 @@ import sys
 import threading
 import time
 import traceback
+import shutil
+import zipfile
 from uuid import uuid4
 import requests # install explicitly
 
 #### Import provisioning_files/fleetprovisioning.py file
 from provisioning_files.fleetprovisioning import *
+#### Import telemetry_files/spool.py file
+from telemetry_files.spool import SpoolDrainer
+#### Import telemetry_files/batching.py file
+from telemetry_files.batching import ReadingBatcher
+#### Import decision_files/watering_detector.py file
+from decision_files.watering_detector import WateringDetector, load_definition
+#### Import telemetry_files/deadband.py file
+from telemetry_files.deadband import DeadbandFilter
+#### Import telemetry_files/encoding.py file
+from telemetry_files.encoding import encode_reading, encode_batch, json_reading_encoder, ReadingPayloadCache
+#### Import runtime_files/async_runtime.py file
+from runtime_files.async_runtime import AsyncRuntime, drain_spool
+#### Import runtime_files/startup_timeline.py file
+from runtime_files.startup_timeline import StartupTimeline
+#### Import runtime_files/reconnect.py file
+from runtime_files.reconnect import Backoff, ConnectionStats
+#### Import runtime_files/device_setup.py file
+from runtime_files.device_setup import (find_parameters, find_certificates, connection_settings, open_spool,
+                                        build_client_bootstrap, build_mqtt3_connection, connect_with_backoff)
+#### Import runtime_files/mqtt5_transport.py file, needs an awsiotsdk release with MQTT5 support
+try:
+    from runtime_files.mqtt5_transport import build_mqtt5_connection, publish_with_expiry
+except ImportError:
+    build_mqtt5_connection = None
+#### Import telemetry_files/sampling.py file
+from telemetry_files.sampling import ProbeFilter
+#### Import telemetry_files/calibration.py file
+from telemetry_files.calibration import CalibrationTable, probe_curve
+#### Import telemetry_files/forecast.py file
+from telemetry_files.forecast import DryForecaster
+#### Import telemetry_files/adaptive_interval.py file
+from telemetry_files.adaptive_interval import AdaptiveInterval
+#### Import telemetry_files/metrics.py file
+from telemetry_files.metrics import MetricsRegistry, MetricsReporter
+#### Import runtime_files/connection_swap.py file
+from runtime_files.connection_swap import switch_connection
+#### Import runtime_files/profiling.py file
+from runtime_files.profiling import DeviceProfiler
+#### Import ota_files/firmware_download.py file
+from ota_files.firmware_download import FirmwareDownloader, ota_file_entries, PART_SUFFIX
+#### Import ota_files/firmware_delta.py file
+from ota_files.firmware_delta import apply_patch, delta_base_version, firmware_version
 
 parser = argparse.ArgumentParser(description="IoT Enabled Sprinkler Script.")
 parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port. " +
@@ -29,36 +73,50 @@ parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpo
 parser.add_argument('--device_name', required=True, help="Device Name for MQTT connection.")
 args = parser.parse_args()
 
+# Time-to-ready is measured from here
+startup_timeline = StartupTimeline()
+
 # Using globals to simplify sample code
 is_sample_done = threading.Event()
+# Set while the MQTT connection is up, used to pause the spool drainer
+is_connected = threading.Event()
+# Interruptions, reconnects and time spent disconnected
+connection_stats = ConnectionStats()
+# Set once the shadow get/accepted response has been applied, or get/rejected was received
+shadow_get_received = threading.Event()
+# Device health metrics, reported to Device Defender as custom metrics
+metrics = MetricsRegistry()
+publish_ack_ms = metrics.histogram('publish_ack_ms')
+publish_failures = metrics.counter('publish_failures')
+job_duration_ms = metrics.histogram('job_duration_ms', (1000, 5000, 30000, 60000, 300000, 900000, 3600000))
+reconnects = metrics.counter('reconnects')
+# Profiler driven by the PROFILE_DEVICE job task
+device_profiler = DeviceProfiler()
 
 #### Check if parameters file exists. If not exit.
-if exists('parameters.json'):
-    print("Found parameters file.")
-    parameter_path='parameters.json'
-    f = open('parameters.json')
-    parameters = json.load(f)
-elif exists('devices/{}/parameters.json'.format(args.device_name)):
-    print("Found parameters file.")
-    parameter_path='devices/{}/parameters.json'.format(args.device_name)
-    f = open('devices/{}/parameters.json'.format(args.device_name))
-    parameters = json.load(f)
-else:
+parameter_path = find_parameters(args.device_name)
+if parameter_path is None:
     print("Parameters file does not exist... Exiting")
     exit(0)
+print("Found parameters file.")
+with open(parameter_path) as f:
+    parameters = json.load(f)
 
-#### Check if certificate files exist and assign to variables. If not, provision device
-if exists("certificates/{}_certificate.pem.crt".format(args.device_name)) : 
-    print("Found certificate files")
-    PATH_TO_CERT = "certificates/{}_certificate.pem.crt".format(args.device_name)
-    PATH_TO_KEY = "certificates/{}_private.pem.key".format(args.device_name)
-    PATH_TO_ROOT = "certificates/AmazonRootCA1.pem"
+# Fleet provisioning settings, response timeouts and whether rotation reuses the live device connection
+PROVISIONING_CREATE_KEYS_TIMEOUT=parameters.get('provisioning_create_keys_timeout', 12)
+PROVISIONING_REGISTER_THING_TIMEOUT=parameters.get('provisioning_register_thing_timeout', 20)
+# Certificate swap settings, how long the new certificate gets to connect and a random delay to spread a fleet-wide rotation
+CERT_SWAP_TIMEOUT=parameters.get('cert_swap_timeout', 30)
+CERT_SWAP_JITTER_SECONDS=parameters.get('cert_swap_jitter_seconds', 0)
+ROTATE_OVER_DEVICE_CONNECTION=parameters.get('rotate_over_device_connection', True)
+# Provisioning client kept across certificate rotations on the device connection
+rotation_client = None
 
-elif exists("devices/{}/certificates/{}_certificate.pem.crt".format(args.device_name, args.device_name)):
+#### Check if certificate files exist and assign to variables. If not, provision device
+certificate_paths = find_certificates(args.device_name)
+if certificate_paths is not None:
     print("Found certificate files")
-    PATH_TO_CERT = "devices/{}/certificates/{}_certificate.pem.crt".format(args.device_name, args.device_name)
-    PATH_TO_KEY = "devices/{}/certificates/{}_private.pem.key".format(args.device_name, args.device_name)
-    PATH_TO_ROOT = "devices/{}/certificates/AmazonRootCA1.pem".format(args.device_name)
+    PATH_TO_CERT, PATH_TO_KEY, PATH_TO_ROOT = certificate_paths
 
 else:
     print("Did not find certificate files. Attempting to provision device ...")
@@ -66,7 +124,9 @@ else:
         performCertificateRotation=False
         PATH_TO_ROOT = "devices/{}/certificates/AmazonRootCA1.pem".format(args.device_name)
         response = provision_device(args.device_name, args.endpoint, PATH_TO_ROOT, parameters['provisioningTemplateName'], performCertificateRotation,
-                        parameters['version'], parameters['sensor_type'], parameters['plant_id'])
+                        parameters['version'], parameters['sensor_type'], parameters['plant_id'],
+                        create_keys_timeout=PROVISIONING_CREATE_KEYS_TIMEOUT,
+                        register_thing_timeout=PROVISIONING_REGISTER_THING_TIMEOUT)
         if response['status'] != 'Done':
             print("Certificate Creation Failed")
         PATH_TO_CERT = "devices/{}/certificates/{}_certificate.pem.crt".format(args.device_name, args.device_name)
@@ -84,11 +144,96 @@ DELAY=parameters['message_interval']
 ABS_HYDRATED_STATE_VALUE=parameters['abs_hydrated_state_value']
 ABS_DRY_STATE_VALUE=parameters['abs_dry_state_value']
 SPRINKLER_TRIGGER_PERCENTAGE=parameters['sprinkler_trigger_percentage']
+# Store-and-forward spool drain rate, the spool itself is opened by open_spool()
+SPOOL_DRAIN_RATE=parameters.get('spool_drain_rate', 5)
+# Connection settings, a persistent session keeps subscriptions and queued QoS 1 messages across reconnects
+PERSISTENT_SESSION=parameters.get('persistent_session', False)
+# The reconnect window of this device is randomized so a fleet does not reconnect in lockstep
+KEEP_ALIVE_SECS, RECONNECT_MIN_TIMEOUT, RECONNECT_MAX_TIMEOUT, CONNECT_RETRY_MAX_SECONDS = connection_settings(parameters)
+# MQTT protocol version, 3 (MQTT 3.1.1) or 5 (topic aliases, receive maximum and message expiry)
+MQTT_VERSION=parameters.get('mqtt_version', 3)
+RECEIVE_MAXIMUM=parameters.get('receive_maximum', 10)
+# IoT Core accepts up to 8 topic aliases per connection
+TOPIC_ALIAS_CACHE_SIZE=min(8, parameters.get('topic_alias_cache_size', 8))
+# Seconds after which the broker drops undelivered telemetry, 0 never expires it
+TELEMETRY_EXPIRY_SECONDS=parameters.get('telemetry_expiry_seconds', 0)
+# MQTT5 client behind each MQTT5 connection, used for publishes with MQTT5 properties
+mqtt5_clients = {}
+# OTA download settings, chunk size, HTTP timeout, retries within one job run and job progress report steps
+FIRMWARE_DIR=os.path.join(os.path.dirname(parameter_path), 'firmware_files')
+OTA_CHUNK_BYTES=parameters.get('ota_chunk_bytes', 65536)
+OTA_REQUEST_TIMEOUT=parameters.get('ota_request_timeout', 30)
+OTA_MAX_RETRIES=parameters.get('ota_max_retries', 10)
+OTA_PROGRESS_STEP_PERCENT=parameters.get('ota_progress_step_percent', 10)
+# Use a delta file from the OTA job when the device holds its base image, else download the full image
+OTA_DELTA_ENABLED=parameters.get('ota_delta_enabled', True)
+# Client token prefix of job progress updates, their responses must not end the job
+PROGRESS_CLIENT_TOKEN_PREFIX = "progress-"
+# Longest profiling window a PROFILE_DEVICE job can ask for
+PROFILE_MAX_SECONDS=parameters.get('profile_max_seconds', 600)
+# Device Defender metrics reports, at most one every 5 minutes is accepted
+METRICS_ENABLED=parameters.get('metrics_enabled', True)
+METRICS_REPORT_INTERVAL=max(300, parameters.get('metrics_report_interval', 300))
+# Batching settings, a batch_max_readings of 1 sends every reading on its own
+BATCH_MAX_READINGS=parameters.get('batch_max_readings', 1)
+BATCH_MAX_SECONDS=parameters.get('batch_max_seconds', 60)
+# Edge-local watering decisions, driven by the same definition as the IoT Events detector model
+EDGE_DECISIONS_ENABLED=parameters.get('edge_decisions_enabled', False)
+DETECTOR_MODEL_PATH=os.path.join(os.path.dirname(parameter_path), 'detector_model.json')
+# Deadband reporting settings, a deadband_percentage of 0 reports every reading
+DEADBAND_PERCENTAGE=parameters.get('deadband_percentage', 0)
+DEADBAND_MAX_SILENCE_SECONDS=parameters.get('deadband_max_silence_seconds', 300)
+# Probe calibration curve, None for the linear curve between the hydrated and dry values (see telemetry_files/calibration.py)
+CALIBRATION_CURVE=parameters.get('calibration')
+CALIBRATION_ADC_MAX=parameters.get('calibration_adc_max', 4095)
+# Wire format for sensor data, "json" or "struct" (compact binary, see telemetry_files/encoding.py)
+PAYLOAD_FORMAT=parameters.get('payload_format', 'json')
+# Print a line for every spooled reading, turn off on small units where the sensor loop is most of the CPU
+LOG_READINGS=parameters.get('log_readings', True)
+# Device runtime, "threads" (callbacks, job threads and blocking sleeps) or "asyncio" (one event loop)
+RUNTIME=parameters.get('runtime', 'threads')
+# Oversampling settings, the probe is read OVERSAMPLE_COUNT times per message interval and filtered
+OVERSAMPLE_COUNT=max(1, parameters.get('oversample_count', 1))
+FILTER_METHOD=parameters.get('filter_method', 'median')
+FILTER_WINDOW=parameters.get('filter_window', OVERSAMPLE_COUNT)
+PROBE_NOISE=parameters.get('probe_noise', 0)
+# Adaptive reporting interval, DELAY follows the moisture rate of change between the min and max intervals
+ADAPTIVE_INTERVAL_ENABLED=parameters.get('adaptive_interval_enabled', False)
+ADAPTIVE_MIN_INTERVAL=parameters.get('adaptive_min_interval', 1)
+ADAPTIVE_MAX_INTERVAL=parameters.get('adaptive_max_interval', 300)
+ADAPTIVE_GAIN=parameters.get('adaptive_gain', 4)
+# Time-to-dry forecast, reported as minutesToDry in JSON readings and as the predicted dry time in the shadow
+FORECAST_ENABLED=parameters.get('forecast_enabled', False)
+FORECAST_MODEL=parameters.get('forecast_model', 'linear')
+FORECAST_WINDOW=parameters.get('forecast_window', 30)
+FORECAST_MIN_SAMPLES=parameters.get('forecast_min_samples', 5)
+# The shadow is only updated when the predicted dry time moves by more than this
+FORECAST_SHADOW_TOLERANCE_MINUTES=parameters.get('forecast_shadow_tolerance_minutes', 15)
+# Predicted dry time last reported to the shadow, epoch seconds
+REPORTED_DRY_AT=None
+# Last sprinkler state applied by this device
+SPRINKLER_STATE="off"
+# Startup settings, how long to wait for SUBACKs and for the shadow get response
+SUBSCRIBE_TIMEOUT=parameters.get('subscribe_timeout', 10)
+SHADOW_GET_TIMEOUT=parameters.get('shadow_get_timeout', 5)
+PUBLISH_STARTUP_TIMELINE=parameters.get('publish_startup_timeline', False)
 
 #### Define Topics to publish/subscribe ####
 ## PUBLISH TOPICS ##
 TOPIC_PUB_SENSOR_SM = "{}/sensordata/soil_moisture".format(DEVICE_NAME)
 print("TOPIC_PUB_SENSOR_SM: {}".format(TOPIC_PUB_SENSOR_SM))
+# Batched multi-reading soil moisture messages
+TOPIC_PUB_SENSOR_SM_BATCH = "{}/sensordata/soil_moisture/batch".format(DEVICE_NAME)
+print("TOPIC_PUB_SENSOR_SM_BATCH: {}".format(TOPIC_PUB_SENSOR_SM_BATCH))
+# Binary encoded soil moisture messages, single readings and batches
+TOPIC_PUB_SENSOR_SM_BIN = "{}/sensordata/soil_moisture/bin".format(DEVICE_NAME)
+print("TOPIC_PUB_SENSOR_SM_BIN: {}".format(TOPIC_PUB_SENSOR_SM_BIN))
+# Device Defender metrics report with the device's custom metrics
+TOPIC_PUB_DEFENDER_METRICS = "$aws/things/{}/defender/metrics/json".format(DEVICE_NAME)
+print("TOPIC_PUB_DEFENDER_METRICS: {}".format(TOPIC_PUB_DEFENDER_METRICS))
+# Startup timeline, published once the device is ready when publish_startup_timeline is set
+TOPIC_PUB_STARTUP_TIMELINE = "{}/diagnostics/startup".format(DEVICE_NAME)
+print("TOPIC_PUB_STARTUP_TIMELINE: {}".format(TOPIC_PUB_STARTUP_TIMELINE))
 # Update when sprinkler is turned on or off
 TOPIC_PUB_SHADOW_UPDATE = "$aws/things/{}/shadow/update".format(DEVICE_NAME)
 print("TOPIC_PUB_SHADOW_UPDATE: {}".format(TOPIC_PUB_SHADOW_UPDATE))
@@ -108,10 +253,26 @@ print("TOPIC_SUB_SHADOW_DELTA: {}".format(TOPIC_SUB_SHADOW_DELTA))
 # Listen to GET shadow topic to receive updated parameters
 TOPIC_SUB_SHADOW_GET = "$aws/things/{}/shadow/get/accepted".format(DEVICE_NAME)
 print("TOPIC_SUB_SHADOW_GET: {}".format(TOPIC_SUB_SHADOW_GET))
+# A device without a shadow gets a 404 on get/rejected, so startup does not wait for get/accepted
+TOPIC_SUB_SHADOW_GET_REJECTED = "$aws/things/{}/shadow/get/rejected".format(DEVICE_NAME)
+print("TOPIC_SUB_SHADOW_GET_REJECTED: {}".format(TOPIC_SUB_SHADOW_GET_REJECTED))
 # Listen to receive the new certificate and private key when rotating custom certificates
 TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE = "{}/customCa/certificate/create/complete".format(DEVICE_NAME)
 print("TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE: {}".format(TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE))
 
+#### Prebuilt payloads ####
+# Encoded single reading payloads, reused for every reading with the same state and percentage
+json_readings = ReadingPayloadCache(json_reading_encoder("SoilMoistureSensor", DEVICE_NAME))
+binary_readings = ReadingPayloadCache(encode_reading)
+# Shadow updates reporting the sprinkler state, from the cloud and from the local detector
+SHADOW_REPORTED_SPRINKLER_STATE = {
+    state: json.dumps({"state": {"reported": {"sprinkler_state": state}}}) for state in ("on", "off")
+}
+SHADOW_LOCAL_SPRINKLER_STATE = {
+    state: json.dumps({"state": {"reported": {"sprinkler_state": state}, "desired": {"sprinkler_state": state}}})
+    for state in ("on", "off")
+}
+
 """ 
     Define all the callback functions for subscribe calls 
 """
@@ -172,6 +333,7 @@ def done_working_on_job():
 def on_disconnected(disconnect_future):
     # type: (Future) -> None
     print("Disconnected.")
+    is_connected.clear()
 
     # Signal that sample is finished
     is_sample_done.set()
@@ -219,11 +381,15 @@ def on_start_next_pending_job_execution_accepted(response):
             print("Request to start next job was accepted. job_id:{} job_document:{}".format(
                 execution.job_id, execution.job_document))
 
-            # To emulate working on a job, spawn a thread that sleeps for a few seconds
-            job_thread = threading.Thread(
-                target=lambda: job_thread_fn(execution.job_id, execution.job_document),
-                name='job_thread')
-            job_thread.start()
+            if RUNTIME == 'asyncio':
+                # Picked up by the job_worker task
+                job_queue.put_nowait((execution.job_id, execution.job_document))
+            else:
+                # To emulate working on a job, spawn a thread that sleeps for a few seconds
+                job_thread = threading.Thread(
+                    target=lambda: job_thread_fn(execution.job_id, execution.job_document),
+                    name='job_thread')
+                job_thread.start()
         else:
             print("Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs...")
             done_working_on_job()
@@ -263,12 +429,37 @@ def update_device_iot_certificates():
     # }
     templateName= parameters['rotationTemplateName']
     performCertificateRotation= True
+    global rotation_client
+    previous_certificates = read_certificate_files()
+    # Rotate over the live device connection, or open a claim-cert session on the device's bootstrap
+    if ROTATE_OVER_DEVICE_CONNECTION:
+        if rotation_client is None:
+            rotation_client = ProvisioningClient(mqtt_connection=mqtt_connection,
+                                                 create_keys_timeout=PROVISIONING_CREATE_KEYS_TIMEOUT,
+                                                 register_thing_timeout=PROVISIONING_REGISTER_THING_TIMEOUT)
+        provisioning_client = rotation_client
+    else:
+        provisioning_client = ProvisioningClient(endpoint=ENDPOINT,
+                                                 cert="devices/{}/provisioning_files/claim.certificate.pem".format(DEVICE_NAME),
+                                                 key="devices/{}/provisioning_files/claim.private.key".format(DEVICE_NAME),
+                                                 root_ca=PATH_TO_ROOT,
+                                                 client_bootstrap=client_bootstrap,
+                                                 create_keys_timeout=PROVISIONING_CREATE_KEYS_TIMEOUT,
+                                                 register_thing_timeout=PROVISIONING_REGISTER_THING_TIMEOUT)
     # Call the provisioning code to get and replace to new certs
-    response = provision_device(DEVICE_NAME, ENDPOINT, PATH_TO_ROOT, templateName, performCertificateRotation)
+    response = provision_device(DEVICE_NAME, ENDPOINT, PATH_TO_ROOT, templateName, performCertificateRotation,
+                                provisioning_client=provisioning_client)
+    if not ROTATE_OVER_DEVICE_CONNECTION:
+        provisioning_client.close()
     if response["status"] != 'Done':
         print("Certificate Rotation Failed")
         print("##======================================##\n\n")
         return
+    # Only signal completion, which revokes the old certificate, once the new one is in use
+    if not swap_connection(previous_certificates):
+        print("Certificate Rotation Failed")
+        print("##======================================##\n\n")
+        return
     payload = {
         "thingName" : DEVICE_NAME,
         "newCertificateId" : response["certificateID"]
@@ -294,18 +485,158 @@ def update_device_custom_certificates():
     
     return
 
-def get_firmware_files_http(s3PresignedUrl):
-    # os.system('wget -P devices/{}/firmware_files {} --trust-server-names'.format(DEVICE_NAME, s3PresignedUrl))
-    return
+def report_job_progress(job_id, status_details):
+    # IN_PROGRESS update, status details are shown on the job execution in the console and Fleet Hub
+    request = iotjobs.UpdateJobExecutionRequest(
+        thing_name=DEVICE_NAME,
+        job_id=job_id,
+        status=iotjobs.JobStatus.IN_PROGRESS,
+        status_details=status_details,
+        include_job_execution_state=True,
+        client_token=PROGRESS_CLIENT_TOKEN_PREFIX + str(uuid4()))
+    jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+
+def ota_cert_path(file_info):
+    # Code signing certificate, relative to the device folder
+    return os.path.join(os.path.dirname(parameter_path), file_info['certfile']) if file_info.get('certfile') else None
+
+def get_firmware_files_http(job_id, file_info):
+    # sample afr_ota file entry:
+    # {
+    #     "filepath": "firmware_v1.3.zip",
+    #     "filesize": 1048576,
+    #     "fileid": 0,
+    #     "certfile": "firmware_files/codeSigningCert.crt",
+    #     "update_data_url": "https://<bucket>.s3.amazonaws.com/...",
+    #     "sig-sha256-ecdsa": "MEUCIQ..."
+    # }
+    # Streams the image to firmware_files/, resuming a partial download of the same image
+    os.makedirs(FIRMWARE_DIR, exist_ok=True)
+    file_name = os.path.basename(file_info.get('filepath') or 'firmware_{}.bin'.format(file_info.get('fileid', 0)))
+    firmware_path = os.path.join(FIRMWARE_DIR, file_name)
+    cert_path = ota_cert_path(file_info)
+    signature = file_info.get('sig-sha256-ecdsa')
+    # Same name, size and signature means the same image, whatever the presigned URL
+    image_id = "{}:{}:{}".format(file_name, file_info['filesize'], signature or file_info.get('sha256', ''))
+
+    def on_progress(done, total):
+        print("Firmware download {}% ({}/{} bytes)".format(int(done * 100 / total), done, total))
+        report_job_progress(job_id, {"step": "download", "file": file_name, "bytesDownloaded": str(done), "totalBytes": str(total)})
+
+    downloader = FirmwareDownloader(OTA_CHUNK_BYTES, OTA_REQUEST_TIMEOUT, OTA_MAX_RETRIES, Backoff(1, 60),
+                                    progress_fn=on_progress, progress_step_percent=OTA_PROGRESS_STEP_PERCENT)
+    started = t.time()
+    sha256 = downloader.download(file_info['update_data_url'], firmware_path, file_info['filesize'], image_id,
+                                 expected_sha256=file_info.get('sha256'), signature=signature, cert_path=cert_path)
+    print("Firmware verified in {:.1f}s, {} attempts, resumed from byte {}".format(
+        t.time() - started, downloader.attempts, downloader.resumed_bytes))
+    report_job_progress(job_id, {"step": "verified", "file": file_name, "totalBytes": str(file_info['filesize']), "sha256": sha256})
+    return firmware_path, sha256
+
+def get_firmware_files_delta(job_id, file_info, delta_info, base_path):
+    # Downloads the delta, rebuilds the full image from the base image and verifies it like a full download
+    patch_path, _ = get_firmware_files_http(job_id, delta_info)
+    firmware_path = os.path.join(FIRMWARE_DIR, os.path.basename(file_info['filepath']))
+    report_job_progress(job_id, {"step": "patching", "file": os.path.basename(firmware_path)})
+    try:
+        apply_patch(base_path, patch_path, firmware_path + PART_SUFFIX, OTA_CHUNK_BYTES)
+        sha256 = FirmwareDownloader(OTA_CHUNK_BYTES).verify(firmware_path + PART_SUFFIX, file_info['filesize'],
+                                                            file_info.get('sha256'), file_info.get('sig-sha256-ecdsa'),
+                                                            ota_cert_path(file_info)).hex()
+    except Exception:
+        if exists(firmware_path + PART_SUFFIX):
+            os.remove(firmware_path + PART_SUFFIX)
+        raise
+    finally:
+        os.remove(patch_path)
+    os.replace(firmware_path + PART_SUFFIX, firmware_path)
+    return firmware_path, sha256
+
+def get_firmware_files(job_id, file_entries):
+    # Returns (firmware_path, sha256, mode) of the verified full image, the first file of the OTA job
+    file_info = file_entries[0]
+    current_version = parameters.get('currentFirmwareVersion')
+    base_path = os.path.join(FIRMWARE_DIR, "firmware_v{}.zip".format(current_version))
+    delta_info = next((entry for entry in file_entries[1:]
+                       if current_version and delta_base_version(entry.get('filepath')) == current_version), None)
+    if OTA_DELTA_ENABLED and delta_info is not None and file_info.get('filepath') and exists(base_path):
+        try:
+            print("Downloading firmware delta from version {}".format(current_version))
+            return get_firmware_files_delta(job_id, file_info, delta_info, base_path) + ("delta",)
+        except Exception as e:
+            print("Firmware delta failed, downloading the full image: {}".format(e))
+    return get_firmware_files_http(job_id, file_info) + ("full",)
+
+def execute_ota_update(firmware_path):
+    # Unpack the verified image into firmware_files/current, swapped in with a rename
+    staging_dir = os.path.join(FIRMWARE_DIR, 'staging')
+    current_dir = os.path.join(FIRMWARE_DIR, 'current')
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    if zipfile.is_zipfile(firmware_path):
+        with zipfile.ZipFile(firmware_path) as archive:
+            archive.extractall(staging_dir)
+    else:
+        os.makedirs(staging_dir)
+        shutil.copy(firmware_path, staging_dir)
+    shutil.rmtree(current_dir, ignore_errors=True)
+    os.replace(staging_dir, current_dir)
+    # Keep only this image, it is the base of the next delta update
+    version = firmware_version(os.path.basename(firmware_path))
+    if version is not None:
+        for name in os.listdir(FIRMWARE_DIR):
+            if (name.endswith('.zip') or name.endswith('.patch')) and name != os.path.basename(firmware_path):
+                os.remove(os.path.join(FIRMWARE_DIR, name))
+        parameters['currentFirmwareVersion'] = version
+        # Only the version changes on disk, settings such as new_device keep their saved values
+        with open(parameter_path, 'r+') as f:
+            data = json.load(f)
+            data['currentFirmwareVersion'] = version
+            f.seek(0)  # rewind
+            json.dump(data, f, indent=4)
+            f.truncate()
 
-def execute_ota_update():
-    return
+def profile_device(job_id, payload):
+    # sample job document:
+    # {
+    #     "task": "PROFILE_DEVICE",
+    #     "payload": {
+    #         "mode": "sampling",
+    #         "duration_seconds": 60,
+    #         "sample_interval_ms": 10,
+    #         "trace_memory": true,
+    #         "upload_url": "<presigned S3 PUT URL>"
+    #     }
+    # }
+    mode = payload.get('mode', 'sampling')
+    duration = min(payload.get('duration_seconds', 60), PROFILE_MAX_SECONDS)
+    archive_path = os.path.join(os.path.dirname(parameter_path), 'profile_{}.tar.gz'.format(job_id))
+    print("Profiling device for {}s in {} mode".format(duration, mode))
+    report_job_progress(job_id, {"step": "profiling", "mode": mode, "durationSeconds": str(duration)})
+    try:
+        # cProfile is switched on and off by the sensor loop, give it one full reading interval plus a margin.
+        # The adaptive interval can stretch DELAY up to its maximum while the profiler runs
+        longest_interval = max(DELAY, ADAPTIVE_MAX_INTERVAL) if ADAPTIVE_INTERVAL_ENABLED else DELAY
+        summary = device_profiler.run(archive_path, mode, duration, payload.get('sample_interval_ms', 10),
+                                      payload.get('trace_memory', False), loop_timeout=longest_interval + 30)
+        report_job_progress(job_id, {"step": "uploading", "archiveBytes": str(summary['archiveBytes'])})
+        with open(archive_path, 'rb') as f:
+            response = requests.put(payload['upload_url'], data=f, timeout=OTA_REQUEST_TIMEOUT) # nosec
+        response.raise_for_status()
+    finally:
+        if exists(archive_path):
+            os.remove(archive_path)
+    print("Profile uploaded: {}".format(summary))
+    return {"step": "uploaded", "mode": mode, "cpuSeconds": str(summary['cpuSeconds']),
+            "archiveBytes": str(summary['archiveBytes'])}
 
 def job_thread_fn(job_id, job_document):
+    job_started = time.monotonic()
     try:
         print("Starting local work on job...")
+        status = iotjobs.JobStatus.SUCCEEDED
+        status_details = None
         
-        # For root ca update or cert update
+        # For root ca update, cert update or profiling
         try:
             if job_document['task']=="UPDATE_DEVICE_ROOTCA_CERTIFICATE":
                 update_root_ca(job_document['payload']['url'])
@@ -313,28 +644,40 @@ def job_thread_fn(job_id, job_document):
                 update_device_iot_certificates()
             elif job_document['task']=="UPDATE_DEVICE_CUSTOM_CERTIFICATES":
                 update_device_custom_certificates()
+            elif job_document['task']=="PROFILE_DEVICE":
+                try:
+                    status_details = profile_device(job_id, job_document['payload'])
+                except Exception as e:
+                    status = iotjobs.JobStatus.FAILED
+                    status_details = {"step": "failed", "reason": str(e)[:1000]}
+                    raise
         except Exception as e:
             print(e)
         
         # For ota update
-        try: 
-            # Download firmware files
-            s3PresignedUrl= job_document['afr_ota']['files']['update_data_url']
-            print("Downloading Firmware files")
-            get_firmware_files_http(s3PresignedUrl)
-            # Execute OTA Update
-            print("Executing OTA Update")
-            execute_ota_update
-            print("OTA Update Executed successfully!")
-        except Exception as e:
-            print(e)
+        if 'afr_ota' in job_document:
+            try:
+                # Download firmware files
+                print("Downloading Firmware files")
+                firmware_path, sha256, mode = get_firmware_files(job_id, ota_file_entries(job_document))
+                # Execute OTA Update
+                print("Executing OTA Update")
+                execute_ota_update(firmware_path)
+                print("OTA Update Executed successfully!")
+                status_details = {"step": "applied", "mode": mode, "sha256": sha256}
+            except Exception as e:
+                print(e)
+                status = iotjobs.JobStatus.FAILED
+                status_details = {"step": "failed", "reason": str(e)[:1000]}
         print("Done working on job.")
+        job_duration_ms.observe_since(job_started)
 
-        print("Publishing request to update job status to SUCCEEDED...")
+        print("Publishing request to update job status to {}...".format(status))
         request = iotjobs.UpdateJobExecutionRequest(
             thing_name=DEVICE_NAME,
             job_id=job_id,
-            status=iotjobs.JobStatus.SUCCEEDED)
+            status=status,
+            status_details=status_details)
         publish_future = jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
         publish_future.add_done_callback(on_publish_update_job_execution)
 
@@ -353,6 +696,9 @@ def on_publish_update_job_execution(future):
 def on_update_job_execution_accepted(response):
     # type: (iotjobs.UpdateJobExecutionResponse) -> None
     try:
+        # Progress updates leave the job running
+        if response.execution_state is not None and response.execution_state.status == iotjobs.JobStatus.IN_PROGRESS:
+            return
         print("Request to update job was accepted.")
         done_working_on_job()
     except Exception as e:
@@ -360,10 +706,119 @@ def on_update_job_execution_accepted(response):
 
 def on_update_job_execution_rejected(rejected):
     # type: (iotjobs.RejectedError) -> None
+    if rejected.client_token and rejected.client_token.startswith(PROGRESS_CLIENT_TOKEN_PREFIX):
+        print("Job progress update was rejected. code:'{}' message:'{}'.".format(rejected.code, rejected.message))
+        return
     exit("Request to update job status was rejected. code:'{}' message:'{}'.".format(
         rejected.code, rejected.message))
         
 
+##  CONNECTION CALLBACK FUNCTIONS ##
+
+# Callback when connection is accidentally lost.
+def on_connection_interrupted(connection, error, **kwargs):
+    # A connection retired by a certificate swap is dropped by IoT Core on purpose
+    if connection is not mqtt_connection:
+        return
+    print("Connection interrupted. error: {}".format(error))
+    is_connected.clear()
+    connection_stats.on_interrupted()
+
+# Callback when an interrupted connection is re-established.
+def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    if connection is not mqtt_connection:
+        return
+    print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        is_connected.set()
+        reconnects.inc()
+        outage = connection_stats.on_resumed()
+        print("Reconnected after {:.1f}s. Interruptions: {} Disconnected: {:.1f}s Dropped messages: {}".format(
+            outage, connection_stats.interruptions, connection_stats.total_disconnected_seconds(), spool.dropped_records))
+        
+        if not session_present:
+            print("Session did not persist. Resubscribing to existing topics...")
+            resubscribe_future, _ = connection.resubscribe_existing_topics()
+            
+            # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
+            # evaluate result with a callback instead.
+            resubscribe_future.add_done_callback(on_resubscribe_complete)
+
+def on_resubscribe_complete(resubscribe_future):
+    resubscribe_results = resubscribe_future.result()
+    print("Resubscribe results: {}".format(resubscribe_results))
+    
+    for topic, qos in resubscribe_results['topics']:
+        if qos is None:
+            exit("Server rejected resubscribe to topic: {}".format(topic))
+
+##  CERTIFICATE SWAP FUNCTIONS ##
+
+def read_certificate_files():
+    with open(PATH_TO_CERT) as f:
+        certificate_pem = f.read()
+    with open(PATH_TO_KEY) as f:
+        private_key = f.read()
+    return certificate_pem, private_key
+
+def write_certificate_files(certificate_pem, private_key):
+    with open(PATH_TO_CERT, "w") as text_file:
+        text_file.write(certificate_pem)
+    with open(PATH_TO_KEY, "w") as text_file:
+        text_file.write(private_key)
+
+# Switch to the certificate files that were just written, see runtime_files/connection_swap.py.
+# Telemetry waits in the spool in the meantime, and spooled messages that were not
+# acknowledged on the old connection are sent again on the new one. If the new
+# certificate does not work, the previous files are restored and the device stays
+# connected with the previous certificate.
+def swap_connection(previous_certificates):
+    global mqtt_connection, jobs_client, rotation_client
+    print("Swapping to the new certificate...")
+    # Spread the takeovers of a fleet-wide rotation
+    if CERT_SWAP_JITTER_SECONDS:
+        t.sleep(random.uniform(0, CERT_SWAP_JITTER_SECONDS)) # nosec
+    jobs_clients = {}
+
+    def build():
+        connection = build_connection(PATH_TO_CERT, PATH_TO_KEY)
+        jobs_clients[connection] = iotjobs.IotJobsClient(connection)
+        return connection
+
+    def connect(connection):
+        connection.connect().result(CERT_SWAP_TIMEOUT)
+
+    def subscribe(connection):
+        for subscribe_future in subscribe_topics(connection, jobs_clients[connection]):
+            subscribe_future.result(SUBSCRIBE_TIMEOUT)
+
+    def close(connection):
+        try:
+            connection.disconnect().result(CERT_SWAP_TIMEOUT)
+        except Exception as e:
+            print("Failed to disconnect: {}".format(e))
+        mqtt5_clients.pop(connection, None)
+
+    old_connection = mqtt_connection
+    is_connected.clear()
+    try:
+        connection, swapped = switch_connection(old_connection, build, connect, subscribe, close,
+                                                lambda: write_certificate_files(*previous_certificates))
+    except Exception as e:
+        # Telemetry stays in the spool until the device is restarted with the previous certificate
+        print("Previous certificate did not reconnect either: {}".format(e))
+        return False
+
+    if connection is not old_connection:
+        mqtt_connection = connection
+        jobs_client = jobs_clients[connection]
+        # The rotation client is bound to the old connection
+        rotation_client = None
+    is_connected.set()
+    if swapped:
+        print("Swapped to the new certificate")
+    return swapped
+
 ##  CUSTOM CALLBACK FUNCTIONS ##
 
 # Callback when the delta topic receives a message. 
@@ -372,22 +827,30 @@ def on_delta_message_received(topic, payload, **kwargs):
     print("Received message from topic '{}'".format(topic))
     # print(json.dumps(json.loads(payload)))
     payload = json.loads(payload)
+    
+    if 'adaptive_interval' in payload['state']:
+        apply_adaptive_interval_settings(payload['state']['adaptive_interval'])
+    if 'calibration' in payload['state']:
+        report_calibration(apply_calibration(payload['state']['calibration']))
+    if 'sprinkler_state' not in payload['state']:
+        print("##======================================##\n\n")
+        return
+    
+    global SPRINKLER_STATE
     desired_state = payload['state']['sprinkler_state']
+    SPRINKLER_STATE = desired_state
     print("DESIRED SPRINKLER STATE: {}".format(desired_state))
+    
+    # The cloud detector supervises the local one, keep them in the same state
+    if EDGE_DECISIONS_ENABLED:
+        detector.sync(desired_state)
 
     if desired_state=="on":
         ##
         # Code to turn the sprinkler on...
         ##
         print("Sprinkler Turned On")
-        shadowDoc = {
-            "state": {
-                "reported": {
-                    "sprinkler_state": "on"
-                }
-            }
-        }
-        mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+        mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=SHADOW_REPORTED_SPRINKLER_STATE["on"], qos=mqtt.QoS.AT_LEAST_ONCE)
         print("Updated Shadow Document")
 
     if desired_state=="off":
@@ -395,18 +858,25 @@ def on_delta_message_received(topic, payload, **kwargs):
         # Code to turn the sprinkler off...
         ##
         print("Sprinkler Turned Off")
-        shadowDoc = {
-            "state": {
-                "reported": {
-                    "sprinkler_state": "off"
-                }
-            }
-        }
-        mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+        mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=SHADOW_REPORTED_SPRINKLER_STATE["off"], qos=mqtt.QoS.AT_LEAST_ONCE)
         print("Updated Shadow Document")
 
     print("##======================================##\n\n")
 
+# Switch the sprinkler from a local detector decision, without waiting for the cloud round trip
+def actuate_locally(sprinkler_state):
+    global SPRINKLER_STATE
+    SPRINKLER_STATE = sprinkler_state
+    print("\n##======================================##")
+    ##
+    # Code to turn the sprinkler on or off...
+    ##
+    print("Sprinkler Turned {} by local detector".format(sprinkler_state.capitalize()))
+    # Report the desired state as well so the shadow does not send back a stale delta
+    mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=SHADOW_LOCAL_SPRINKLER_STATE[sprinkler_state], qos=mqtt.QoS.AT_LEAST_ONCE)
+    print("Updated Shadow Document")
+    print("##======================================##\n\n")
+
 #  Callback that updates the ABS_HYDRATED_STATE_VALUE and ABS_DRY_STATE_VALUE from shadow doc
 def on_get_message_received(topic, payload, **kwargs):
     print("\n##======================================##")
@@ -422,23 +892,85 @@ def on_get_message_received(topic, payload, **kwargs):
     SPRINKLER_TRIGGER_PERCENTAGE = payload['state']['reported']['sprinkler_trigger_percentage']
     
     print("Updated 'ABS_HYDRATED_STATE_VALUE' and 'ABS_DRY_STATE_VALUE' with ShadowDoc")
+    
+    # The lookup table is only rebuilt when the curve or the hydrated and dry values changed
+    apply_calibration(payload['state'].get('desired', {}).get('calibration',
+        payload['state']['reported'].get('calibration', CALIBRATION_CURVE)))
+    
+    # Desired settings win over the last reported ones, a pending change is also sent as a delta
+    settings = payload['state'].get('desired', {}).get('adaptive_interval',
+        payload['state']['reported'].get('adaptive_interval'))
+    if settings is not None:
+        apply_adaptive_interval_settings(settings)
+    shadow_get_received.set()
+    print("##======================================##\n\n")
+
+# Callback when the shadow GET is rejected, the values from parameters.json stay in use
+def on_get_rejected_message_received(topic, payload, **kwargs):
+    print("\n##======================================##")
+    print("Received message from topic '{}'".format(topic))
+    payload = json.loads(payload)
+    print("Shadow get rejected ({}: {}), using values from parameters.json".format(payload.get('code'), payload.get('message')))
+    shadow_get_received.set()
     print("##======================================##\n\n")
 
+# Apply adaptive interval settings from the shadow and report them back to clear the delta
+def apply_adaptive_interval_settings(settings):
+    # Reports the settings in use, a rejected desired setting stays in the delta
+    try:
+        adaptive_interval.configure(settings)
+        print("Updated adaptive interval settings: {}".format(adaptive_interval.settings()))
+    except ValueError as e:
+        print("Rejected adaptive interval settings {}: {}. Keeping {}".format(settings, e, adaptive_interval.settings()))
+    shadowDoc = {
+        "state": {
+            "reported": {
+                "adaptive_interval": adaptive_interval.settings()
+            }
+        }
+    }
+    mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+
+# Rebuild the probe's lookup table when its calibration curve changed
+def apply_calibration(curve):
+    # Returns the curve in use, the previous one if this curve is rejected
+    curve = probe_curve(curve, ABS_HYDRATED_STATE_VALUE, ABS_DRY_STATE_VALUE)
+    try:
+        if calibration.set_curve(0, curve):
+            print("Rebuilt calibration table: {}".format(curve))
+    except (KeyError, TypeError, ValueError) as e:
+        print("Rejected invalid calibration {}: {}. Keeping {}".format(curve, e, calibration.curves[0]))
+    return calibration.curves[0]
+
+# Report the calibration curve in use, a rejected desired curve stays in the delta
+def report_calibration(curve):
+    shadowDoc = {
+        "state": {
+            "reported": {
+                "calibration": curve
+            }
+        }
+    }
+    mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+
 # Callback that updates device's certificates on receiving fresh certs
 
 def on_custom_certificate_create_complete(topic, payload, **kwargs):
     print("\n##======================================##")
     print("Received message from topic '{}'".format(topic))
     payload = json.loads(payload)
-    
+    # The swap blocks on connects and SUBACKs, keep it off the CRT and asyncio event loops
+    threading.Thread(target=complete_custom_certificate_rotation, args=[payload], daemon=True).start()
+
+def complete_custom_certificate_rotation(payload):
+    previous_certificates = read_certificate_files()
     # take payload and store certs to certificate folder
-    with open("devices/{}/certificates/{}_certificate.pem.crt".format(DEVICE_NAME, DEVICE_NAME), "w") as text_file:
-        text_file.write(payload['certificatePem'])
-    text_file.close()
+    write_certificate_files(payload['certificatePem'], payload['privateKey'])
     
-    with open("devices/{}/certificates/{}_private.pem.key".format(DEVICE_NAME, DEVICE_NAME), "w") as text_file:
-        text_file.write(payload['privateKey'])
-    text_file.close()
+    if not swap_connection(previous_certificates):
+        print("Certificate Rotation Failed")
+        print("\n##======================================##")
+        return
     
     # Certs rotated, inititate rotation completion flow
     payload = {
@@ -453,10 +985,6 @@ def on_custom_certificate_create_complete(topic, payload, **kwargs):
 """ 
     Define Publish Function 
 """
-# Calculate Soil Moisture % using map function
-def _map(x, in_min, in_max, out_min, out_max):
-    return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
-
 # Function that sends our sensor data to the cloud
 def publish(data):
     # if (data>=ABS_HYDRATED_STATE_VALUE) and (data<ABS_DRY_STATE_VALUE-95):
@@ -464,55 +992,315 @@ def publish(data):
     # else:
     #     sensorReportedState = "dry"
     
-    soil_moisture_percentage = _map(data, ABS_HYDRATED_STATE_VALUE, ABS_DRY_STATE_VALUE, 100, 0)    
+    # Soil Moisture % from the probe's calibration lookup table
+    soil_moisture_percentage = calibration.percentage(data)
     
     if (soil_moisture_percentage<=SPRINKLER_TRIGGER_PERCENTAGE):
         sensorReportedState = "dry"
     else:
         sensorReportedState = "hydrated"
     
-    message ={
-        "sensorType": "SoilMoistureSensor",
-        "deviceID": DEVICE_NAME,
-        "sensorReportedState": sensorReportedState,
-        "sensorReportedMoisturePercentage": soil_moisture_percentage,
-        # "exactValue": data #DELETE
+    if EDGE_DECISIONS_ENABLED:
+        new_sprinkler_state = detector.on_reading(sensorReportedState)
+        if new_sprinkler_state is not None:
+            actuate_locally(new_sprinkler_state)
+    
+    # Minutes until the soil reaches the trigger, from the readings of the current drying period
+    minutes_to_dry = None
+    if FORECAST_ENABLED:
+        forecaster.add(soil_moisture_percentage, SPRINKLER_STATE == "on")
+        minutes_to_dry = forecaster.minutes_to(SPRINKLER_TRIGGER_PERCENTAGE)
+        report_forecast(minutes_to_dry)
+    
+    # Report faster near the trigger point and while watering, slower when the value is stable
+    if ADAPTIVE_INTERVAL_ENABLED:
+        global DELAY
+        DELAY = adaptive_interval.update(soil_moisture_percentage, SPRINKLER_TRIGGER_PERCENTAGE, SPRINKLER_STATE == "on",
+                                         seconds_to_trigger=None if minutes_to_dry is None else minutes_to_dry * 60)
+    
+    # Number of readings this report stands for, used by the IoT Events debounce counter
+    sampleCount = 1
+    if DEADBAND_PERCENTAGE > 0:
+        sampleCount = deadband.should_report(soil_moisture_percentage, sensorReportedState)
+        if sampleCount is None:
+            if BATCH_MAX_READINGS > 1:
+                batch = batcher.flush_if_due()
+                if batch is not None:
+                    spool_batch(batch)
+            return
+    
+    if BATCH_MAX_READINGS > 1:
+        batch = batcher.add(sensorReportedState, soil_moisture_percentage, sampleCount)
+        if batch is not None:
+            spool_batch(batch)
+        return
+    
+    if PAYLOAD_FORMAT == 'struct':
+        spool.append(TOPIC_PUB_SENSOR_SM_BIN, binary_readings.encode(sensorReportedState, soil_moisture_percentage, sampleCount))
+        if LOG_READINGS:
+            print("\n=========> Spooled: {}% {} for the topic: '{}'".format(soil_moisture_percentage, sensorReportedState, TOPIC_PUB_SENSOR_SM_BIN))
+        return
+    
+    # Readings go through the spool, the drainer publishes them once the connection is up
+    payload = json_readings.encode(sensorReportedState, soil_moisture_percentage, sampleCount,
+                                   None if minutes_to_dry is None else int(minutes_to_dry))
+    spool.append(TOPIC_PUB_SENSOR_SM, payload)
+    if LOG_READINGS:
+        print("\n=========> Spooled: '{}' for the topic: '{}'".format(payload.decode('utf-8'), TOPIC_PUB_SENSOR_SM))
+
+# Report the predicted dry time to the shadow, so the cloud can stagger watering across zones
+def report_forecast(minutes_to_dry):
+    global REPORTED_DRY_AT
+    dry_at = None if minutes_to_dry is None else int(time.time() + minutes_to_dry * 60)
+    if dry_at is None and REPORTED_DRY_AT is None:
+        return
+    if (dry_at is not None and REPORTED_DRY_AT is not None and
+            abs(dry_at - REPORTED_DRY_AT) <= FORECAST_SHADOW_TOLERANCE_MINUTES * 60):
+        return
+    REPORTED_DRY_AT = dry_at
+    shadowDoc = {
+        "state": {
+            "reported": {
+                "forecast": {
+                    "predicted_dry_at": dry_at,
+                    "model": FORECAST_MODEL
+                }
+            }
+        }
     }
-    mqtt_connection.publish(topic=TOPIC_PUB_SENSOR_SM, payload=json.dumps(message), qos=mqtt.QoS.AT_LEAST_ONCE)
-    print("\n=========> Published: '" + json.dumps(message) + "' to the topic: '" + TOPIC_PUB_SENSOR_SM + "'")
+    mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_UPDATE, payload=json.dumps(shadowDoc), qos=mqtt.QoS.AT_LEAST_ONCE)
+    print("Reported predicted dry time: {}".format(dry_at))
+
+# Queue a full batch of readings in the configured wire format
+def spool_batch(batch):
+    if PAYLOAD_FORMAT == 'struct':
+        spool.append(TOPIC_PUB_SENSOR_SM_BIN, encode_batch(batch))
+        print("\n=========> Spooled batch of {} readings for the topic: '{}'".format(len(batch['readings']), TOPIC_PUB_SENSOR_SM_BIN))
+    else:
+        spool.append(TOPIC_PUB_SENSOR_SM_BATCH, json.dumps(batch, separators=(',', ':')))
+        print("\n=========> Spooled batch of {} readings for the topic: '{}'".format(len(batch['readings']), TOPIC_PUB_SENSOR_SM_BATCH))
+
+# Publish function used by the spool drainer, returns the PUBACK future
+def publish_spooled(topic, payload):
+    started = time.monotonic()
+    if MQTT_VERSION == 5:
+        publish_future = publish_with_expiry(mqtt5_clients[mqtt_connection], topic, payload, TELEMETRY_EXPIRY_SECONDS)
+    else:
+        publish_future, _ = mqtt_connection.publish(topic=topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)
+    publish_future.add_done_callback(lambda future: on_publish_acked(future, started))
+    return publish_future
+
+# Publish-to-PUBACK time of telemetry
+def on_publish_acked(future, started):
+    if future.exception() is None:
+        publish_ack_ms.observe_since(started)
+    else:
+        publish_failures.inc()
+
+def publish_metrics_report(topic, payload):
+    mqtt_connection.publish(topic=topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)
 
 
+"""
+    Device runtime
+"""
+# Simulated soil moisture probe, sweeps between the hydrated and dry values
+def simulated_sensor_readings():
+    while True:
+        var = ABS_HYDRATED_STATE_VALUE
+        delimiter = random.randrange(4, 20, 2) # nosec
+        
+        while(var<ABS_DRY_STATE_VALUE):
+            var = var+delimiter
+            yield var
+        
+        delimiter = random.randrange(4, 20, 2) # nosec
+        while(var>ABS_HYDRATED_STATE_VALUE):
+            var = var-delimiter
+            yield var
+
+# Reads the simulated probe, PROBE_NOISE adds the kind of jitter a real capacitive probe has
+def read_probe(reading):
+    if PROBE_NOISE:
+        return reading + random.gauss(0, PROBE_NOISE) # nosec
+    return reading
+
+# Waits for the shadow values instead of a fixed sleep, then reports the startup timeline
+def wait_for_shadow_get():
+    if shadow_get_received.wait(SHADOW_GET_TIMEOUT):
+        startup_timeline.mark("shadow_received")
+    else:
+        print("No shadow get response after {}s, using values from parameters.json".format(SHADOW_GET_TIMEOUT))
+        startup_timeline.mark("shadow_timeout")
+    startup_timeline.mark("ready")
+    startup_timeline.print_timeline()
+    if PUBLISH_STARTUP_TIMELINE:
+        timeline = {"deviceID": DEVICE_NAME, "runtime": RUNTIME, "timeline": startup_timeline.to_dict()}
+        mqtt_connection.publish(topic=TOPIC_PUB_STARTUP_TIMELINE, payload=json.dumps(timeline), qos=mqtt.QoS.AT_LEAST_ONCE)
+
+# Runs a CRT callback on the asyncio loop when the asyncio runtime is selected
+def on_loop(callback):
+    # Execution time of every MQTT callback goes to the callback_ms histogram
+    callback = metrics.timed('callback_ms', callback)
+    if RUNTIME == 'asyncio':
+        return async_runtime.dispatch(callback)
+    return callback
+
+async def sensor_task():
+    await async_runtime.loop.run_in_executor(None, wait_for_shadow_get)
+    for reading in simulated_sensor_readings():
+        device_profiler.on_main_loop()
+        for _ in range(OVERSAMPLE_COUNT):
+            probe_filter.add(read_probe(reading))
+            await asyncio.sleep(DELAY / OVERSAMPLE_COUNT)
+        publish(probe_filter.value())
+
+async def job_worker():
+    while True:
+        job_id, job_document = await job_queue.get()
+        # Job handlers do blocking file and network I/O, keep it off the event loop
+        await async_runtime.loop.run_in_executor(None, job_thread_fn, job_id, job_document)
+
+# Sends every subscription of the device without waiting, the shadow get/accepted and get/rejected futures come first
+def subscribe_topics(connection, jobs):
+    print("Subscribing to topic '{}'...".format(TOPIC_SUB_SHADOW_GET))
+    subscribe_future, _ = connection.subscribe(
+            topic=TOPIC_SUB_SHADOW_GET,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_loop(on_get_message_received)
+    )
+    subscribe_futures = [subscribe_future]
+
+    print("Subscribing to topic '{}'...".format(TOPIC_SUB_SHADOW_GET_REJECTED))
+    subscribe_future, _ = connection.subscribe(
+            topic=TOPIC_SUB_SHADOW_GET_REJECTED,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_loop(on_get_rejected_message_received)
+    )
+    subscribe_futures.append(subscribe_future)
+
+    print("Subscribing to topic '{}'...".format(TOPIC_SUB_SHADOW_DELTA))
+    subscribe_future, _ = connection.subscribe(
+            topic=TOPIC_SUB_SHADOW_DELTA,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_loop(on_delta_message_received)
+    )
+    subscribe_futures.append(subscribe_future)
+
+    #### Subscribe to Custom Cert rotation topic
+    print("Subscribing to topic '{}'...".format(TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE))
+    subscribe_future, _ = connection.subscribe(
+            topic=TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_loop(on_custom_certificate_create_complete)
+    )
+    subscribe_futures.append(subscribe_future)
+
+    #### Subscribe to Job Topics
+    print("\nBegin Jobs Topics Subscriptions")
+
+    print("Subscribing to Next Changed events...")
+    changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
+        thing_name=DEVICE_NAME)
+    subscribe_future, _ = jobs.subscribe_to_next_job_execution_changed_events(
+        request=changed_subscription_request,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_loop(on_next_job_execution_changed))
+    subscribe_futures.append(subscribe_future)
+
+    print("Subscribing to Start responses...")
+    start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
+        thing_name=DEVICE_NAME)
+    subscribe_future, _ = jobs.subscribe_to_start_next_pending_job_execution_accepted(
+        request=start_subscription_request,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_loop(on_start_next_pending_job_execution_accepted))
+    subscribe_futures.append(subscribe_future)
+
+    subscribe_future, _ = jobs.subscribe_to_start_next_pending_job_execution_rejected(
+        request=start_subscription_request,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_loop(on_start_next_pending_job_execution_rejected))
+    subscribe_futures.append(subscribe_future)
+
+    print("Subscribing to Update responses...")
+    # Note that we subscribe to "+", the MQTT wildcard, to receive
+    # responses about any job-ID.
+    update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
+            thing_name=DEVICE_NAME,
+            job_id='+')
+
+    subscribe_future, _ = jobs.subscribe_to_update_job_execution_accepted(
+        request=update_subscription_request,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_loop(on_update_job_execution_accepted))
+    subscribe_futures.append(subscribe_future)
+
+    subscribe_future, _ = jobs.subscribe_to_update_job_execution_rejected(
+        request=update_subscription_request,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_loop(on_update_job_execution_rejected))
+    subscribe_futures.append(subscribe_future)
+    
+    return subscribe_futures
+
+# Builds the device connection, used at startup and for a certificate swap
+def build_connection(cert_path, key_path):
+    if MQTT_VERSION == 5:
+        client, connection = build_mqtt5_connection(ENDPOINT, cert_path, key_path, PATH_TO_ROOT, CLIENT_ID, client_bootstrap,
+                                                    on_connection_interrupted, on_connection_resumed,
+                                                    persistent_session=PERSISTENT_SESSION,
+                                                    keep_alive_secs=KEEP_ALIVE_SECS,
+                                                    receive_maximum=RECEIVE_MAXIMUM,
+                                                    topic_alias_cache_size=TOPIC_ALIAS_CACHE_SIZE,
+                                                    reconnect_min_secs=RECONNECT_MIN_TIMEOUT,
+                                                    reconnect_max_secs=RECONNECT_MAX_TIMEOUT)
+        mqtt5_clients[connection] = client
+        return connection
+    return build_mqtt3_connection(ENDPOINT, cert_path, key_path, PATH_TO_ROOT, CLIENT_ID, client_bootstrap,
+                                  on_connection_interrupted, on_connection_resumed,
+                                  clean_session=not PERSISTENT_SESSION,
+                                  keep_alive_secs=KEEP_ALIVE_SECS,
+                                  reconnect_min_secs=RECONNECT_MIN_TIMEOUT,
+                                  reconnect_max_secs=RECONNECT_MAX_TIMEOUT)
+
 """
     Establishing connection and executing device code
 """
 
 if __name__ == '__main__':
     io.init_logging(io.LogLevel.Error, 'stderr')
+    if MQTT_VERSION == 5 and build_mqtt5_connection is None:
+        sys.exit("mqtt_version 5 needs MQTT5 support, upgrade with: python3 -m pip install --upgrade awsiotsdk")
+    if RUNTIME == 'asyncio':
+        async_runtime = AsyncRuntime()
+        job_queue = asyncio.Queue()
+    # detector_model.json is only read when the edge detector or the deadband filter uses it
+    detector_definition = None
+    if EDGE_DECISIONS_ENABLED or DEADBAND_PERCENTAGE > 0:
+        detector_definition = load_definition(DETECTOR_MODEL_PATH)
+    if EDGE_DECISIONS_ENABLED:
+        detector = WateringDetector(detector_definition)
+    adaptive_interval = AdaptiveInterval(ADAPTIVE_MIN_INTERVAL, ADAPTIVE_MAX_INTERVAL, ADAPTIVE_GAIN)
+    calibration = CalibrationTable(CALIBRATION_ADC_MAX)
+    forecaster = DryForecaster(FORECAST_WINDOW, FORECAST_MODEL, FORECAST_MIN_SAMPLES)
+    calibration.set_curve(0, probe_curve(CALIBRATION_CURVE, ABS_HYDRATED_STATE_VALUE, ABS_DRY_STATE_VALUE))
+    # Opened before connecting, the connection callbacks report its drop counter
+    spool = open_spool(parameters, parameter_path)
     #### Spin up resources #### 
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-                endpoint=ENDPOINT,
-                cert_filepath=PATH_TO_CERT,
-                pri_key_filepath=PATH_TO_KEY,
-                client_bootstrap=client_bootstrap,
-                ca_filepath=PATH_TO_ROOT,
-                client_id=CLIENT_ID,
-                clean_session=True,
-                keep_alive_secs=6
-                )
+    client_bootstrap = build_client_bootstrap()
+    mqtt_connection = build_connection(PATH_TO_CERT, PATH_TO_KEY)
     
     #### Attempt connecting to AWS IoT #### 
     print("Connecting to {} with client ID '{}'...".format(
             ENDPOINT, CLIENT_ID))
-    # Make the connect() call
-    connect_future = mqtt_connection.connect()
     # Establish Jobs Client
     jobs_client = iotjobs.IotJobsClient(mqtt_connection)
-    # Future.result() waits until a result is available
-    connect_future.result()
+    # Retries with jittered exponential backoff until the connection is accepted
+    connect_with_backoff(mqtt_connection, RECONNECT_MIN_TIMEOUT, CONNECT_RETRY_MAX_SECONDS)
     print("Connected!")
+    is_connected.set()
+    startup_timeline.mark("connected")
     
     #### Check if this is new device. If yes, report device params #### 
     if parameters['new_device']==True:
@@ -537,113 +1325,75 @@ if __name__ == '__main__':
     
     
     #### Subscribe to Topics #### 
+    # All subscriptions are sent at once and awaited together, instead of one round trip each
     print('Begin Subscribe')
     try:
-        print("Subscribing to topic '{}'...".format(TOPIC_SUB_SHADOW_DELTA))
-        subscribe_topic, packet_id = mqtt_connection.subscribe(
-                topic=TOPIC_SUB_SHADOW_DELTA,
-                qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=on_delta_message_received
-        )
-        subscribe_topic.result()
-        #### Subscribe to Shadow Get Topic
-        print("Subscribing to topic '{}'...".format(TOPIC_SUB_SHADOW_GET))
-        subscribe_topic, packet_id = mqtt_connection.subscribe(
-                topic=TOPIC_SUB_SHADOW_GET,
-                qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=on_get_message_received
-        )
-        subscribe_topic.result()
+        subscribe_futures = subscribe_topics(mqtt_connection, jobs_client)
         
-        #### Subscribe to Custom Cert rotation topic
-        print("Subscribing to topic '{}'...".format(TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE))
-        subscribe_topic, packet_id = mqtt_connection.subscribe(
-                topic=TOPIC_SUB_CUSTOM_CERT_CREATE_COMPLETE,
-                qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=on_custom_certificate_create_complete
-        )
-        subscribe_topic.result()
+        #### Publish to shadow GET topic to receive the abs_hydrated_state_value & abs_dry_state_value value. #### 
+        # Sent as soon as get/accepted and get/rejected are subscribed, while the other SUBACKs are still in flight
+        for subscribe_future in subscribe_futures[:2]:
+            subscribe_future.result(SUBSCRIBE_TIMEOUT)
+        empty_payload={}
+        mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_GET, payload=json.dumps(empty_payload), qos=mqtt.QoS.AT_LEAST_ONCE)
+        print("\n=========> Published: '" + json.dumps(empty_payload) + "' to the topic: '" + TOPIC_PUB_SHADOW_GET + "'")
         
-        #### Subscribe to Job Topics
-        print("\nBegin Jobs Topics Subscriptions")
-        
-        print("Subscribing to Next Changed events...")
-        changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
-            thing_name=DEVICE_NAME)
-        subscribed_future, _ = jobs_client.subscribe_to_next_job_execution_changed_events(
-            request=changed_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_next_job_execution_changed)
-        # Wait for subscription to succeed
-        subscribed_future.result()
-        
-        print("Subscribing to Start responses...")
-        start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
-            thing_name=DEVICE_NAME)
-        subscribed_accepted_future, _ = jobs_client.subscribe_to_start_next_pending_job_execution_accepted(
-            request=start_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_start_next_pending_job_execution_accepted)
-    
-        subscribed_rejected_future, _ = jobs_client.subscribe_to_start_next_pending_job_execution_rejected(
-            request=start_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_start_next_pending_job_execution_rejected)
-    
-        # Wait for subscriptions to succeed
-        subscribed_accepted_future.result()
-        subscribed_rejected_future.result()
-        
-        print("Subscribing to Update responses...")
-        # Note that we subscribe to "+", the MQTT wildcard, to receive
-        # responses about any job-ID.
-        update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
-                thing_name=DEVICE_NAME,
-                job_id='+')
-    
-        subscribed_accepted_future, _ = jobs_client.subscribe_to_update_job_execution_accepted(
-            request=update_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_job_execution_accepted)
-    
-        subscribed_rejected_future, _ = jobs_client.subscribe_to_update_job_execution_rejected(
-            request=update_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_job_execution_rejected)
-    
-        # Wait for subscriptions to succeed
-        subscribed_accepted_future.result()
-        subscribed_rejected_future.result()
+        # Wait for all subscriptions to succeed
+        for subscribe_future in subscribe_futures:
+            subscribe_future.result(SUBSCRIBE_TIMEOUT)
         
     except Exception as e:
         exit(e)
     print('Subscribe End')
+    startup_timeline.mark("subscribed")
     
-    #### Publish to shadow GET topic to receive the abs_hydrated_state_value & abs_dry_state_value value. #### 
-    empty_payload={}
-    mqtt_connection.publish(topic=TOPIC_PUB_SHADOW_GET, payload=json.dumps(empty_payload), qos=mqtt.QoS.AT_LEAST_ONCE)
-    print("\n=========> Published: '" + json.dumps(empty_payload) + "' to the topic: '" + TOPIC_PUB_SHADOW_GET + "'")
-    t.sleep(1)
+    # The asyncio runtime only runs the get callback once its loop starts, sensor_task waits there instead
+    if RUNTIME != 'asyncio':
+        wait_for_shadow_get()
     
     #### Make attempat to start job
     try_start_next_job()
     
+    #### Report device health metrics, outbound queue depth is read from the spool at report time ####
+    if METRICS_ENABLED:
+        metrics.gauge('spool_pending_bytes', spool.pending_bytes)
+        metrics.gauge('spool_dropped_records', lambda: spool.dropped_records)
+        metrics_reporter = MetricsReporter(metrics, publish_metrics_report, TOPIC_PUB_DEFENDER_METRICS, is_connected, METRICS_REPORT_INTERVAL)
+        metrics_reporter.start()
+    
+    #### Start draining spooled sensor data, including readings left over from a previous run ####
+    if RUNTIME != 'asyncio':
+        spool_drainer = SpoolDrainer(spool, publish_spooled, is_connected, SPOOL_DRAIN_RATE)
+        spool_drainer.start()
+    batcher = ReadingBatcher("SoilMoistureSensor", DEVICE_NAME, BATCH_MAX_READINGS, BATCH_MAX_SECONDS)
+    probe_filter = ProbeFilter(FILTER_WINDOW, FILTER_METHOD)
+    # Never hold back more readings than the detector needs to make a decision
+    if detector_definition is not None:
+        deadband = DeadbandFilter(DEADBAND_PERCENTAGE, DEADBAND_MAX_SILENCE_SECONDS,
+                                  detector_definition['debounce_threshold'])
+    else:
+        # Unused with a deadband_percentage of 0, publish() then reports every reading
+        deadband = DeadbandFilter(DEADBAND_PERCENTAGE, DEADBAND_MAX_SILENCE_SECONDS)
+    
     #### Begin infinite publish of Soil Moisture Sensor Data #### 
     print('Begin Infinite Publish')
-    while True:
-        var = ABS_HYDRATED_STATE_VALUE
-        delimiter = random.randrange(4, 20, 2) # nosec
-        
-        while(var<ABS_DRY_STATE_VALUE):
-            var = var+delimiter
-            publish(var)
-            t.sleep(DELAY)
-        
-        delimiter = random.randrange(4, 20, 2) # nosec
-        while(var>ABS_HYDRATED_STATE_VALUE):
-            var = var-delimiter
-            publish(var)
-            t.sleep(DELAY)
+    if RUNTIME == 'asyncio':
+        try:
+            async_runtime.run(
+                sensor_task(),
+                drain_spool(spool, publish_spooled, is_connected, SPOOL_DRAIN_RATE),
+                job_worker()
+            )
+            exit("Async runtime stopped")
+        except Exception as e:
+            exit(e)
+    else:
+        for reading in simulated_sensor_readings():
+            device_profiler.on_main_loop()
+            for _ in range(OVERSAMPLE_COUNT):
+                probe_filter.add(read_probe(reading))
+                t.sleep(DELAY / OVERSAMPLE_COUNT)
+            publish(probe_filter.value())
             
     # Wait for the sample to finish (won't finish)
     is_sample_done.wait()
\ No newline at end of file
@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Rebuilds a firmware image from the image already on the device and a delta
+patch created by the ota_update Lambda (lambda/ota_update/firmware_delta.py).
+The patch format must match on both sides.
+
+Patch layout:
+    | magic "IESD" | format version (1 byte) | base size (8 bytes) | target size (8 bytes) |
+    | base SHA-256 (32 bytes) | target SHA-256 (32 bytes) | zlib stream of operations |
+Operations:
+    | "C" | base offset (8 bytes) | length (4 bytes) |   copy bytes from the base image
+    | "I" | length (4 bytes) | data |                   insert new bytes
+    | "E" |                                             end of patch
+
+The patch is decompressed and applied as a stream, so neither image is held in
+memory. Delta files are named firmware_v<base>_to_v<target>.patch in the OTA job.
+'''
+
+
+import hashlib
+import os
+import re
+import struct
+import zlib
+
+MAGIC = b'IESD'
+FORMAT_VERSION = 1
+HEADER_FORMAT = struct.Struct('>4sBQQ32s32s')
+COPY_FORMAT = struct.Struct('>QI')
+INSERT_FORMAT = struct.Struct('>I')
+OP_COPY, OP_INSERT, OP_END = b'C', b'I', b'E'
+DELTA_FILE_PATTERN = re.compile(r'firmware_v(?P<base>.+)_to_v(?P<target>.+)\.patch$')
+FIRMWARE_FILE_PATTERN = re.compile(r'firmware_v(?P<version>.+)\.zip$')
+
+
+class PatchError(Exception):
+    pass
+
+
+def firmware_version(file_name):
+    # "firmware_v1.4.zip" -> "1.4", same naming as the update_thing_firmware_version Lambda
+    match = FIRMWARE_FILE_PATTERN.search(file_name or '')
+    return match.group('version') if match else None
+
+
+def delta_base_version(file_name):
+    # "firmware_v1.3_to_v1.4.patch" -> "1.3", None for full images
+    match = DELTA_FILE_PATTERN.search(file_name or '')
+    return match.group('base') if match else None
+
+
+class PatchStream:
+    # Reads exact byte counts from the zlib compressed operations of a patch file
+    def __init__(self, f, chunk_bytes=65536):
+        self.f = f
+        self.chunk_bytes = chunk_bytes
+        self.decompressor = zlib.decompressobj()
+        # Decompressed bytes, read up to offset. The read part is only dropped when more
+        # data is decompressed, so small operation headers do not copy the whole buffer
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            data = self.f.read(self.chunk_bytes)
+            if not data:
+                raise PatchError("Patch is truncated")
+            del self.buffer[:self.offset]
+            self.offset = 0
+            self.buffer += self.decompressor.decompress(data)
+        data = bytes(self.buffer[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+
+def apply_patch(base_path, patch_path, output_path, chunk_bytes=65536):
+    # Writes the rebuilt image to output_path, returns its SHA-256 digest
+    with open(patch_path, 'rb') as patch:
+        magic, version, base_size, target_size, base_sha256, target_sha256 = HEADER_FORMAT.unpack(
+            patch.read(HEADER_FORMAT.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise PatchError("Not a firmware patch, or an unsupported patch format version")
+        base_digest = hashlib.sha256()
+        with open(base_path, 'rb') as base:
+            for chunk in iter(lambda: base.read(chunk_bytes), b''):
+                base_digest.update(chunk)
+        if os.path.getsize(base_path) != base_size or base_digest.digest() != base_sha256:
+            raise PatchError("Patch was made for a different base image")
+
+        stream = PatchStream(patch, chunk_bytes)
+        digest = hashlib.sha256()
+        written = 0
+        with open(base_path, 'rb') as base, open(output_path, 'wb') as output:
+            while True:
+                operation = stream.read(1)
+                if operation == OP_END:
+                    break
+                if operation == OP_COPY:
+                    offset, remaining = COPY_FORMAT.unpack(stream.read(COPY_FORMAT.size))
+                    base.seek(offset)
+                    read = base.read
+                elif operation == OP_INSERT:
+                    remaining, = INSERT_FORMAT.unpack(stream.read(INSERT_FORMAT.size))
+                    read = stream.read
+                else:
+                    raise PatchError("Unknown patch operation {!r}".format(operation))
+                while remaining:
+                    data = read(min(chunk_bytes, remaining))
+                    if not data:
+                        raise PatchError("Patch copies past the end of the base image")
+                    output.write(data)
+                    digest.update(data)
+                    written += len(data)
+                    remaining -= len(data)
+            output.flush()
+            os.fsync(output.fileno())
+        if written != target_size or digest.digest() != target_sha256:
+            raise PatchError("Rebuilt image does not match the patch's target image")
+    return digest.digest()
@@ -0,0 +1,179 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Streaming, resumable and verified firmware download for OTA jobs.
+
+The image is streamed to <file>.part in fixed-size chunks, so it is never held
+in memory. If the link drops, the download resumes from the bytes already on
+disk with an HTTP Range request, both within one job run and across runs: a
+small <file>.part.json sidecar records which image the partial file belongs to.
+Once the expected size is reached, the file is hashed in chunks and verified
+against the job document (size, optional SHA-256, and the code signing
+signature if the cryptography package is installed), then renamed into place.
+'''
+
+
+import base64
+import hashlib
+import json
+import os
+from os.path import exists
+import time
+import requests # install explicitly
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, utils
+except ImportError:
+    x509 = None
+
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+
+class FirmwareVerificationError(Exception):
+    pass
+
+
+def ota_file_entries(job_document):
+    # The afr_ota "files" entry is a list in FreeRTOS OTA job documents, accept a single object too
+    files = job_document['afr_ota']['files']
+    return files if isinstance(files, list) else [files]
+
+
+def sha256_file(path, chunk_bytes=65536):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def verify_signature(digest, signature_b64, cert_path):
+    # ECDSA over the SHA-256 of the image, as produced by the AmazonFreeRTOS-Default signer profile
+    if x509 is None:
+        print("cryptography is not installed, skipping firmware signature check")
+        return
+    with open(cert_path, 'rb') as f:
+        certificate = x509.load_pem_x509_certificate(f.read())
+    try:
+        certificate.public_key().verify(base64.b64decode(signature_b64), digest,
+                                        ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+    except Exception as e:
+        raise FirmwareVerificationError("Firmware signature does not match: {}".format(e))
+
+
+class FirmwareDownloader:
+    def __init__(self, chunk_bytes=65536, request_timeout=30, max_retries=10, backoff=None,
+                 progress_fn=None, progress_step_percent=10):
+        # progress_fn(bytes_done, total_bytes) is called at most every progress_step_percent
+        self.chunk_bytes = chunk_bytes
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.progress_fn = progress_fn
+        self.progress_step_percent = progress_step_percent
+        self.resumed_bytes = 0
+        self.attempts = 0
+        self.reported_percent = 0
+
+    def _load_state(self, path, image_id):
+        # Keep a partial file only if it belongs to the same image
+        part_path = path + PART_SUFFIX
+        try:
+            with open(path + STATE_SUFFIX) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get('imageId') != image_id and exists(part_path):
+            os.remove(part_path)
+        with open(path + STATE_SUFFIX, 'w') as f:
+            json.dump({'imageId': image_id}, f)
+        return os.path.getsize(part_path) if exists(part_path) else 0
+
+    def _report(self, done, total):
+        percent = int(done * 100 / total) if total else 100
+        if self.progress_fn is not None and (percent - self.reported_percent >= self.progress_step_percent or done == total):
+            self.progress_fn(done, total)
+            self.reported_percent = percent
+
+    def _fetch(self, url, part_path, offset, total):
+        # One HTTP request, appends to the partial file and returns the new offset
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=self.request_timeout) as response: # nosec
+            if response.status_code == 416:
+                # The partial file is longer than the image on the server, start over
+                os.remove(part_path)
+                return 0
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # Server ignored the Range header, start over
+                print("Server does not support resuming, restarting download")
+                offset = 0
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                try:
+                    for chunk in response.iter_content(chunk_size=self.chunk_bytes):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        self._report(offset, total)
+                finally:
+                    # Keep what arrived, the next attempt resumes from here
+                    f.flush()
+                    os.fsync(f.fileno())
+        return offset
+
+    def download(self, url, path, expected_size, image_id, expected_sha256=None, signature=None, cert_path=None):
+        # Returns the SHA-256 hex digest of the verified image, now at path
+        part_path = path + PART_SUFFIX
+        offset = self._load_state(path, image_id)
+        self.resumed_bytes = offset
+        self.reported_percent = int(offset * 100 / expected_size) if expected_size else 0
+        if offset:
+            print("Resuming firmware download at byte {} of {}".format(offset, expected_size))
+
+        self.attempts = 0
+        while offset < expected_size:
+            self.attempts += 1
+            try:
+                offset = self._fetch(url, part_path, offset, expected_size)
+                if offset < expected_size:
+                    raise IOError("Connection closed at byte {} of {}".format(offset, expected_size))
+            except (requests.RequestException, IOError) as e:
+                if self.attempts > self.max_retries:
+                    raise
+                if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code in (401, 403):
+                    # An expired presigned URL does not recover, the partial file is kept for the next job run
+                    raise
+                offset = os.path.getsize(part_path) if exists(part_path) else 0
+                delay = self.backoff.next_delay() if self.backoff is not None else 1
+                print("Firmware download interrupted at byte {}: {}. Retrying in {:.1f}s".format(offset, e, delay))
+                time.sleep(delay)
+        if self.backoff is not None:
+            self.backoff.reset()
+
+        try:
+            digest = self.verify(part_path, expected_size, expected_sha256, signature, cert_path)
+        except FirmwareVerificationError:
+            # A bad image must not be resumed, the next attempt starts from zero
+            os.remove(part_path)
+            os.remove(path + STATE_SUFFIX)
+            raise
+        os.replace(part_path, path)
+        os.remove(path + STATE_SUFFIX)
+        return digest.hex()
+
+    def verify(self, part_path, expected_size, expected_sha256=None, signature=None, cert_path=None):
+        size = os.path.getsize(part_path)
+        if size != expected_size:
+            raise FirmwareVerificationError("Firmware size {} does not match the expected {}".format(size, expected_size))
+        digest = sha256_file(part_path, self.chunk_bytes)
+        if expected_sha256 and digest.hex() != expected_sha256.lower():
+            raise FirmwareVerificationError("Firmware SHA-256 {} does not match the expected {}".format(digest.hex(), expected_sha256))
+        if signature and cert_path:
+            verify_signature(digest, signature, cert_path)
+        return digest
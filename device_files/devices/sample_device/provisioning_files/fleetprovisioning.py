@@ -6,7 +6,7 @@ import argparse
 from awscrt import auth, http, io, mqtt
 from awsiot import iotidentity
 from awsiot import mqtt_connection_builder
-from concurrent.futures import Future
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import sys
 import threading
 import time
@@ -16,160 +16,245 @@ import json
 import os
 from datetime import date
 
-def provision_device(device_name, endpoint, root_ca, templateName, performCertificateRotation=False,
-                version=None, sensor_type=None, plant_id=None, firmwareVersion= '13.3.4',
-                client_id="test-"+str(uuid4()), verbosity=io.LogLevel.NoLogs.name):
 
-    cert= "devices/{}/provisioning_files/claim.certificate.pem".format(device_name)
-    key= "devices/{}/provisioning_files/claim.private.key".format(device_name)
-    
-    today = date.today()
-    
-    if performCertificateRotation==True:
-        print('Attempting to rotate certificates')
-        templateParameters = {
-            "ThingName": device_name,
-            "CertificateCreatedOn": str(today)
-        }
-    else:
-        print("Provisioning device")
-        templateParameters = {
-            "SerialNumber": device_name,
-            "CertificateCreatedOn": str(today),
-            "SensorType": sensor_type,
-            "PlantId": plant_id,
-            "FirmwareVersion": firmwareVersion
-        }
-    
-    # Using globals to simplify sample code
-    is_sample_done = threading.Event()
-
-    io.init_logging(getattr(io.LogLevel, verbosity), 'stderr')
-    mqtt_connection = None
-    identity_client = None
-
-    global createKeysAndCertificateResponse
-    createKeysAndCertificateResponse = None
-    
-    global registerThingResponse
-    registerThingResponse = None
-    
-    global certificateID
-    certificateID = None
-
-    class LockedData:
-        def __init__(self):
-            self.lock = threading.Lock()
-            self.disconnect_called = False
-
-    locked_data = LockedData()
-
-    # Function for gracefully quitting this sample
-    def exit(msg_or_exception):
-        if isinstance(msg_or_exception, Exception):
-            print("Exiting Provisioning due to exception.")
-            traceback.print_exception(msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2])
-        else:
-            print("Exiting Provisioning:", msg_or_exception)
-
-        with locked_data.lock:
-            if not locked_data.disconnect_called:
-                print("Disconnecting...")
-                locked_data.disconnect_called = True
-                future = mqtt_connection.disconnect()
-                future.add_done_callback(on_disconnected)
-
-    def on_disconnected(disconnect_future):
-        # type: (Future) -> None
-        print("Disconnected.")
-
-        # Signal that sample is finished
-        is_sample_done.set()
-
-    def on_publish_register_thing(future):
-        # type: (Future) -> None
+class ProvisioningClient:
+    '''
+    Fleet provisioning client that keeps one MQTT session across requests.
+
+    It either wraps a live connection, such as the device's own connection when
+    rotating certificates, or opens its own connection with the given (claim)
+    certificate, optionally on an existing ClientBootstrap. The identity
+    subscriptions are made once per session. Requests on one client are
+    serialized because CreateKeysAndCertificate and RegisterThing responses
+    carry no correlation token, use one client per worker for concurrency.
+    '''
+    def __init__(self, endpoint=None, cert=None, key=None, root_ca=None, client_id=None,
+                 mqtt_connection=None, client_bootstrap=None,
+                 create_keys_timeout=12, register_thing_timeout=20):
+        self.endpoint = endpoint
+        self.cert = cert
+        self.key = key
+        self.root_ca = root_ca
+        self.client_id = client_id or "test-" + str(uuid4())
+        self.mqtt_connection = mqtt_connection
+        self.owns_connection = mqtt_connection is None
+        self.client_bootstrap = client_bootstrap
+        self.create_keys_timeout = create_keys_timeout
+        self.register_thing_timeout = register_thing_timeout
+        self.identity_client = None
+        self.lock = threading.Lock()
+        self.create_keys_subscribed = False
+        self.subscribed_templates = set()
+        # Completed by the accepted/rejected callbacks of the request in flight
+        self.create_keys_future = None
+        self.register_thing_future = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        if self.identity_client is not None:
+            return
+        if self.owns_connection:
+            if self.client_bootstrap is None:
+                event_loop_group = io.EventLoopGroup(1)
+                host_resolver = io.DefaultHostResolver(event_loop_group)
+                self.client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+            self.mqtt_connection = mqtt_connection_builder.mtls_from_path(
+                endpoint=self.endpoint,
+                cert_filepath=self.cert,
+                pri_key_filepath=self.key,
+                client_bootstrap=self.client_bootstrap,
+                ca_filepath=self.root_ca,
+                client_id=self.client_id,
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed,
+                clean_session=False,
+                keep_alive_secs=30
+            )
+            print("Connecting to {} with client ID '{}'...".format(
+                self.endpoint, self.client_id))
+            self.mqtt_connection.connect().result()
+            print("Connected!")
+        self.identity_client = iotidentity.IotIdentityClient(self.mqtt_connection)
+
+    def close(self):
+        if self.owns_connection and self.mqtt_connection is not None and self.identity_client is not None:
+            print("Disconnecting...")
+            self.mqtt_connection.disconnect().result()
+            print("Disconnected.")
+        self.identity_client = None
+        self.create_keys_subscribed = False
+        self.subscribed_templates = set()
+
+    def subscribe(self, template_name):
+        # Subscriptions missing from this session are sent together and awaited together
+        subscribe_futures = []
+        if not self.create_keys_subscribed:
+            createkeysandcertificate_subscription_request = iotidentity.CreateKeysAndCertificateSubscriptionRequest()
+
+            print("Subscribing to CreateKeysAndCertificate Accepted topic...")
+            subscribe_future, _ = self.identity_client.subscribe_to_create_keys_and_certificate_accepted(
+                request=createkeysandcertificate_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.createkeysandcertificate_execution_accepted)
+            subscribe_futures.append(subscribe_future)
+
+            print("Subscribing to CreateKeysAndCertificate Rejected topic...")
+            subscribe_future, _ = self.identity_client.subscribe_to_create_keys_and_certificate_rejected(
+                request=createkeysandcertificate_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.createkeysandcertificate_execution_rejected)
+            subscribe_futures.append(subscribe_future)
+
+        if template_name not in self.subscribed_templates:
+            registerthing_subscription_request = iotidentity.RegisterThingSubscriptionRequest(template_name=template_name)
+
+            print("Subscribing to RegisterThing Accepted topic...")
+            subscribe_future, _ = self.identity_client.subscribe_to_register_thing_accepted(
+                request=registerthing_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.registerthing_execution_accepted)
+            subscribe_futures.append(subscribe_future)
+
+            print("Subscribing to RegisterThing Rejected topic...")
+            subscribe_future, _ = self.identity_client.subscribe_to_register_thing_rejected(
+                request=registerthing_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.registerthing_execution_rejected)
+            subscribe_futures.append(subscribe_future)
+
+        # Wait for subscriptions to succeed, with the same bound as the requests
+        for subscribe_future in subscribe_futures:
+            try:
+                subscribe_future.result(self.create_keys_timeout)
+            except FutureTimeoutError:
+                raise Exception('Identity subscriptions were not acknowledged within {}s'.format(self.create_keys_timeout))
+        self.create_keys_subscribed = True
+        self.subscribed_templates.add(template_name)
+
+    def provision(self, template_name, template_parameters):
+        '''
+        Creates keys and a certificate and registers them with template_name.
+
+        Returns the CreateKeysAndCertificate and RegisterThing responses and the
+        per-step latency in milliseconds. Raises on rejection or timeout.
+        '''
+        with self.lock:
+            step_latency = {}
+            step_start = time.monotonic()
+
+            def end_step(name):
+                nonlocal step_start
+                now = time.monotonic()
+                step_latency[name] = round((now - step_start) * 1000, 1)
+                print("Provisioning step '{}' took {} ms".format(name, step_latency[name]))
+                step_start = now
+
+            if self.identity_client is None:
+                self.connect()
+                end_step("connect")
+
+            if not self.create_keys_subscribed or template_name not in self.subscribed_templates:
+                self.subscribe(template_name)
+                end_step("subscribe")
+
+            try:
+                return self._request(template_name, template_parameters, step_latency, end_step)
+            finally:
+                # A late response to this request finds no future, instead of completing the next request's
+                self.create_keys_future = None
+                self.register_thing_future = None
+
+    def _request(self, template_name, template_parameters, step_latency, end_step):
+        # Each future is created right before its own publish, so a response that arrives earlier is dropped
+        create_keys_future = self.create_keys_future = Future()
+        print("Publishing to CreateKeysAndCertificate...")
+        publish_future = self.identity_client.publish_create_keys_and_certificate(
+            request=iotidentity.CreateKeysAndCertificateRequest(), qos=mqtt.QoS.AT_LEAST_ONCE)
+        publish_future.add_done_callback(
+            lambda future: self.on_publish(future, "CreateKeysAndCertificate", create_keys_future))
+
+        # Raises the rejection, or a timeout if no response arrives in time
         try:
-            future.result() # raises exception if publish failed
-            print("Published RegisterThing request..")
+            createKeysAndCertificateResponse = create_keys_future.result(self.create_keys_timeout)
+        except FutureTimeoutError:
+            raise Exception('CreateKeysAndCertificate API did not respond within {}s'.format(self.create_keys_timeout))
+        end_step("create_keys_and_certificate")
 
-        except Exception as e:
-            print("Failed to publish RegisterThing request.")
-            exit(e)
+        registerThingRequest = iotidentity.RegisterThingRequest(
+            template_name=template_name,
+            certificate_ownership_token=createKeysAndCertificateResponse.certificate_ownership_token,
+            parameters=template_parameters)
+
+        register_thing_future = self.register_thing_future = Future()
+        print("Publishing to RegisterThing topic...")
+        registerthing_publish_future = self.identity_client.publish_register_thing(registerThingRequest, mqtt.QoS.AT_LEAST_ONCE)
+        registerthing_publish_future.add_done_callback(
+            lambda future: self.on_publish(future, "RegisterThing", register_thing_future))
 
-    def on_publish_create_keys_and_certificate(future):
-        # type: (Future) -> None
+        try:
+            registerThingResponse = register_thing_future.result(self.register_thing_timeout)
+        except FutureTimeoutError:
+            raise Exception('RegisterThing API did not respond within {}s'.format(self.register_thing_timeout))
+        end_step("register_thing")
+
+        return {
+            "createKeysAndCertificateResponse": createKeysAndCertificateResponse,
+            "registerThingResponse": registerThingResponse,
+            "latencyMs": step_latency
+        }
+
+    def on_publish(self, future, request_name, response_future):
+        # type: (Future, str, Future) -> None
         try:
             future.result() # raises exception if publish failed
-            print("Published CreateKeysAndCertificate request..")
+            print("Published {} request..".format(request_name))
 
         except Exception as e:
-            print("Failed to publish CreateKeysAndCertificate request.")
-            exit(e)
+            print("Failed to publish {} request.".format(request_name))
+            if not response_future.done():
+                response_future.set_exception(e)
 
-    def createkeysandcertificate_execution_accepted(response):
+    def createkeysandcertificate_execution_accepted(self, response):
         # type: (iotidentity.CreateKeysAndCertificateResponse) -> None
-        try:
-            global createKeysAndCertificateResponse
-            createKeysAndCertificateResponse = response
-            print("Received a new message {}".format(createKeysAndCertificateResponse))
-            
-            if performCertificateRotation==True:
-                device_name = templateParameters['ThingName']
-            else:
-                device_name = templateParameters['SerialNumber']
-
-            # Set device as new device in parameters file
-            with open('devices/{}/parameters.json'.format(device_name), 'r+') as f:
-                data = json.load(f)
-                data['new_device'] = True
-                f.seek(0)  # rewind
-                json.dump(data, f)
-                f.truncate()
-
-            # Write certificates in certificates folder
-            with open("devices/{}/certificates/{}_certificate.pem.crt".format(device_name, device_name), "w") as text_file:
-                text_file.write(createKeysAndCertificateResponse.certificate_pem)
-
-            with open("devices/{}/certificates/{}_private.pem.key".format(device_name, device_name), "w") as text_file:
-                text_file.write(createKeysAndCertificateResponse.private_key)
-            
-            # Getting value of Certificate ID that will be used during rotation
-            global certificateID
-            certificateID = createKeysAndCertificateResponse.certificate_id
-
-            return
+        print("Received a new message {}".format(response))
+        future = self.create_keys_future
+        if future is not None and not future.done():
+            future.set_result(response)
 
-        except Exception as e:
-            exit(e)
-
-    def createkeysandcertificate_execution_rejected(rejected):
+    def createkeysandcertificate_execution_rejected(self, rejected):
         # type: (iotidentity.RejectedError) -> None
-        exit("CreateKeysAndCertificate Request rejected with code:'{}' message:'{}' statuscode:'{}'".format(
-            rejected.error_code, rejected.error_message, rejected.status_code))
+        future = self.create_keys_future
+        if future is not None and not future.done():
+            future.set_exception(Exception("CreateKeysAndCertificate Request rejected with code:'{}' message:'{}' statuscode:'{}'".format(
+                rejected.error_code, rejected.error_message, rejected.status_code)))
 
-    def registerthing_execution_accepted(response):
+    def registerthing_execution_accepted(self, response):
         # type: (iotidentity.RegisterThingResponse) -> None
-        try:
-            global registerThingResponse
-            registerThingResponse = response
-            print("Received a new message {} ".format(registerThingResponse))
-            return
+        print("Received a new message {} ".format(response))
+        future = self.register_thing_future
+        if future is not None and not future.done():
+            future.set_result(response)
 
-        except Exception as e:
-            exit(e)
-
-    def registerthing_execution_rejected(rejected):
+    def registerthing_execution_rejected(self, rejected):
         # type: (iotidentity.RejectedError) -> None
-        exit("RegisterThing Request rejected with code:'{}' message:'{}' statuscode:'{}'".format(
-            rejected.error_code, rejected.error_message, rejected.status_code))
+        future = self.register_thing_future
+        if future is not None and not future.done():
+            future.set_exception(Exception("RegisterThing Request rejected with code:'{}' message:'{}' statuscode:'{}'".format(
+                rejected.error_code, rejected.error_message, rejected.status_code)))
 
     # Callback when connection is accidentally lost.
-    def on_connection_interrupted(connection, error, **kwargs):
+    def on_connection_interrupted(self, connection, error, **kwargs):
         print("Connection interrupted. error: {}".format(error))
 
-
     # Callback when an interrupted connection is re-established.
-    def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
         print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
 
         if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
@@ -178,9 +263,9 @@ def provision_device(device_name, endpoint, root_ca, templateName, performCertif
 
             # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
             # evaluate result with a callback instead.
-            resubscribe_future.add_done_callback(on_resubscribe_complete)
+            resubscribe_future.add_done_callback(self.on_resubscribe_complete)
 
-    def on_resubscribe_complete(resubscribe_future):
+    def on_resubscribe_complete(self, resubscribe_future):
         resubscribe_results = resubscribe_future.result()
         print("Resubscribe results: {}".format(resubscribe_results))
 
@@ -188,123 +273,84 @@ def provision_device(device_name, endpoint, root_ca, templateName, performCertif
             if qos is None:
                 sys.exit("Server rejected resubscribe to topic: {}".format(topic))
 
-    def waitForCreateKeysAndCertificateResponse():
-        # Wait for the response.
-        loopCount = 0
-        while loopCount < 12 and createKeysAndCertificateResponse is None:
-            if createKeysAndCertificateResponse is not None:
-                break
-            print('Waiting... CreateKeysAndCertificateResponse: ' + json.dumps(createKeysAndCertificateResponse))
-            loopCount += 1
-            time.sleep(1)
-
-    def waitForRegisterThingResponse():
-        # Wait for the response.
-        loopCount = 0
-        while loopCount < 20 and registerThingResponse is None:
-            if registerThingResponse is not None:
-                break
-            loopCount += 1
-            print('Waiting... RegisterThingResponse: ' + json.dumps(registerThingResponse))
-            time.sleep(1)
-
-    # Spin up resources
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=endpoint,
-        cert_filepath=cert,
-        pri_key_filepath=key,
-        client_bootstrap=client_bootstrap,
-        ca_filepath=root_ca,
-        client_id=client_id,
-        on_connection_interrupted=on_connection_interrupted,
-        on_connection_resumed=on_connection_resumed,
-        clean_session=False,
-        keep_alive_secs=30
-    )
-    print("Connecting to {} with client ID '{}'...".format(
-        endpoint, client_id))
-
-    connected_future = mqtt_connection.connect()
-
-    identity_client = iotidentity.IotIdentityClient(mqtt_connection)
-
-    connected_future.result()
-    print("Connected!")
-
-    try:
-        createkeysandcertificate_subscription_request = iotidentity.CreateKeysAndCertificateSubscriptionRequest()
-
-        print("Subscribing to CreateKeysAndCertificate Accepted topic...")
-        createkeysandcertificate_subscribed_accepted_future, _ = identity_client.subscribe_to_create_keys_and_certificate_accepted(
-            request=createkeysandcertificate_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=createkeysandcertificate_execution_accepted)
-
-        # Wait for subscription to succeed
-        createkeysandcertificate_subscribed_accepted_future.result()
-
-        print("Subscribing to CreateKeysAndCertificate Rejected topic...")
-        createkeysandcertificate_subscribed_rejected_future, _ = identity_client.subscribe_to_create_keys_and_certificate_rejected(
-            request=createkeysandcertificate_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=createkeysandcertificate_execution_rejected)
 
-        # Wait for subscription to succeed
-        createkeysandcertificate_subscribed_rejected_future.result()
+# Write the new certificate and key, and mark the device as new so it reports its parameters
+def write_device_certificates(device_name, createKeysAndCertificateResponse):
+    # Set device as new device in parameters file
+    with open('devices/{}/parameters.json'.format(device_name), 'r+') as f:
+        data = json.load(f)
+        data['new_device'] = True
+        f.seek(0)  # rewind
+        json.dump(data, f)
+        f.truncate()
 
-        registerthing_subscription_request = iotidentity.RegisterThingSubscriptionRequest(template_name=templateName)
+    # Write certificates in certificates folder
+    with open("devices/{}/certificates/{}_certificate.pem.crt".format(device_name, device_name), "w") as text_file:
+        text_file.write(createKeysAndCertificateResponse.certificate_pem)
 
-        print("Subscribing to RegisterThing Accepted topic...")
-        registerthing_subscribed_accepted_future, _ = identity_client.subscribe_to_register_thing_accepted(
-            request=registerthing_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=registerthing_execution_accepted)
+    with open("devices/{}/certificates/{}_private.pem.key".format(device_name, device_name), "w") as text_file:
+        text_file.write(createKeysAndCertificateResponse.private_key)
 
-        # Wait for subscription to succeed
-        registerthing_subscribed_accepted_future.result()
 
-        print("Subscribing to RegisterThing Rejected topic...")
-        registerthing_subscribed_rejected_future, _ = identity_client.subscribe_to_register_thing_rejected(
-            request=registerthing_subscription_request,
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=registerthing_execution_rejected)
-        # Wait for subscription to succeed
-        registerthing_subscribed_rejected_future.result()
-
-        print("Publishing to CreateKeysAndCertificate...")
-        publish_future = identity_client.publish_create_keys_and_certificate(
-            request=iotidentity.CreateKeysAndCertificateRequest(), qos=mqtt.QoS.AT_LEAST_ONCE)
-        publish_future.add_done_callback(on_publish_create_keys_and_certificate)
-
-        waitForCreateKeysAndCertificateResponse()
+def provision_device(device_name, endpoint, root_ca, templateName, performCertificateRotation=False,
+                version=None, sensor_type=None, plant_id=None, firmwareVersion= '13.3.4',
+                client_id="test-"+str(uuid4()), verbosity=io.LogLevel.NoLogs.name,
+                create_keys_timeout=12, register_thing_timeout=20, provisioning_client=None):
 
-        if createKeysAndCertificateResponse is None:
-            raise Exception('CreateKeysAndCertificate API did not succeed')
-        
-        registerThingRequest = iotidentity.RegisterThingRequest(
-            template_name=templateName,
-            certificate_ownership_token=createKeysAndCertificateResponse.certificate_ownership_token,
-            parameters=templateParameters)
-        
-        print("Publishing to RegisterThing topic...")
-        registerthing_publish_future = identity_client.publish_register_thing(registerThingRequest, mqtt.QoS.AT_LEAST_ONCE)
-        registerthing_publish_future.add_done_callback(on_publish_register_thing)
+    today = date.today()
 
-        waitForRegisterThingResponse()
-        exit("success")
+    if performCertificateRotation==True:
+        print('Attempting to rotate certificates')
+        templateParameters = {
+            "ThingName": device_name,
+            "CertificateCreatedOn": str(today)
+        }
+    else:
+        print("Provisioning device")
+        templateParameters = {
+            "SerialNumber": device_name,
+            "CertificateCreatedOn": str(today),
+            "SensorType": sensor_type,
+            "PlantId": plant_id,
+            "FirmwareVersion": firmwareVersion
+        }
 
-    except Exception as e:
-        exit(e)
+    # Without a client, open a one-off session with the claim certificate
+    owns_client = provisioning_client is None
+    if owns_client:
+        io.init_logging(getattr(io.LogLevel, verbosity), 'stderr')
+        provisioning_client = ProvisioningClient(
+            endpoint=endpoint,
+            cert="devices/{}/provisioning_files/claim.certificate.pem".format(device_name),
+            key="devices/{}/provisioning_files/claim.private.key".format(device_name),
+            root_ca=root_ca,
+            client_id=client_id,
+            create_keys_timeout=create_keys_timeout,
+            register_thing_timeout=register_thing_timeout)
 
-    is_sample_done.wait()
-    
     response = {
         "status" : "Done",
-        "certificateID" : certificateID
+        "certificateID" : None,
+        "latencyMs" : {}
     }
-    # return 'Done'
-    return response
\ No newline at end of file
+    try:
+        result = provisioning_client.provision(templateName, templateParameters)
+        write_device_certificates(device_name, result['createKeysAndCertificateResponse'])
+        # Getting value of Certificate ID that will be used during rotation
+        response['certificateID'] = result['createKeysAndCertificateResponse'].certificate_id
+        response['latencyMs'] = result['latencyMs']
+        print("Exiting Provisioning: success")
+
+    except Exception as e:
+        print("Exiting Provisioning due to exception.")
+        traceback.print_exception(e.__class__, e, sys.exc_info()[2])
+        response['status'] = "Failed"
+
+    finally:
+        if owns_client:
+            try:
+                provisioning_client.close()
+            except Exception as e:
+                print("Failed to disconnect: {}".format(e))
+
+    return response
@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+asyncio based runtime for the sprinkler device.
+
+Selected with "runtime": "asyncio" in parameters.json. Sensor sampling, spool
+draining, job handling and shadow callbacks all run as cooperative tasks on one
+event loop instead of a thread per job and blocking sleeps:
+
+- await_crt() turns the concurrent.futures.Future objects returned by awscrt
+  into awaitables, with an optional timeout.
+- dispatch() wraps a CRT callback so it runs on the event loop instead of the
+  CRT event-loop thread.
+- LoopLagMonitor measures how late the loop wakes up, the one place to look
+  when a task is hogging it.
+- run() starts the tasks and cancels them all on SIGINT/SIGTERM or when one fails.
+'''
+
+
+import asyncio
+import functools
+import signal
+import time
+
+
+async def await_crt(future, timeout=None):
+    return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=1.0, report_every=60):
+        self.interval = interval
+        self.report_every = report_every
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    async def run(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_lag = max(0.0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if now - last_report >= self.report_every:
+                print("Event loop lag: last {:.1f} ms, max {:.1f} ms".format(self.last_lag * 1000, self.max_lag * 1000))
+                self.max_lag = 0.0
+                last_report = now
+
+
+class AsyncRuntime:
+    def __init__(self):
+        # Created up front so CRT callbacks can be queued before the loop starts running
+        self.loop = asyncio.new_event_loop()
+        self.lag_monitor = LoopLagMonitor()
+
+    def dispatch(self, callback):
+        def on_crt_thread(*args, **kwargs):
+            self.loop.call_soon_threadsafe(functools.partial(callback, *args, **kwargs))
+        return on_crt_thread
+
+    def run(self, *coroutines):
+        self.loop.run_until_complete(self._run(coroutines))
+
+    async def _run(self, coroutines):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        tasks.append(asyncio.ensure_future(self.lag_monitor.run()))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self._cancel, tasks)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are not available on every platform
+                pass
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            print("Async runtime cancelled")
+        finally:
+            self._cancel(tasks)
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _cancel(self, tasks):
+        for task in tasks:
+            task.cancel()
+
+
+async def drain_spool(spool, publish_fn, connected_event, drain_rate=5, ack_timeout=10):
+    # Async counterpart of SpoolDrainer, publish_fn(topic, payload) returns a CRT future
+    drain_interval = 1.0 / drain_rate if drain_rate > 0 else 0
+    while True:
+        if not connected_event.is_set():
+            await asyncio.sleep(0.5)
+            continue
+        record = spool.peek()
+        if record is None:
+            await asyncio.sleep(0.5)
+            continue
+        topic, payload = record
+        try:
+            await await_crt(publish_fn(topic, payload), ack_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Spool publish failed, will retry: {}".format(e))
+            await asyncio.sleep(1)
+            continue
+        spool.commit()
+        if drain_interval:
+            await asyncio.sleep(drain_interval)
@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Switch of the device connection to a rotated certificate.
+
+IoT Core allows one connection per client ID, and the device policy only lets
+a device connect with its thing name as client ID, so the connection with the
+new certificate cannot be tried next to the old one. As soon as it connects,
+IoT Core drops the old connection:
+- the old connection is closed right away, so its automatic reconnect does not
+  take the session back while the new one subscribes
+- if the new certificate is refused before that, the old connection never lost
+  its session and stays in use
+- if it fails after that, the old connection is gone and a fresh connection
+  with the previous certificate is connected and subscribed instead
+
+The connection specific steps are callables, so the same switch runs with the
+MQTT 3 and MQTT 5 connections of the device.
+'''
+
+
+def switch_connection(old_connection, build, connect, subscribe, close, restore_previous):
+    '''
+    build() returns an unconnected connection with the certificate files on disk,
+    connect(connection) and subscribe(connection) raise when they fail,
+    close(connection) disconnects a connection for good and restore_previous()
+    writes the previous certificate files back.
+
+    Returns (connection, swapped), the connection to use from now on and whether
+    it has the new certificate. Raises if the previous certificate cannot
+    reconnect either.
+    '''
+    new_connection = build()
+    took_over = False
+    try:
+        connect(new_connection)
+        took_over = True
+        close(old_connection)
+        subscribe(new_connection)
+        return new_connection, True
+    except Exception as e:
+        print("New certificate did not connect, keeping the current one: {}".format(e))
+        restore_previous()
+        close(new_connection)
+        if not took_over:
+            return old_connection, False
+
+    print("Reconnecting with the previous certificate...")
+    previous_connection = build()
+    try:
+        connect(previous_connection)
+        subscribe(previous_connection)
+    except Exception:
+        close(previous_connection)
+        raise
+    return previous_connection, False
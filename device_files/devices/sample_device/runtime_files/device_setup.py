@@ -0,0 +1,98 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Startup shared by the sprinkler (iot_sprinkler.py) and the gateway (iot_gateway.py).
+
+Both run from the device folder or from the folder above devices/, and both
+connect the same way:
+- find_parameters() and find_certificates() look for the device files in both places
+- connection_settings() reads the keep alive and reconnect settings, with a
+  reconnect window randomized per device (see runtime_files/reconnect.py)
+- open_spool() opens the store-and-forward spool next to parameters.json
+- build_client_bootstrap() and build_mqtt3_connection() build the MQTT 3.1.1
+  connection, connect_with_backoff() connects it, retrying with jittered
+  exponential backoff until the broker accepts it
+'''
+
+
+from awscrt import io
+from awsiot import mqtt_connection_builder
+from os.path import dirname, exists, join
+import time
+
+from runtime_files.reconnect import Backoff, reconnect_timeouts
+from telemetry_files.spool import TelemetrySpool
+
+
+def find_parameters(device_name):
+    # Path of parameters.json, None if there is none
+    for parameter_path in ['parameters.json', 'devices/{}/parameters.json'.format(device_name)]:
+        if exists(parameter_path):
+            return parameter_path
+    return None
+
+
+def find_certificates(device_name):
+    # (certificate, private key, root CA) paths, None if the device is not provisioned yet
+    for folder in ['certificates', 'devices/{}/certificates'.format(device_name)]:
+        if exists("{}/{}_certificate.pem.crt".format(folder, device_name)):
+            return ("{}/{}_certificate.pem.crt".format(folder, device_name),
+                    "{}/{}_private.pem.key".format(folder, device_name),
+                    "{}/AmazonRootCA1.pem".format(folder))
+    return None
+
+
+def connection_settings(parameters):
+    # (keep_alive_secs, reconnect_min_timeout_secs, reconnect_max_timeout_secs, connect_retry_max_seconds)
+    reconnect_min, reconnect_max = reconnect_timeouts(
+        parameters.get('reconnect_min_seconds', 1), parameters.get('reconnect_max_seconds', 128))
+    return (parameters.get('keep_alive_secs', 6), reconnect_min, reconnect_max,
+            parameters.get('connect_retry_max_seconds', 120))
+
+
+def open_spool(parameters, parameter_path):
+    # "drop_oldest" keeps the latest readings when the spool is full, "drop_newest" keeps the backlog
+    return TelemetrySpool(join(dirname(parameter_path), 'spool'),
+                          parameters.get('spool_max_bytes', 1048576),
+                          parameters.get('spool_segment_bytes', 65536),
+                          parameters.get('spool_drop_policy', 'drop_oldest'))
+
+
+def build_client_bootstrap():
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    return io.ClientBootstrap(event_loop_group, host_resolver)
+
+
+def build_mqtt3_connection(endpoint, cert_path, key_path, root_ca, client_id, client_bootstrap,
+                           on_connection_interrupted, on_connection_resumed,
+                           clean_session=True, keep_alive_secs=6, reconnect_min_secs=1, reconnect_max_secs=128):
+    return mqtt_connection_builder.mtls_from_path(
+                endpoint=endpoint,
+                cert_filepath=cert_path,
+                pri_key_filepath=key_path,
+                client_bootstrap=client_bootstrap,
+                ca_filepath=root_ca,
+                client_id=client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed,
+                clean_session=clean_session,
+                keep_alive_secs=keep_alive_secs,
+                reconnect_min_timeout_secs=reconnect_min_secs,
+                reconnect_max_timeout_secs=reconnect_max_secs
+                )
+
+
+def connect_with_backoff(connection, min_seconds, max_seconds):
+    # Blocks until the connection is accepted
+    connect_backoff = Backoff(min_seconds, max_seconds)
+    while True:
+        try:
+            connection.connect().result()
+            return
+        except Exception as e:
+            delay = connect_backoff.next_delay()
+            print("Connect failed: {}. Retrying in {:.1f}s".format(e, delay))
+            time.sleep(delay)
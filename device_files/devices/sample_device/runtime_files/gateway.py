@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Zones and topic routing for the gateway runtime (iot_gateway.py).
+
+A gateway owns one connection and drives many zones. Each zone is a child thing
+named <gateway>_<zone>, with its own shadow, jobs and telemetry topics, so the
+cloud side (rules, IoT Events detector, actuation Lambdas) treats it exactly like
+a stand-alone sprinkler. Inbound shadow and jobs messages arrive on wildcard
+subscriptions and are routed to the zone by the thing name in the topic.
+
+Each zone's probe is one row of the gateway's CalibrationTable, so the readings
+of all zones are converted to percentages with one percentages() call.
+'''
+
+
+from telemetry_files.calibration import probe_curve
+
+
+class Zone:
+    def __init__(self, gateway_name, zone_name, abs_hydrated_state_value, abs_dry_state_value, sprinkler_trigger_percentage,
+                 calibration_table, probe, calibration=None):
+        self.name = zone_name
+        self.thing_name = "{}_{}".format(gateway_name, zone_name)
+        self.abs_hydrated_state_value = abs_hydrated_state_value
+        self.abs_dry_state_value = abs_dry_state_value
+        self.sprinkler_trigger_percentage = sprinkler_trigger_percentage
+        self.sprinkler_state = "off"
+        self.calibration_table = calibration_table
+        self.probe = probe
+        self.calibration = calibration
+        self.calibration_table.set_curve(probe, self.curve())
+
+    def curve(self):
+        return probe_curve(self.calibration, self.abs_hydrated_state_value, self.abs_dry_state_value)
+
+    def moisture_percentage(self, reading):
+        return self.calibration_table.percentage(reading, self.probe)
+
+    def reported_state(self, moisture_percentage):
+        return "dry" if moisture_percentage <= self.sprinkler_trigger_percentage else "hydrated"
+
+    def apply_parameters(self, values):
+        # Calibration from the zone's shadow or from an UPDATE_ZONE_PARAMETERS job.
+        # Raises ValueError and leaves the zone and its table as they were if any value is invalid
+        updated = dict(self.parameters())
+        updated.update((name, values[name]) for name in updated if name in values)
+        for name in ("abs_hydrated_state_value", "abs_dry_state_value", "sprinkler_trigger_percentage"):
+            if isinstance(updated[name], bool) or not isinstance(updated[name], (int, float)):
+                raise ValueError("Zone {} {} must be a number, got {!r}".format(self.name, name, updated[name]))
+        try:
+            self.calibration_table.set_curve(self.probe, probe_curve(
+                updated['calibration'], updated['abs_hydrated_state_value'], updated['abs_dry_state_value']))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("Zone {} calibration is invalid: {}".format(self.name, e))
+        self.abs_hydrated_state_value = updated['abs_hydrated_state_value']
+        self.abs_dry_state_value = updated['abs_dry_state_value']
+        self.sprinkler_trigger_percentage = updated['sprinkler_trigger_percentage']
+        self.calibration = updated['calibration']
+
+    def parameters(self):
+        return {
+            "abs_hydrated_state_value": self.abs_hydrated_state_value,
+            "abs_dry_state_value": self.abs_dry_state_value,
+            "sprinkler_trigger_percentage": self.sprinkler_trigger_percentage,
+            "calibration": self.calibration
+        }
+
+
+class ZoneRouter:
+    def __init__(self, zones):
+        self.zones = {zone.thing_name: zone for zone in zones}
+
+    def __iter__(self):
+        return iter(self.zones.values())
+
+    def __len__(self):
+        return len(self.zones)
+
+    def zone_for_topic(self, topic):
+        # $aws/things/<thing>/... topics, None for things that are not zones of this gateway
+        parts = topic.split('/')
+        if len(parts) < 3 or parts[0] != '$aws' or parts[1] != 'things':
+            return None
+        return self.zones.get(parts[2])
+
+
+def multi_child_batch(gateway_name, pending_readings):
+    # One message for all zones, expanded per zone by the unbatch_sensordata Lambda
+    return {
+        "sensorType": "SoilMoistureSensor",
+        "deviceID": gateway_name,
+        "devices": [
+            {"deviceID": thing_name, "readings": readings}
+            for thing_name, readings in pending_readings.items() if readings
+        ]
+    }
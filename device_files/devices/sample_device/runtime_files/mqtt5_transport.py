@@ -0,0 +1,78 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+MQTT5 transport for the sprinkler device.
+
+Selected with "mqtt_version": 5 in parameters.json. The device code keeps using
+the MQTT 3.1.1 style connection API (publish, subscribe, the Jobs and Identity
+clients) through the connection adapter of an MQTT5 client, and gets:
+- outbound topic aliases (LRU cache) for every publish, so repeated topics such
+  as <device>/sensordata/soil_moisture are sent once per connection
+- receive maximum flow control, the broker keeps at most receive_maximum QoS 1
+  messages in flight towards the device
+- full jitter on the client's own reconnect backoff
+- message expiry for telemetry, see publish_with_expiry()
+'''
+
+
+from awscrt import mqtt5
+from awsiot import mqtt5_client_builder
+from concurrent.futures import Future
+
+# Reason codes that still mean the broker took the message
+PUBACK_ACCEPTED = (mqtt5.PubackReasonCode.SUCCESS, mqtt5.PubackReasonCode.NO_MATCHING_SUBSCRIBERS)
+
+
+def build_mqtt5_connection(endpoint, cert_path, key_path, root_ca, client_id, client_bootstrap,
+                           on_connection_interrupted, on_connection_resumed,
+                           persistent_session=False, keep_alive_secs=6, receive_maximum=10,
+                           topic_alias_cache_size=8, reconnect_min_secs=1, reconnect_max_secs=128):
+    # Returns the MQTT5 client and an MQTT 3.1.1 style connection running on it
+    client = mqtt5_client_builder.mtls_from_path(
+        endpoint=endpoint,
+        cert_filepath=cert_path,
+        pri_key_filepath=key_path,
+        ca_filepath=root_ca,
+        client_id=client_id,
+        client_bootstrap=client_bootstrap,
+        session_behavior=mqtt5.ClientSessionBehaviorType.REJOIN_POST_SUCCESS if persistent_session else mqtt5.ClientSessionBehaviorType.CLEAN,
+        connect_options=mqtt5.ConnectPacket(
+            keep_alive_interval_sec=keep_alive_secs,
+            receive_maximum=receive_maximum,
+            # IoT Core keeps a persistent session for up to an hour
+            session_expiry_interval_sec=3600 if persistent_session else None),
+        topic_aliasing_options=mqtt5.TopicAliasingOptions(
+            outbound_behavior=mqtt5.OutboundTopicAliasBehaviorType.LRU,
+            outbound_cache_max_size=topic_alias_cache_size),
+        retry_jitter_mode=mqtt5.ExponentialBackoffJitterMode.FULL,
+        min_reconnect_delay_ms=reconnect_min_secs * 1000,
+        max_reconnect_delay_ms=reconnect_max_secs * 1000)
+    connection = client.new_connection(
+        on_connection_interrupted=on_connection_interrupted,
+        on_connection_resumed=on_connection_resumed)
+    return client, connection
+
+
+def publish_with_expiry(client, topic, payload, expiry_seconds=None):
+    # QoS 1 publish that the broker drops if it cannot deliver it within expiry_seconds.
+    # Returns a future that completes on an accepting PUBACK, like the MQTT 3.1.1 publish future.
+    acked = Future()
+
+    def on_publish_complete(publish_future):
+        try:
+            puback = publish_future.result().puback
+            if puback is not None and puback.reason_code not in PUBACK_ACCEPTED:
+                raise Exception("Publish to '{}' was rejected with reason code {}".format(topic, puback.reason_code))
+            acked.set_result(puback)
+        except Exception as e:
+            acked.set_exception(e)
+
+    packet = mqtt5.PublishPacket(
+        topic=topic,
+        payload=payload,
+        qos=mqtt5.QoS.AT_LEAST_ONCE,
+        message_expiry_interval_sec=expiry_seconds or None)
+    client.publish(packet).add_done_callback(on_publish_complete)
+    return acked
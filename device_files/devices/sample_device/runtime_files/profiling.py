@@ -0,0 +1,164 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+On-demand profiling of a running device, used by the PROFILE_DEVICE job task.
+
+Modes, for a bounded window:
+- "sampling" takes the stack of every Python thread at a fixed interval and
+  counts them in collapsed form ("thread;outer;...;inner count"), ready for
+  flamegraph.pl or speedscope. It sees all threads at a cost of one stack walk
+  per interval.
+- "cprofile" runs cProfile on the sensor loop thread, which calls
+  on_main_loop() on every iteration. cProfile only sees the thread it is
+  enabled on, so work on other threads is not included.
+Either mode can add a tracemalloc snapshot diff between the start and the end
+of the window, to find where memory grows.
+
+The results go into a gzip compressed tar archive:
+    summary.json      mode, window, samples, CPU time and peak RSS
+    stacks.folded     sampling mode
+    profile.txt       cProfile mode, sorted by cumulative time
+    profile.pstats    cProfile mode, raw stats for snakeviz or pstats
+    memory.txt        with tracemalloc, top allocation growth by line
+'''
+
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_MODES = ("sampling", "cprofile")
+MAX_STACK_DEPTH = 64
+
+
+class CProfileRequest:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.enabled = False
+        self.stop = threading.Event()
+        self.done = threading.Event()
+
+
+class DeviceProfiler:
+    def __init__(self):
+        self.cprofile_request = None
+
+    def on_main_loop(self):
+        # Called from the sensor loop thread, starts and stops cProfile on that thread
+        request = self.cprofile_request
+        if request is None:
+            return
+        if request.stop.is_set():
+            if request.enabled:
+                request.profile.disable()
+            self.cprofile_request = None
+            request.done.set()
+        elif not request.enabled:
+            request.profile.enable()
+            request.enabled = True
+
+    def _sample_stacks(self, deadline, interval):
+        own_thread = threading.get_ident()
+        names = {}
+        stacks = {}
+        samples = 0
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(interval)
+        folded = ''.join("{} {}\n".format(key, count) for key, count in sorted(stacks.items()))
+        return folded, samples
+
+    def _run_cprofile(self, deadline, timeout):
+        request = CProfileRequest()
+        self.cprofile_request = request
+        time.sleep(max(0, deadline - time.monotonic()))
+        request.stop.set()
+        if not request.done.wait(timeout) or not request.enabled:
+            self.cprofile_request = None
+            raise RuntimeError("Sensor loop did not pick up the profiler, is the device running?")
+        text = io.StringIO()
+        stats = pstats.Stats(request.profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(50)
+        return text.getvalue(), request.profile
+
+    def run(self, archive_path, mode="sampling", duration_seconds=60, sample_interval_ms=10,
+            trace_memory=False, loop_timeout=30):
+        # Profiles for duration_seconds and writes the tar.gz archive, returns the summary.
+        # In cprofile mode, loop_timeout must cover one iteration of the sensor loop
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode '{}', expected one of {}".format(mode, PROFILE_MODES))
+        started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(10)
+        memory_before = tracemalloc.take_snapshot() if trace_memory else None
+        cpu_before = os.times()
+        started = time.monotonic()
+        deadline = started + duration_seconds
+
+        files = {}
+        summary = {"mode": mode, "durationSeconds": duration_seconds, "startedAt": int(time.time())}
+        try:
+            if mode == "sampling":
+                files['stacks.folded'], summary['samples'] = self._sample_stacks(deadline, sample_interval_ms / 1000)
+            else:
+                files['profile.txt'], profile = self._run_cprofile(deadline, loop_timeout)
+                with tempfile.NamedTemporaryFile(suffix='.pstats', delete=False) as f:
+                    stats_path = f.name
+                profile.dump_stats(stats_path)
+                with open(stats_path, 'rb') as f:
+                    files['profile.pstats'] = f.read()
+                os.remove(stats_path)
+            if trace_memory:
+                growth = tracemalloc.take_snapshot().compare_to(memory_before, 'lineno')
+                current, peak = tracemalloc.get_traced_memory()
+                files['memory.txt'] = "traced current={} peak={}\n".format(current, peak) + \
+                    ''.join("{}\n".format(stat) for stat in growth[:50])
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+        cpu_after = os.times()
+        summary['wallSeconds'] = round(time.monotonic() - started, 3)
+        summary['cpuSeconds'] = round((cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system), 3)
+        summary['threads'] = threading.active_count()
+        if resource is not None:
+            summary['maxRssKb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        files['summary.json'] = json.dumps(summary, indent=4)
+
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            for name, content in files.items():
+                data = content.encode('utf-8') if isinstance(content, str) else content
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                archive.addfile(info, io.BytesIO(data))
+        summary['archiveBytes'] = os.path.getsize(archive_path)
+        return summary
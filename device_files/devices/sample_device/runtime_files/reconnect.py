@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Reconnect helpers for the device connection.
+
+- Backoff gives "full jitter" exponential delays, a random delay between 0 and
+  min(cap, base * 2^attempt), for the initial connect retries.
+- reconnect_timeouts() picks the CRT's automatic reconnect window for this
+  device. The CRT doubles its delay from the minimum up to the maximum, and a
+  random minimum per device keeps a fleet from reconnecting in lockstep after a
+  broker hiccup.
+- ConnectionStats counts interruptions and reconnects and the time spent
+  disconnected.
+'''
+
+
+import random
+import threading
+import time
+
+
+class Backoff:
+    def __init__(self, base=1, cap=120):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt)) # nosec
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+def reconnect_timeouts(min_seconds, max_seconds):
+    # Returns (reconnect_min_timeout_secs, reconnect_max_timeout_secs) for mqtt_connection_builder
+    # The CRT takes whole seconds, and parameters.json may hold values like 1.5
+    min_seconds = max(1, int(min_seconds))
+    max_seconds = int(max_seconds)
+    jittered_min = random.randint(min_seconds, max(min_seconds, min(2 * min_seconds, max_seconds))) # nosec
+    return jittered_min, max(jittered_min, max_seconds)
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.interruptions = 0
+        self.reconnects = 0
+        self.disconnected_seconds = 0.0
+        self.disconnected_since = None
+
+    def on_interrupted(self):
+        with self.lock:
+            self.interruptions += 1
+            if self.disconnected_since is None:
+                self.disconnected_since = time.monotonic()
+
+    def on_resumed(self):
+        # Returns how long this outage lasted
+        with self.lock:
+            self.reconnects += 1
+            outage = 0.0
+            if self.disconnected_since is not None:
+                outage = time.monotonic() - self.disconnected_since
+                self.disconnected_seconds += outage
+                self.disconnected_since = None
+            return outage
+
+    def total_disconnected_seconds(self):
+        # Includes the outage in progress, if any
+        with self.lock:
+            total = self.disconnected_seconds
+            if self.disconnected_since is not None:
+                total += time.monotonic() - self.disconnected_since
+            return total
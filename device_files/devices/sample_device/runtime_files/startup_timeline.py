@@ -0,0 +1,36 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Startup timeline for the sprinkler device.
+
+Records the time from process start to each startup milestone (connected,
+subscribed, shadow received, ready), so time-to-ready after a power cycle can be
+measured on the device and, when published, across the fleet.
+'''
+
+
+import time
+
+
+class StartupTimeline:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.monotonic() - self.start))
+
+    def to_dict(self):
+        # Milliseconds since process start for each milestone, in order
+        return {name: round(elapsed * 1000, 1) for name, elapsed in self.marks}
+
+    def print_timeline(self):
+        print("\n##======================================##")
+        print("Startup timeline (ms since start):")
+        previous = 0.0
+        for name, elapsed in self.marks:
+            print("  {:<20} {:>9.1f}  (+{:.1f})".format(name, elapsed * 1000, (elapsed - previous) * 1000))
+            previous = elapsed
+        print("##======================================##\n")
@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Adaptive reporting interval driven by the soil moisture rate of change.
+
+The slope of the recent readings (percentage points per second) is estimated
+with a least squares fit over a short window, and the next interval is:
+- min_interval while the sprinkler is watering
+- time left until sprinkler_trigger_percentage divided by gain while the soil is
+  drying toward the trigger, so about "gain" readings land before it is crossed.
+  The time left comes from the time-to-dry forecast when one is given, and from
+  the slope of the window otherwise
+- the time it takes the value to move 1/gain points otherwise, which grows to
+  max_interval when the value is stable
+
+min_interval, max_interval and gain can be changed from the device shadow.
+'''
+
+
+from collections import deque
+import time
+
+
+class AdaptiveInterval:
+    def __init__(self, min_interval, max_interval, gain=4, window=6):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.gain = gain
+        self.history = deque(maxlen=window)
+        self.interval = max_interval
+
+    def configure(self, settings):
+        # Settings from the shadow, any subset of min_interval, max_interval and gain.
+        # Raises ValueError and keeps the current settings if the result is not usable
+        if not isinstance(settings, dict):
+            raise ValueError("Adaptive interval settings must be an object, got {!r}".format(settings))
+        merged = dict(self.settings(), **settings)
+        for name in ("min_interval", "max_interval", "gain"):
+            if isinstance(merged[name], bool) or not isinstance(merged[name], (int, float)):
+                raise ValueError("Adaptive interval {} must be a number, got {!r}".format(name, merged[name]))
+        if merged['gain'] <= 0:
+            raise ValueError("Adaptive interval gain must be greater than 0, got {}".format(merged['gain']))
+        if not 0 < merged['min_interval'] <= merged['max_interval']:
+            raise ValueError("Adaptive intervals need 0 < min_interval <= max_interval, got {} and {}".format(
+                merged['min_interval'], merged['max_interval']))
+        self.min_interval = merged['min_interval']
+        self.max_interval = merged['max_interval']
+        self.gain = merged['gain']
+
+    def settings(self):
+        return {
+            "min_interval": self.min_interval,
+            "max_interval": self.max_interval,
+            "gain": self.gain
+        }
+
+    def slope(self):
+        if len(self.history) < 2:
+            return 0.0
+        count = len(self.history)
+        mean_t = sum(t for t, _ in self.history) / count
+        mean_v = sum(v for _, v in self.history) / count
+        variance = sum((t - mean_t) ** 2 for t, _ in self.history)
+        if variance == 0:
+            return 0.0
+        return sum((t - mean_t) * (v - mean_v) for t, v in self.history) / variance
+
+    def update(self, moisture_percentage, trigger_percentage, watering, now=None, seconds_to_trigger=None):
+        # Records a reading and returns the interval to wait before the next one
+        self.history.append((time.monotonic() if now is None else now, moisture_percentage))
+        slope = self.slope()
+        if watering:
+            interval = self.min_interval
+        elif seconds_to_trigger is not None and moisture_percentage > trigger_percentage:
+            interval = seconds_to_trigger / self.gain
+        elif slope < 0 and moisture_percentage > trigger_percentage:
+            interval = (moisture_percentage - trigger_percentage) / -slope / self.gain
+        elif slope != 0:
+            interval = 1.0 / (abs(slope) * self.gain)
+        else:
+            interval = self.max_interval
+        self.interval = max(self.min_interval, min(self.max_interval, interval))
+        return self.interval
@@ -0,0 +1,70 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Collects soil moisture readings into multi-reading telemetry messages.
+
+A batch is flushed once it holds batch_max_readings readings or its oldest
+reading is batch_max_seconds old. The shared header is sent once per batch and
+each reading is a compact [timestamp_ms, moisture_percentage, state, sampleCount]
+array:
+
+{
+    "sensorType": "SoilMoistureSensor",
+    "deviceID": "AWS_9875",
+    "readings": [
+        [1700000000000, 31, "hydrated", 1],
+        [1700000002000, 27, "dry", 1]
+    ]
+}
+
+The cloud side unbatches these with the unbatch_sensordata Lambda.
+'''
+
+
+import threading
+import time
+
+
+class ReadingBatcher:
+    def __init__(self, sensor_type, device_id, max_readings=10, max_seconds=60):
+        self.sensor_type = sensor_type
+        self.device_id = device_id
+        self.max_readings = max_readings
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.readings = []
+        self.started_at = None
+
+    def add(self, state, moisture_percentage, sample_count=1, timestamp_ms=None):
+        # Returns a full batch message when one is ready to send, otherwise None
+        if timestamp_ms is None:
+            timestamp_ms = int(time.time() * 1000)
+        with self.lock:
+            if not self.readings:
+                self.started_at = time.monotonic()
+            self.readings.append([timestamp_ms, moisture_percentage, state, sample_count])
+            if len(self.readings) >= self.max_readings or self._expired():
+                return self._flush()
+        return None
+
+    def flush_if_due(self):
+        # Used to send a partially filled batch once it is older than max_seconds
+        with self.lock:
+            if self.readings and self._expired():
+                return self._flush()
+        return None
+
+    def _expired(self):
+        return time.monotonic() - self.started_at >= self.max_seconds
+
+    def _flush(self):
+        message = {
+            "sensorType": self.sensor_type,
+            "deviceID": self.device_id,
+            "readings": self.readings
+        }
+        self.readings = []
+        self.started_at = None
+        return message
@@ -0,0 +1,135 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Calibration of raw probe readings to soil moisture percentages.
+
+Capacitive probes are not linear, so each probe can have its own curve, set in
+parameters.json or in the shadow under "calibration":
+- {"type": "linear", "hydrated": 300, "dry": 600}
+      100% at the hydrated value and 0% at the dry value, the default built from
+      abs_hydrated_state_value and abs_dry_state_value
+- {"type": "piecewise", "points": [[300, 100], [420, 55], [510, 20], [600, 0]]}
+      straight lines between [raw, percentage] points, flat beyond the first and last
+- {"type": "polynomial", "coefficients": [c0, c1, c2, ...]}
+      c0 + c1 * raw + c2 * raw^2 + ...
+
+A curve is evaluated once for every raw value from 0 to adc_max into a lookup
+table of percentages, clamped to 0..100. Converting a reading is then a single
+index into the table. Tables are only rebuilt when a probe's curve changes.
+
+With several probes on one device the tables are rows of one 2-D table, and
+percentages() converts one reading of every probe at once, as a single NumPy
+gather when NumPy is installed, otherwise row by row in pure Python.
+'''
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CURVE_TYPES = ("linear", "piecewise", "polynomial")
+
+
+def probe_curve(curve, abs_hydrated_state_value, abs_dry_state_value):
+    # The configured curve, or the linear curve between the hydrated and dry values
+    if curve:
+        return curve
+    return {"type": "linear", "hydrated": abs_hydrated_state_value, "dry": abs_dry_state_value}
+
+
+def curve_points(curve):
+    # Piecewise points of linear and piecewise curves, sorted by raw value
+    if curve['type'] == "linear":
+        if curve['hydrated'] == curve['dry']:
+            raise ValueError("Linear calibration needs different hydrated and dry values")
+        return sorted([(curve['hydrated'], 100), (curve['dry'], 0)])
+    points = sorted((raw, percentage) for raw, percentage in curve['points'])
+    if len(points) < 2:
+        raise ValueError("Piecewise calibration needs at least two points")
+    return points
+
+
+def evaluate_curve(curve, adc_max):
+    # Percentage of every raw value from 0 to adc_max, as bytes
+    if curve.get('type') not in CURVE_TYPES:
+        raise ValueError("Unknown calibration curve type '{}', expected one of {}".format(curve.get('type'), CURVE_TYPES))
+    if curve['type'] == "polynomial" and not curve.get('coefficients'):
+        raise ValueError("Polynomial calibration needs coefficients")
+
+    if np is not None:
+        raw = np.arange(adc_max + 1, dtype=float)
+        if curve['type'] == "polynomial":
+            # polyval takes the highest power first
+            values = np.polyval(curve['coefficients'][::-1], raw)
+        else:
+            points = curve_points(curve)
+            values = np.interp(raw, [point[0] for point in points], [point[1] for point in points])
+        return np.clip(values, 0, 100).astype(np.uint8).tobytes()
+
+    if curve['type'] == "polynomial":
+        coefficients = curve['coefficients'][::-1]
+        values = []
+        for raw in range(adc_max + 1):
+            value = 0.0
+            for coefficient in coefficients:
+                value = value * raw + coefficient
+            values.append(value)
+    else:
+        points = curve_points(curve)
+        values = []
+        segment = 0
+        for raw in range(adc_max + 1):
+            while segment < len(points) - 2 and raw > points[segment + 1][0]:
+                segment += 1
+            (x0, y0), (x1, y1) = points[segment], points[segment + 1]
+            if raw <= x0:
+                values.append(y0)
+            elif raw >= x1:
+                values.append(y1)
+            else:
+                values.append(y0 + (raw - x0) * (y1 - y0) / (x1 - x0))
+    return bytes(int(min(100, max(0, value))) for value in values)
+
+
+class CalibrationTable:
+    def __init__(self, adc_max=4095, probe_count=1):
+        self.adc_max = adc_max
+        self.curves = [None] * probe_count
+        # One bytes row per probe for single lookups, and the same rows as a 2-D array for percentages()
+        self.rows = [bytes(adc_max + 1)] * probe_count
+        self.table = np.zeros((probe_count, adc_max + 1), dtype=np.uint8) if np is not None else None
+        self.probes = np.arange(probe_count) if np is not None else None
+
+    def set_curve(self, probe, curve):
+        # Rebuilds the probe's table if its curve changed, returns True when rebuilt
+        if curve == self.curves[probe]:
+            return False
+        row = evaluate_curve(curve, self.adc_max)
+        self.rows[probe] = row
+        if self.table is not None:
+            self.table[probe] = np.frombuffer(row, dtype=np.uint8)
+        self.curves[probe] = curve
+        return True
+
+    def configure(self, curves):
+        # One curve per probe, returns True if any table was rebuilt
+        rebuilt = False
+        for probe, curve in enumerate(curves):
+            rebuilt = self.set_curve(probe, curve) or rebuilt
+        return rebuilt
+
+    def index(self, raw):
+        return min(max(int(raw + 0.5), 0), self.adc_max)
+
+    def percentage(self, raw, probe=0):
+        return self.rows[probe][self.index(raw)]
+
+    def percentages(self, raws):
+        # One reading per probe, in probe order
+        if self.table is not None:
+            indexes = np.clip(np.floor(np.asarray(raws, dtype=float) + 0.5), 0, self.adc_max).astype(np.intp)
+            return self.table[self.probes, indexes].tolist()
+        return [row[self.index(raw)] for row, raw in zip(self.rows, raws)]
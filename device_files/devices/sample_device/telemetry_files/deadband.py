@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Change-driven (deadband) reporting for the soil moisture sensor loop.
+
+A reading is only reported when one of the following is true:
+1. The moisture percentage moved more than deadband_percentage since the last report
+2. sensorReportedState flipped between "dry" and "hydrated"
+3. max_silence_seconds passed since the last report (heartbeat)
+4. The readings since the last state flip, reported and suppressed, reach the
+   count at which the detector switches (more than debounce_threshold)
+
+Each report carries a sampleCount with the number of readings it stands for, so
+the IoT Events debounce counter advances by the same amount as if every reading
+had been sent. Suppressed readings always have the same state as the last
+report, because a state flip is reported straight away. Rule 4 makes the cloud
+detector switch on the same reading as it would with every reading sent, even
+when reports in between (rule 1) split up the run.
+'''
+
+
+import time
+
+
+class DeadbandFilter:
+    def __init__(self, deadband_percentage, max_silence_seconds=300, debounce_threshold=4):
+        self.deadband_percentage = deadband_percentage
+        self.max_silence_seconds = max_silence_seconds
+        # The detector switches once its counter is greater than debounce_threshold
+        self.switch_count = debounce_threshold + 1
+        self.last_percentage = None
+        self.last_state = None
+        self.last_report_time = None
+        self.pending_samples = 0
+        self.readings_since_flip = 0
+
+    def should_report(self, moisture_percentage, state, now=None):
+        # Returns the sampleCount to report with this reading, or None if it is suppressed
+        now = time.monotonic() if now is None else now
+        self.pending_samples += 1
+        flipped = state != self.last_state
+        self.readings_since_flip = 1 if flipped else self.readings_since_flip + 1
+        switch_due = self.readings_since_flip >= self.switch_count
+        if (flipped
+                or abs(moisture_percentage - self.last_percentage) > self.deadband_percentage
+                or now - self.last_report_time >= self.max_silence_seconds
+                or switch_due):
+            sample_count = self.pending_samples
+            if flipped:
+                # Readings suppressed before a flip belong to the old state and cannot change the counter
+                sample_count = 1
+            if switch_due:
+                # The detector resets its counter when it switches, count again from here
+                self.readings_since_flip = 0
+            self.last_percentage = moisture_percentage
+            self.last_state = state
+            self.last_report_time = now
+            self.pending_samples = 0
+            return sample_count
+        return None
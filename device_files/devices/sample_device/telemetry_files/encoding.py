@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Compact binary wire format for soil moisture telemetry.
+
+Used instead of JSON when "payload_format" is "struct" in parameters.json. The
+first byte of every payload is the schema version. The device ID comes from the
+topic, so it is not repeated in the payload. All fields are big endian.
+
+Schema 1, single reading (5 bytes):
+    | version (B) | state (B) | moisture percentage (b) | sampleCount (H) |
+
+Schema 2, batch of readings (11 bytes + 8 bytes per reading):
+    | version (B) | reading count (H) | base timestamp ms (q) |
+    then per reading:
+    | offset from base timestamp ms (I) | state (B) | moisture percentage (b) | sampleCount (H) |
+
+The unbatch_sensordata Lambda holds the matching decoder.
+
+JSON single readings are built from a format string prepared once per device,
+and ReadingPayloadCache keeps the encoded payload of every state and
+percentage it has seen. A device sweeping between its hydrated and dry values
+keeps publishing the same few hundred payloads, so after the first sweep the
+payload of a reading is a list lookup, with no dict, string or bytes built.
+Readings carrying a time-to-dry forecast (minutesToDry) are formatted on every
+call, the binary schemas have no forecast field.
+'''
+
+
+import json
+import struct
+
+SCHEMA_READING = 1
+SCHEMA_BATCH = 2
+
+READING_FORMAT = struct.Struct('>BBbH')
+BATCH_HEADER_FORMAT = struct.Struct('>BHq')
+BATCH_ROW_FORMAT = struct.Struct('>IBbH')
+
+STATE_CODES = {
+    "hydrated": 0,
+    "dry": 1
+}
+
+
+def encode_reading(state, moisture_percentage, sample_count=1):
+    return READING_FORMAT.pack(SCHEMA_READING, STATE_CODES[state], moisture_percentage, sample_count)
+
+
+def encode_batch(batch):
+    # Takes a ReadingBatcher message and packs its readings
+    readings = batch['readings']
+    base_timestamp = readings[0][0]
+    payload = bytearray(BATCH_HEADER_FORMAT.size + BATCH_ROW_FORMAT.size * len(readings))
+    BATCH_HEADER_FORMAT.pack_into(payload, 0, SCHEMA_BATCH, len(readings), base_timestamp)
+    offset = BATCH_HEADER_FORMAT.size
+    for timestamp, moisture_percentage, state, sample_count in readings:
+        BATCH_ROW_FORMAT.pack_into(payload, offset, timestamp - base_timestamp, STATE_CODES[state],
+                                   moisture_percentage, sample_count)
+        offset += BATCH_ROW_FORMAT.size
+    return bytes(payload)
+
+
+def json_reading_encoder(sensor_type, device_id):
+    # Same payload as json.dumps of the reading dict, the constant fields are escaped once
+    template = ('{{"sensorType": {}, "deviceID": {}, "sensorReportedState": "%s", '
+                '"sensorReportedMoisturePercentage": %d, "sampleCount": %d').format(
+                    json.dumps(sensor_type), json.dumps(device_id))
+    reading_template = template + '}'
+    forecast_template = template + ', "minutesToDry": %d}'
+
+    def encode_json_reading(state, moisture_percentage, sample_count=1, minutes_to_dry=None):
+        if minutes_to_dry is None:
+            return (reading_template % (state, moisture_percentage, sample_count)).encode('utf-8')
+        return (forecast_template % (state, moisture_percentage, sample_count, minutes_to_dry)).encode('utf-8')
+    return encode_json_reading
+
+
+class ReadingPayloadCache:
+    # Encoded payloads of single readings by state and percentage, for readings with a sampleCount of 1.
+    # Percentages outside of -128..127 and deadband reports are encoded on every call.
+    def __init__(self, encode_fn):
+        self.encode_fn = encode_fn
+        self.slots = {state: [None] * 256 for state in STATE_CODES}
+
+    def encode(self, state, moisture_percentage, sample_count=1, minutes_to_dry=None):
+        if minutes_to_dry is not None:
+            return self.encode_fn(state, moisture_percentage, sample_count, minutes_to_dry)
+        if sample_count != 1 or not -128 <= moisture_percentage <= 127:
+            return self.encode_fn(state, moisture_percentage, sample_count)
+        slots = self.slots[state]
+        payload = slots[moisture_percentage + 128]
+        if payload is None:
+            payload = slots[moisture_percentage + 128] = self.encode_fn(state, moisture_percentage, sample_count)
+        return payload
\ No newline at end of file
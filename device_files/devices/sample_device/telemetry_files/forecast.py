@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+On-device forecast of the time until the soil dries down to
+sprinkler_trigger_percentage.
+
+Readings taken while the soil is drying are fitted with a least squares line
+over a sliding window, kept as running sums so a new reading costs a few
+additions and no pass over the window:
+- "linear" fits the moisture percentage, for soil that loses water at a steady rate
+- "exponential" fits the log of the percentage, for soil that dries fast when
+  wet and slows down as it gets drier
+
+The window is cleared while the sprinkler is watering and whenever the moisture
+rises by more than reset_rise points (rain, manual watering), so the fit only
+ever covers one drying period. No forecast is given until min_samples readings
+spanning min_span_seconds are in the window, or while the soil is not drying.
+'''
+
+
+from array import array
+import math
+import time
+
+FORECAST_MODELS = ("linear", "exponential")
+
+
+class DryForecaster:
+    def __init__(self, window=30, model="linear", min_samples=5, min_span_seconds=60, reset_rise=5,
+                 max_minutes=10080):
+        if model not in FORECAST_MODELS:
+            raise ValueError("Unknown forecast model '{}', expected one of {}".format(model, FORECAST_MODELS))
+        self.window = max(2, window)
+        self.model = model
+        self.min_samples = max(2, min_samples)
+        self.min_span_seconds = min_span_seconds
+        self.reset_rise = reset_rise
+        self.max_minutes = max_minutes
+        self.times = array('d', bytes(8 * self.window))
+        self.values = array('d', bytes(8 * self.window))
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.index = 0
+        self.count = 0
+        self.last_percentage = None
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+
+    def _value(self, moisture_percentage):
+        if self.model == "exponential":
+            # Half a point keeps the log finite at 0%
+            return math.log(max(moisture_percentage, 0.5))
+        return float(moisture_percentage)
+
+    def _resum(self):
+        # Rebuilds the running sums from the window once per pass, so rounding errors do not pile up
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+        for i in range(self.count):
+            t, v = self.times[i], self.values[i]
+            self.sum_t += t
+            self.sum_v += v
+            self.sum_tt += t * t
+            self.sum_tv += t * v
+
+    def add(self, moisture_percentage, watering=False, now=None):
+        now = time.monotonic() if now is None else now
+        if watering or (self.last_percentage is not None and
+                        moisture_percentage - self.last_percentage > self.reset_rise):
+            self.reset()
+            if watering:
+                return
+        if self.start is None:
+            self.start = now
+        self.last_percentage = moisture_percentage
+        # Seconds since the start of the drying period keep the sums small
+        t = now - self.start
+        v = self._value(moisture_percentage)
+        if self.count == self.window:
+            old_t, old_v = self.times[self.index], self.values[self.index]
+            self.sum_t -= old_t
+            self.sum_v -= old_v
+            self.sum_tt -= old_t * old_t
+            self.sum_tv -= old_t * old_v
+        else:
+            self.count += 1
+        self.times[self.index], self.values[self.index] = t, v
+        self.sum_t += t
+        self.sum_v += v
+        self.sum_tt += t * t
+        self.sum_tv += t * v
+        self.index = (self.index + 1) % self.window
+        if self.index == 0:
+            self._resum()
+
+    def minutes_to(self, trigger_percentage):
+        # Minutes until the fitted curve reaches trigger_percentage, None without a usable forecast
+        if self.count < self.min_samples:
+            return None
+        newest = self.times[(self.index - 1) % self.window]
+        oldest = self.times[self.index % self.window] if self.count == self.window else self.times[0]
+        if newest - oldest < self.min_span_seconds:
+            return None
+        n = self.count
+        variance = n * self.sum_tt - self.sum_t * self.sum_t
+        if variance <= 0:
+            return None
+        slope = (n * self.sum_tv - self.sum_t * self.sum_v) / variance
+        if slope >= 0:
+            return None
+        fitted = (self.sum_v + slope * (n * newest - self.sum_t)) / n
+        target = self._value(trigger_percentage)
+        if fitted <= target:
+            return 0.0
+        minutes = (fitted - target) / -slope / 60
+        return minutes if minutes <= self.max_minutes else None
@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+In-process metrics of the device's own health, reported to Device Defender.
+
+- Counter counts events, a report carries the count since the previous report
+- Gauge is read when a report is built, from a function such as the spool's
+  pending bytes, so there is no cost between reports
+- Histogram counts samples into fixed buckets set up front, recording a sample
+  is a bisect and an increment, with no allocation per sample
+
+MetricsReporter publishes a snapshot every interval in the Device Defender
+device-side metrics format, with everything under "custom_metrics". Histograms
+are reported as <name>_p90 and <name>_max numbers, plus the bucket counts as
+the <name>_buckets number list. Each name must exist as a custom metric in
+Device Defender (see iot_device_defender_stack.py).
+'''
+
+
+from array import array
+from bisect import bisect_left
+import json
+import threading
+import time
+
+# Milliseconds, from a fast local PUBACK up to a long outage
+DEFAULT_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Counter:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def collect(self):
+        with self.lock:
+            value, self.value = self.value, 0
+        return value
+
+
+class Gauge:
+    __slots__ = ('read_fn',)
+
+    def __init__(self, read_fn):
+        self.read_fn = read_fn
+
+    def collect(self):
+        return self.read_fn()
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'max', 'lock')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        # One bucket per bound, plus one for samples above the last bound
+        self.counts = array('Q', bytes(8 * (len(self.bounds) + 1)))
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            if value > self.max:
+                self.max = value
+
+    def observe_since(self, started):
+        # started is a time.monotonic() value, the sample is in milliseconds
+        self.observe((time.monotonic() - started) * 1000)
+
+    def collect(self):
+        # Returns (bucket counts, p90 bucket bound, max) since the last collect
+        with self.lock:
+            counts = self.counts.tolist()
+            maximum = self.max
+            for i in range(len(self.counts)):
+                self.counts[i] = 0
+            self.max = 0
+        total = sum(counts)
+        p90 = 0
+        if total:
+            seen = 0
+            for bucket, count in enumerate(counts):
+                seen += count
+                if seen * 10 >= total * 9:
+                    # The overflow bucket has no upper bound, report the max instead
+                    p90 = self.bounds[bucket] if bucket < len(self.bounds) else maximum
+                    break
+        return counts, p90, maximum
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name):
+        return self.metrics.setdefault(name, Counter())
+
+    def gauge(self, name, read_fn):
+        return self.metrics.setdefault(name, Gauge(read_fn))
+
+    def histogram(self, name, bounds=DEFAULT_BUCKETS_MS):
+        return self.metrics.setdefault(name, Histogram(bounds))
+
+    def timed(self, name, fn):
+        # Wraps a callback so its execution time is recorded in the histogram <name>
+        histogram = self.histogram(name)
+
+        def timed_fn(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe_since(started)
+        return timed_fn
+
+    def defender_report(self):
+        # Device Defender device-side metrics report, custom metrics only
+        custom_metrics = {}
+        for name, metric in self.metrics.items():
+            if isinstance(metric, Histogram):
+                counts, p90, maximum = metric.collect()
+                custom_metrics[name + "_p90"] = [{"number": round(p90, 1)}]
+                custom_metrics[name + "_max"] = [{"number": round(maximum, 1)}]
+                custom_metrics[name + "_buckets"] = [{"number_list": counts}]
+            else:
+                custom_metrics[name] = [{"number": metric.collect()}]
+        return {
+            # Report ids only have to increase
+            "header": {"report_id": int(time.time() * 1000), "version": "1.0"},
+            "metrics": {},
+            "custom_metrics": custom_metrics
+        }
+
+
+class MetricsReporter(threading.Thread):
+    def __init__(self, registry, publish_fn, topic, connected_event, interval=300):
+        # publish_fn(topic, payload) publishes the report, Device Defender accepts one every 5 minutes
+        super().__init__(name='metrics_reporter', daemon=True)
+        self.registry = registry
+        self.publish_fn = publish_fn
+        self.topic = topic
+        self.connected_event = connected_event
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            # While offline the metrics keep adding up into the next report
+            if not self.connected_event.is_set():
+                continue
+            try:
+                self.publish_fn(self.topic, json.dumps(self.registry.defender_report(), separators=(',', ':')))
+            except Exception as e:
+                print("Metrics report failed: {}".format(e))
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,73 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Oversampling and smoothing stage for the soil moisture probe.
+
+The probe is read oversample_count times per reporting interval into a
+preallocated ring buffer, and the value that is reported is the filtered value
+of the buffer. One noisy sample then no longer flips sensorReportedState and
+resets the IoT Events debounce counter.
+
+Filters:
+- "median": median of the window
+- "mean": trimmed mean of the window, dropping trim_fraction of samples at each end
+- "ema": exponential moving average with ema_alpha
+
+NumPy is used for the window statistics when it is installed, otherwise the
+buffer is an array('d') and the statistics are computed in pure Python.
+'''
+
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FILTER_METHODS = ("median", "mean", "ema")
+
+
+class ProbeFilter:
+    def __init__(self, window_size, method="median", ema_alpha=0.3, trim_fraction=0.1):
+        if method not in FILTER_METHODS:
+            raise ValueError("Unknown filter method '{}', expected one of {}".format(method, FILTER_METHODS))
+        self.window_size = max(1, window_size)
+        self.method = method
+        self.ema_alpha = ema_alpha
+        self.trim = int(self.window_size * trim_fraction)
+        if np is not None:
+            self.buffer = np.zeros(self.window_size)
+        else:
+            self.buffer = array('d', bytes(8 * self.window_size))
+        self.index = 0
+        self.count = 0
+        self.ema = None
+
+    def add(self, sample):
+        self.buffer[self.index] = sample
+        self.index = (self.index + 1) % self.window_size
+        self.count = min(self.count + 1, self.window_size)
+        self.ema = sample if self.ema is None else self.ema + self.ema_alpha * (sample - self.ema)
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.method == "ema":
+            return self.ema
+        window = self.buffer[:self.count]
+        if self.method == "median":
+            if np is not None:
+                return float(np.median(window))
+            ordered = sorted(window)
+            middle = self.count // 2
+            return ordered[middle] if self.count % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        # Trimmed mean, never trimming the window down to nothing
+        trim = min(self.trim, (self.count - 1) // 2)
+        if np is not None:
+            ordered = np.sort(window)
+            return float(ordered[trim:self.count - trim].mean())
+        ordered = sorted(window)[trim:self.count - trim]
+        return sum(ordered) / len(ordered)
@@ -0,0 +1,232 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Persistent, size bounded store-and-forward spool for device telemetry.
+
+Every reading is appended to a segment file on disk before it is sent. A drain
+thread replays the records in order at a fixed rate whenever the MQTT connection
+is up, and only advances the read cursor once the broker has acknowledged the
+publish. If the spool grows beyond its size limit the oldest segments are
+dropped, so a device that is offline for hours keeps the most recent readings
+without running out of disk or memory. With the "drop_newest" policy the queued
+backlog is kept instead and new records are refused while the spool is full.
+
+Record layout inside a segment:
+    | topic length (2 bytes) | payload length (4 bytes) | topic | payload |
+'''
+
+
+import os
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('>HI')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+DROP_POLICIES = ("drop_oldest", "drop_newest")
+
+
+class TelemetrySpool:
+    def __init__(self, spool_dir, max_bytes=1048576, segment_bytes=65536, drop_policy="drop_oldest"):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy '{}', expected one of {}".format(drop_policy, DROP_POLICIES))
+        self.spool_dir = spool_dir
+        self.drop_policy = drop_policy
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.has_data = threading.Condition(self.lock)
+        self.dropped_records = 0
+        self.encoded_topics = {}
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(spool_dir) if name.endswith(SEGMENT_SUFFIX))
+        if not self.segments:
+            self.segments = [0]
+            open(self._segment_path(0), 'ab').close()
+
+        self.write_file = open(self._segment_path(self.segments[-1]), 'ab')
+        # Size of the segments before the one being written, kept up to date instead of a stat per append
+        self.closed_bytes = sum(os.path.getsize(self._segment_path(segment)) for segment in self.segments[:-1])
+        self.read_segment, self.read_offset = self._load_cursor()
+        self.read_file = None
+        self.peeked = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.spool_dir, '{:08d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.spool_dir, CURSOR_FILE), 'r') as f:
+                segment, offset = (int(value) for value in f.read().split())
+        except (OSError, ValueError):
+            return self.segments[0], 0
+        if segment not in self.segments:
+            return self.segments[0], 0
+        return segment, offset
+
+    def _save_cursor(self):
+        # Write to a temporary file and rename so a power cut never leaves a torn cursor
+        cursor_path = os.path.join(self.spool_dir, CURSOR_FILE)
+        with open(cursor_path + '.tmp', 'w') as f:
+            f.write('{} {}'.format(self.read_segment, self.read_offset))
+        os.replace(cursor_path + '.tmp', cursor_path)
+
+    def _total_bytes(self):
+        return self.closed_bytes + self.write_file.tell()
+
+    def _roll_segment(self):
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        self.closed_bytes += self.write_file.tell()
+        self.write_file.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.write_file = open(self._segment_path(self.segments[-1]), 'ab')
+
+    def _drop_oldest_segment(self):
+        oldest = self.segments.pop(0)
+        if oldest == self.read_segment:
+            # Count what is lost so the device can report it
+            self.dropped_records += self._count_records(oldest, self.read_offset)
+            self._close_reader()
+            self.read_segment, self.read_offset = self.segments[0], 0
+            self._save_cursor()
+        self.closed_bytes -= os.path.getsize(self._segment_path(oldest))
+        os.remove(self._segment_path(oldest))
+
+    def _count_records(self, segment, offset):
+        count = 0
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return count
+                topic_length, payload_length = RECORD_HEADER.unpack(header)
+                f.seek(topic_length + payload_length, os.SEEK_CUR)
+                count += 1
+
+    def _close_reader(self):
+        if self.read_file is not None:
+            self.read_file.close()
+            self.read_file = None
+        self.peeked = None
+
+    def append(self, topic, payload):
+        # Returns False if the record was refused by the drop_newest policy
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        # A device publishes to a handful of topics, encode each one once
+        encoded_topic = self.encoded_topics.get(topic)
+        if encoded_topic is None:
+            encoded_topic = self.encoded_topics[topic] = topic.encode('utf-8')
+        record_bytes = RECORD_HEADER.size + len(encoded_topic) + len(payload)
+
+        with self.lock:
+            if self.drop_policy == "drop_newest" and self._total_bytes() + record_bytes > self.max_bytes:
+                self.dropped_records += 1
+                return False
+            if self.write_file.tell() + record_bytes > self.segment_bytes and self.write_file.tell() > 0:
+                self._roll_segment()
+            # The parts go straight into the file buffer, the record is not joined in memory first
+            self.write_file.write(RECORD_HEADER.pack(len(encoded_topic), len(payload)))
+            self.write_file.write(encoded_topic)
+            self.write_file.write(payload)
+            self.write_file.flush()
+            while len(self.segments) > 1 and self._total_bytes() > self.max_bytes:
+                self._drop_oldest_segment()
+            self.has_data.notify_all()
+        return True
+
+    def peek(self):
+        # Returns the oldest unacknowledged (topic, payload) pair, or None if the spool is drained
+        with self.lock:
+            if self.peeked is not None:
+                return self.peeked[0], self.peeked[1]
+            while True:
+                if self.read_file is None:
+                    self.read_file = open(self._segment_path(self.read_segment), 'rb')
+                self.read_file.seek(self.read_offset)
+                header = self.read_file.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    topic_length, payload_length = RECORD_HEADER.unpack(header)
+                    body = self.read_file.read(topic_length + payload_length)
+                    if len(body) == topic_length + payload_length:
+                        self.peeked = (body[:topic_length].decode('utf-8'), body[topic_length:],
+                                       self.read_offset + RECORD_HEADER.size + len(body))
+                        return self.peeked[0], self.peeked[1]
+                # End of this segment, move on if a newer one exists
+                if self.read_segment == self.segments[-1]:
+                    return None
+                self._advance_segment()
+
+    def _advance_segment(self):
+        finished = self.read_segment
+        self._close_reader()
+        self.read_segment = self.segments[self.segments.index(finished) + 1]
+        self.read_offset = 0
+        self.segments.remove(finished)
+        self.closed_bytes -= os.path.getsize(self._segment_path(finished))
+        os.remove(self._segment_path(finished))
+        self._save_cursor()
+
+    def commit(self):
+        # Mark the record returned by the last peek() as delivered
+        with self.lock:
+            if self.peeked is None:
+                return
+            self.read_offset = self.peeked[2]
+            self.peeked = None
+            self._save_cursor()
+
+    def pending_bytes(self):
+        # Bytes not yet acknowledged by the broker, the outbound queue depth
+        with self.lock:
+            return self._total_bytes() - self.read_offset
+
+    def wait_for_data(self, timeout=None):
+        with self.lock:
+            return self.has_data.wait(timeout)
+
+    def close(self):
+        with self.lock:
+            self._close_reader()
+            self.write_file.close()
+
+
+class SpoolDrainer(threading.Thread):
+    def __init__(self, spool, publish_fn, connected_event, drain_rate=5, ack_timeout=10):
+        # publish_fn(topic, payload) must return a future that completes once the broker acknowledges
+        super().__init__(name='spool_drainer', daemon=True)
+        self.spool = spool
+        self.publish_fn = publish_fn
+        self.connected_event = connected_event
+        self.drain_interval = 1.0 / drain_rate if drain_rate > 0 else 0
+        self.ack_timeout = ack_timeout
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.connected_event.wait()
+            record = self.spool.peek()
+            if record is None:
+                self.spool.wait_for_data(timeout=1)
+                continue
+            topic, payload = record
+            try:
+                self.publish_fn(topic, payload).result(timeout=self.ack_timeout)
+            except Exception as e:
+                # Leave the record in the spool and try again once the link settles
+                print("Spool publish failed, will retry: {}".format(e))
+                time.sleep(1)
+                continue
+            self.spool.commit()
+            if self.drain_interval:
+                time.sleep(self.drain_interval)
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,254 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Bulk device provisioning for factory lines.
+
+Reads a CSV manifest (serial,sensor_type,plant_id,version), creates
+<devices_dir>/<serial> from the sample device, and provisions the devices
+concurrently on a bounded worker pool. For each device it writes the
+parameters.json and the certificate bundle that iot_sprinkler.py expects.
+
+Modes:
+- "fleet": fleet provisioning with the claim certificate. Each worker keeps one
+  claim-cert session (ProvisioningClient) open for all of its devices, and all
+  sessions share one event loop group and client bootstrap.
+- "lambda": invokes a certificate creation Lambda per device, the same call
+  as provisioning_files/customCertificateGeneration.py.
+
+At the end the tool prints throughput and latency, lists failed serial numbers,
+and writes the failed rows to <manifest>.failed.csv so they can be retried.
+
+Usage (from the iot_enabled_sprinkler/ directory):
+    python3 factory_provisioning/bulk_provisioning.py --endpoint $IOT_ENDPOINT --manifest manifest.csv --workers 8
+'''
+
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from uuid import uuid4
+
+MANIFEST_FIELDS = ["serial", "sensor_type", "plant_id", "version"]
+
+
+def read_manifest(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        missing = [field for field in MANIFEST_FIELDS if not row.get(field)]
+        if missing:
+            raise ValueError("Manifest row {} is missing {}".format(row, missing))
+    return rows
+
+
+def create_device_folder(args, row):
+    # Copy the sample device, without any runtime state or certificates of its own
+    device_dir = os.path.join(args.devices_dir, row['serial'])
+    if not os.path.exists(os.path.join(device_dir, 'parameters.json')):
+        shutil.copytree(args.template_device, device_dir,
+                        ignore=shutil.ignore_patterns('__pycache__', 'spool', '*_certificate.pem.crt', '*_private.pem.key'))
+    os.makedirs(os.path.join(device_dir, 'certificates'), exist_ok=True)
+
+    parameter_path = os.path.join(device_dir, 'parameters.json')
+    with open(parameter_path) as f:
+        parameters = json.load(f)
+    parameters['new_device'] = True
+    parameters['sensor_type'] = row['sensor_type']
+    parameters['plant_id'] = row['plant_id']
+    parameters['version'] = row['version']
+    with open(parameter_path, 'w') as f:
+        f.write(json.dumps(parameters, indent=4))
+    return device_dir
+
+
+def write_certificate_bundle(device_dir, serial, certificate_pem, private_key, device_and_root_ca=None):
+    with open(os.path.join(device_dir, 'certificates', '{}_certificate.pem.crt'.format(serial)), 'w') as text_file:
+        text_file.write(certificate_pem)
+    with open(os.path.join(device_dir, 'certificates', '{}_private.pem.key'.format(serial)), 'w') as text_file:
+        text_file.write(private_key)
+    if device_and_root_ca is not None:
+        with open(os.path.join(device_dir, 'certificates', '{}_deviceAndRootCa.pem'.format(serial)), 'w') as text_file:
+            text_file.write(device_and_root_ca)
+
+
+class FleetProvisioner:
+    # One claim-cert session per worker thread, all on the same client bootstrap
+    def __init__(self, args):
+        self.args = args
+        event_loop_group = io.EventLoopGroup(args.event_loop_threads)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        self.client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+        self.local = threading.local()
+        self.clients = []
+        self.clients_lock = threading.Lock()
+
+    def client(self):
+        if getattr(self.local, 'client', None) is None:
+            self.local.client = ProvisioningClient(
+                endpoint=self.args.endpoint,
+                cert=self.args.claim_cert,
+                key=self.args.claim_key,
+                root_ca=self.args.root_ca,
+                client_id="{}{}".format(self.args.client_id_prefix, uuid4()),
+                client_bootstrap=self.client_bootstrap,
+                create_keys_timeout=self.args.timeout,
+                register_thing_timeout=self.args.timeout)
+            with self.clients_lock:
+                self.clients.append(self.local.client)
+        return self.local.client
+
+    def provision(self, row, device_dir):
+        templateParameters = {
+            "SerialNumber": row['serial'],
+            "CertificateCreatedOn": str(date.today()),
+            "SensorType": row['sensor_type'],
+            "PlantId": row['plant_id'],
+            "FirmwareVersion": row['version']
+        }
+        result = self.client().provision(self.args.template_name, templateParameters)
+        createKeysAndCertificateResponse = result['createKeysAndCertificateResponse']
+        write_certificate_bundle(device_dir, row['serial'],
+                                 createKeysAndCertificateResponse.certificate_pem,
+                                 createKeysAndCertificateResponse.private_key)
+        return createKeysAndCertificateResponse.certificate_id
+
+    def close(self):
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception as e:
+                print("Failed to disconnect: {}".format(e))
+
+
+class LambdaProvisioner:
+    def __init__(self, args):
+        self.args = args
+        # boto3 clients are thread safe, the pool size bounds concurrent invocations
+        self._lambda = boto3.client('lambda', config=botocore.config.Config(max_pool_connections=args.workers))
+
+    def provision(self, row, device_dir):
+        event = {
+            "thingName": row['serial'],
+            "days": self.args.days
+        }
+        get_device_certs_response = self._lambda.invoke(
+            FunctionName=self.args.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(event)
+        )
+        device_certs = json.loads(json.loads(get_device_certs_response['Payload'].read())['body'])
+        write_certificate_bundle(device_dir, row['serial'],
+                                 device_certs['certificatePem'],
+                                 device_certs['privateKey'],
+                                 device_certs['deviceAndRootCa'])
+        return device_certs.get('certificateId')
+
+
+def provision_one(provisioner, args, row):
+    start = time.monotonic()
+    device_dir = create_device_folder(args, row)
+    certificate_id = provisioner.provision(row, device_dir)
+    return certificate_id, (time.monotonic() - start) * 1000
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Provision a manifest of devices concurrently.")
+    parser.add_argument('--manifest', required=True, help="CSV file with the columns serial,sensor_type,plant_id,version.")
+    parser.add_argument('--mode', choices=['fleet', 'lambda'], default='fleet', help="Fleet provisioning with the claim certificate, or a certificate creation Lambda.")
+    parser.add_argument('--workers', type=int, default=8, help="Devices provisioned at the same time.")
+    parser.add_argument('--devices_dir', default='devices', help="Folder the device folders are created in.")
+    parser.add_argument('--template_device', default='devices/sample_device', help="Device folder copied for each new device.")
+    parser.add_argument('--skip_provisioned', action='store_true', help="Skip devices that already have a certificate.")
+    # fleet mode
+    parser.add_argument('--endpoint', help="Your AWS IoT custom endpoint, required in fleet mode.")
+    parser.add_argument('--template_name', help="Fleet provisioning template, defaults to provisioningTemplateName from the template device.")
+    parser.add_argument('--claim_cert', help="Claim certificate, defaults to the one in the template device.")
+    parser.add_argument('--claim_key', help="Claim private key, defaults to the one in the template device.")
+    parser.add_argument('--root_ca', help="Root CA, defaults to the one in the template device.")
+    parser.add_argument('--client_id_prefix', default='factory-', help="Prefix of the claim session client IDs.")
+    parser.add_argument('--timeout', type=float, default=20, help="Seconds to wait for each provisioning response.")
+    parser.add_argument('--event_loop_threads', type=int, default=1, help="Threads in the shared CRT event loop group.")
+    # lambda mode
+    parser.add_argument('--function_name', help="Certificate creation Lambda, required in lambda mode.")
+    parser.add_argument('--days', default=90, help="Number of Days for how long the certificate is valid.")
+    args = parser.parse_args()
+
+    rows = read_manifest(args.manifest)
+    if args.skip_provisioned:
+        rows = [row for row in rows if not os.path.exists(os.path.join(
+            args.devices_dir, row['serial'], 'certificates', '{}_certificate.pem.crt'.format(row['serial'])))]
+
+    if args.mode == 'fleet':
+        if not args.endpoint:
+            parser.error("--endpoint is required in fleet mode")
+        # fleetprovisioning.py ships with the device code
+        sys.path.insert(0, args.template_device)
+        from awscrt import io
+        from provisioning_files.fleetprovisioning import ProvisioningClient
+        with open(os.path.join(args.template_device, 'parameters.json')) as f:
+            template_parameters = json.load(f)
+        args.template_name = args.template_name or template_parameters['provisioningTemplateName']
+        args.claim_cert = args.claim_cert or os.path.join(args.template_device, 'provisioning_files', 'claim.certificate.pem')
+        args.claim_key = args.claim_key or os.path.join(args.template_device, 'provisioning_files', 'claim.private.key')
+        args.root_ca = args.root_ca or os.path.join(args.template_device, 'certificates', 'AmazonRootCA1.pem')
+        provisioner = FleetProvisioner(args)
+    else:
+        if not args.function_name:
+            parser.error("--function_name is required in lambda mode")
+        import boto3
+        import botocore.config
+        provisioner = LambdaProvisioner(args)
+
+    print("Provisioning {} devices with {} workers ({} mode)".format(len(rows), args.workers, args.mode))
+    latencies_ms = []
+    failures = []
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(provision_one, provisioner, args, row): row for row in rows}
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    certificate_id, latency_ms = future.result()
+                    latencies_ms.append(latency_ms)
+                    print("Provisioned {} ({:.0f} ms) certificate {}".format(row['serial'], latency_ms, certificate_id))
+                except Exception as e:
+                    failures.append(row)
+                    print("Failed to provision {}: {}".format(row['serial'], e))
+    finally:
+        if args.mode == 'fleet':
+            provisioner.close()
+    elapsed = time.monotonic() - start
+
+    latencies_ms.sort()
+    print("\n##======================================##")
+    print("Provisioned: {}  Failed: {}  in {:.1f} s".format(len(latencies_ms), len(failures), elapsed))
+    print("Throughput: {:.1f} devices/min".format(len(latencies_ms) * 60 / elapsed if elapsed else 0))
+    print("Latency ms: p50 {:.0f}  p90 {:.0f}  p99 {:.0f}  max {:.0f}".format(
+        percentile(latencies_ms, 0.5), percentile(latencies_ms, 0.9),
+        percentile(latencies_ms, 0.99), latencies_ms[-1] if latencies_ms else 0))
+    if failures:
+        failed_path = args.manifest + '.failed.csv'
+        with open(failed_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(failures)
+        print("Failed devices: {}".format(", ".join(row['serial'] for row in failures)))
+        print("Failed rows written to {}".format(failed_path))
+    print("##======================================##")
+    sys.exit(1 if failures else 0)
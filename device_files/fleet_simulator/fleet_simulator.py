@@ -0,0 +1,240 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Multi-device fleet simulator for load testing the sprinkler backend.
+
+Runs many virtual sprinklers in one process. All of them share one event loop
+group, host resolver and client bootstrap, and each has its own client ID,
+certificates and telemetry schedule. With --processes the fleet is sharded
+across a process pool. At the end the simulator prints aggregate publish
+throughput and publish-to-PUBACK latency.
+
+Devices are discovered from <devices_dir>/<name>/certificates/<name>_certificate.pem.crt,
+the same layout used by iot_sprinkler.py. For large load tests with a single
+test certificate, use --cert/--key with --count and --client_id_prefix instead.
+
+Usage (from the iot_enabled_sprinkler/ directory):
+    python3 fleet_simulator/fleet_simulator.py --endpoint $IOT_ENDPOINT --devices_dir devices --duration 300
+'''
+
+
+from awscrt import io, mqtt
+from awsiot import mqtt_connection_builder
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists
+import argparse
+import bisect
+import heapq
+import json
+import os
+import random
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is open ended
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class PublishStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self.connect_failures = 0
+        self.latency_sum_ms = 0.0
+        self.latency_max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record_ack(self, latency_ms):
+        with self.lock:
+            self.acked += 1
+            self.latency_sum_ms += latency_ms
+            self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def merge(self, other):
+        self.published += other['published']
+        self.acked += other['acked']
+        self.failed += other['failed']
+        self.connect_failures += other['connect_failures']
+        self.latency_sum_ms += other['latency_sum_ms']
+        self.latency_max_ms = max(self.latency_max_ms, other['latency_max_ms'])
+        self.buckets = [a + b for a, b in zip(self.buckets, other['buckets'])]
+
+    def to_dict(self):
+        return {
+            "published": self.published,
+            "acked": self.acked,
+            "failed": self.failed,
+            "connect_failures": self.connect_failures,
+            "latency_sum_ms": self.latency_sum_ms,
+            "latency_max_ms": self.latency_max_ms,
+            "buckets": self.buckets
+        }
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested percentile
+        target = self.acked * fraction
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.latency_max_ms
+        return 0
+
+
+class VirtualSprinkler:
+    def __init__(self, name, cert, key, root_ca, client_id, interval):
+        self.name = name
+        self.cert = cert
+        self.key = key
+        self.root_ca = root_ca
+        self.client_id = client_id
+        self.interval = interval
+        self.topic = "{}/sensordata/soil_moisture".format(name)
+        self.moisture = random.randint(20, 80) # nosec
+        self.connection = None
+
+    def next_message(self, trigger_percentage):
+        self.moisture = max(0, min(100, self.moisture + random.randint(-3, 3))) # nosec
+        return json.dumps({
+            "sensorType": "SoilMoistureSensor",
+            "deviceID": self.name,
+            "sensorReportedState": "dry" if self.moisture <= trigger_percentage else "hydrated",
+            "sensorReportedMoisturePercentage": self.moisture,
+            "sampleCount": 1
+        })
+
+
+def discover_devices(args):
+    if args.cert:
+        return [(args.client_id_prefix + str(i), args.cert, args.key, args.root_ca) for i in range(args.count)]
+    devices = []
+    for name in sorted(os.listdir(args.devices_dir)):
+        cert = os.path.join(args.devices_dir, name, "certificates", "{}_certificate.pem.crt".format(name))
+        if exists(cert):
+            devices.append((name, cert,
+                            os.path.join(args.devices_dir, name, "certificates", "{}_private.pem.key".format(name)),
+                            os.path.join(args.devices_dir, name, "certificates", "AmazonRootCA1.pem")))
+    return devices[:args.count] if args.count else devices
+
+
+def run_shard(shard_devices, args):
+    stats = PublishStats()
+    # One event loop group, resolver and bootstrap for every device in the shard
+    event_loop_group = io.EventLoopGroup(args.event_loop_threads)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+    sprinklers = [VirtualSprinkler(name, cert, key, root_ca, name, args.interval)
+                  for name, cert, key, root_ca in shard_devices]
+
+    connect_futures = []
+    for sprinkler in sprinklers:
+        sprinkler.connection = mqtt_connection_builder.mtls_from_path(
+            endpoint=args.endpoint,
+            cert_filepath=sprinkler.cert,
+            pri_key_filepath=sprinkler.key,
+            client_bootstrap=client_bootstrap,
+            ca_filepath=sprinkler.root_ca,
+            client_id=sprinkler.client_id,
+            clean_session=True,
+            keep_alive_secs=60)
+        connect_futures.append(sprinkler.connection.connect())
+        # Spread connects out so the simulator does not cause its own connect storm
+        time.sleep(1.0 / args.connect_rate)
+
+    connected = []
+    for sprinkler, future in zip(sprinklers, connect_futures):
+        try:
+            future.result(timeout=30)
+            connected.append(sprinkler)
+        except Exception as e:
+            print("{} failed to connect: {}".format(sprinkler.name, e))
+            stats.connect_failures += 1
+
+    # Every device publishes on its own schedule, starting at a random phase
+    start = time.monotonic()
+    schedule = [(start + random.uniform(0, args.interval), i) for i in range(len(connected))] # nosec
+    heapq.heapify(schedule)
+    end = start + args.duration
+
+    def on_puback(future, sent_at):
+        try:
+            future.result()
+            stats.record_ack((time.monotonic() - sent_at) * 1000)
+        except Exception:
+            stats.record_failure()
+
+    while schedule and schedule[0][0] < end:
+        due, i = heapq.heappop(schedule)
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sprinkler = connected[i]
+        sent_at = time.monotonic()
+        publish_future, _ = sprinkler.connection.publish(
+            topic=sprinkler.topic,
+            payload=sprinkler.next_message(args.trigger_percentage),
+            qos=mqtt.QoS.AT_LEAST_ONCE)
+        stats.published += 1
+        publish_future.add_done_callback(lambda future, sent_at=sent_at: on_puback(future, sent_at))
+        heapq.heappush(schedule, (due + sprinkler.interval, i))
+
+    # Give outstanding PUBACKs a moment before disconnecting
+    time.sleep(min(5, args.interval))
+    for sprinkler in connected:
+        sprinkler.connection.disconnect().result()
+    return stats.to_dict()
+
+
+def print_summary(stats, duration):
+    print("\n##======================================##")
+    print("Published: {}  Acked: {}  Failed: {}  Connect failures: {}".format(
+        stats.published, stats.acked, stats.failed, stats.connect_failures))
+    print("Throughput: {:.1f} msg/s".format(stats.acked / duration if duration else 0))
+    if stats.acked:
+        print("PUBACK latency ms: mean {:.1f}  p50 <={}  p95 <={}  p99 <={}  max {:.1f}".format(
+            stats.latency_sum_ms / stats.acked, stats.percentile(0.5), stats.percentile(0.95),
+            stats.percentile(0.99), stats.latency_max_ms))
+    print("##======================================##\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IoT Enabled Sprinkler fleet simulator.")
+    parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port.")
+    parser.add_argument('--devices_dir', default='devices', help="Folder with provisioned device folders.")
+    parser.add_argument('--cert', help="Shared test certificate, used instead of per device certificates.")
+    parser.add_argument('--key', help="Private key for --cert.")
+    parser.add_argument('--root_ca', default='devices/sample_device/certificates/AmazonRootCA1.pem', help="Root CA for --cert.")
+    parser.add_argument('--client_id_prefix', default='AWS_SIM_', help="Client ID prefix used with --cert.")
+    parser.add_argument('--count', type=int, default=0, help="Number of virtual devices (0 = all discovered devices).")
+    parser.add_argument('--interval', type=float, default=2, help="Seconds between readings of each device.")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to run the simulation for.")
+    parser.add_argument('--trigger_percentage', type=int, default=27, help="Moisture percentage at or below which a reading is dry.")
+    parser.add_argument('--processes', type=int, default=1, help="Number of processes to shard the fleet across.")
+    parser.add_argument('--event_loop_threads', type=int, default=1, help="Event loop threads shared by the devices of a shard.")
+    parser.add_argument('--connect_rate', type=float, default=50, help="Connections opened per second per shard.")
+    args = parser.parse_args()
+
+    io.init_logging(io.LogLevel.Error, 'stderr')
+    devices = discover_devices(args)
+    print("Simulating {} devices in {} process(es)".format(len(devices), args.processes))
+
+    totals = PublishStats()
+    if args.processes > 1:
+        shards = [devices[i::args.processes] for i in range(args.processes)]
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            for shard_stats in pool.map(run_shard, shards, [args] * len(shards)):
+                totals.merge(shard_stats)
+    else:
+        totals.merge(run_shard(devices, args))
+    # Throughput is measured over the publishing window, connection setup is excluded
+    print_summary(totals, args.duration)
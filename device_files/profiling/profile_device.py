@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Profiles one sprinkler in the field through a PROFILE_DEVICE IoT job.
+
+WHAT IT DOES:
+1. Creates a presigned S3 PUT URL for profiles/<thing>/<job id>.tar.gz in the
+   devices bucket. IoT Jobs only presigns GET URLs, so the upload URL is
+   created here and written into the job document
+2. Creates a job targeting the thing, the device profiles for the requested
+   window and uploads the archive
+3. With --wait, polls the job execution and downloads the archive when the
+   job succeeded
+
+Usage (from the iot_enabled_sprinkler/ directory):
+    python3 profiling/profile_device.py --thing_name $THING_NAME --bucket $BUCKET_NAME --duration 120 --wait
+'''
+
+
+import argparse
+import json
+import time
+import uuid
+import boto3
+
+TERMINAL_STATUSES = ('SUCCEEDED', 'FAILED', 'REJECTED', 'REMOVED', 'TIMED_OUT', 'CANCELED')
+
+
+def create_profile_job(iot, s3, args):
+    job_id = "profile-{}-{}".format(args.thing_name, uuid.uuid4().hex[:8])
+    key = "profiles/{}/{}.tar.gz".format(args.thing_name, job_id)
+    # The URL must outlive the time the device takes to pick up the job and profile
+    upload_url = s3.generate_presigned_url(
+        'put_object', Params={'Bucket': args.bucket, 'Key': key}, ExpiresIn=args.url_expiry)
+    document = {
+        "task": "PROFILE_DEVICE",
+        "payload": {
+            "mode": args.mode,
+            "duration_seconds": args.duration,
+            "sample_interval_ms": args.sample_interval_ms,
+            "trace_memory": args.trace_memory,
+            "upload_url": upload_url
+        }
+    }
+    thing_arn = iot.describe_thing(thingName=args.thing_name)['thingArn']
+    iot.create_job(
+        jobId=job_id,
+        targets=[thing_arn],
+        document=json.dumps(document),
+        description="Profile {} for {}s".format(args.thing_name, args.duration),
+        targetSelection='SNAPSHOT',
+        timeoutConfig={'inProgressTimeoutInMinutes': max(1, args.url_expiry // 60)}
+    )
+    return job_id, key
+
+
+def wait_for_job(iot, job_id, thing_name, poll_seconds):
+    while True:
+        execution = iot.describe_job_execution(jobId=job_id, thingName=thing_name)['execution']
+        status = execution['status']
+        print("Job {}: {} {}".format(job_id, status, execution.get('statusDetails', {}).get('detailsMap', {})))
+        if status in TERMINAL_STATUSES:
+            return status
+        time.sleep(poll_seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Profile a device in the field through an IoT job.")
+    parser.add_argument('--thing_name', required=True, help="Thing to profile.")
+    parser.add_argument('--bucket', required=True, help="Devices bucket the profile is uploaded to.")
+    parser.add_argument('--mode', choices=['sampling', 'cprofile'], default='sampling',
+                        help="Stack sampling of all threads, or cProfile of the sensor loop thread.")
+    parser.add_argument('--duration', type=int, default=60, help="Seconds to profile, capped on the device by profile_max_seconds.")
+    parser.add_argument('--sample_interval_ms', type=int, default=10, help="Stack sampling interval.")
+    parser.add_argument('--trace_memory', action='store_true', help="Add a tracemalloc diff of the profiling window.")
+    parser.add_argument('--url_expiry', type=int, default=3600, help="Seconds the upload URL and the job stay valid.")
+    parser.add_argument('--wait', action='store_true', help="Wait for the job and download the archive.")
+    parser.add_argument('--poll_seconds', type=int, default=10, help="Job status polling interval with --wait.")
+    parser.add_argument('--output', help="Where to save the archive with --wait, defaults to <job id>.tar.gz.")
+    args = parser.parse_args()
+
+    iot = boto3.client('iot')
+    s3 = boto3.client('s3')
+    job_id, key = create_profile_job(iot, s3, args)
+    print("Created job {}, the profile will be uploaded to s3://{}/{}".format(job_id, args.bucket, key))
+
+    if args.wait:
+        status = wait_for_job(iot, job_id, args.thing_name, args.poll_seconds)
+        if status == 'SUCCEEDED':
+            output = args.output or "{}.tar.gz".format(job_id)
+            s3.download_file(args.bucket, key, output)
+            print("Profile saved to {}".format(output))
@@ -325,6 +325,18 @@ class IamStack(Construct):
                         resources=[
                             "arn:aws:iam::{}:role/{}".format(env_params['account_id'], env_params['iot_jobs']['ota_update_role_name'] + "_" + env_params['name'].replace("_", ""))
                         ]
+                    ),
+                    # Read the previous image and write the delta between the two
+                    iam.PolicyStatement(
+                        actions=[
+                            "s3:ListBucket",
+                            "s3:GetObject",
+                            "s3:PutObject"
+                        ],
+                        resources=[
+                            "arn:aws:s3:::{}".format(devices_bucket.bucket_name),
+                            "arn:aws:s3:::{}/firmware_files/*".format(devices_bucket.bucket_name)
+                        ]
                     )
                 ]
         )
@@ -349,6 +361,31 @@ class IamStack(Construct):
             document=thing_firmware_update_lambda_policy_document
         )
         
+        # Policy that is attached to lambda that unbatches multi-reading sensor data messages
+        unbatch_sensordata_lambda_policy_document = iam.PolicyDocument(
+            statements=[
+                iam.PolicyStatement(
+                    actions=[
+                        "iotevents:BatchPutMessage"
+                    ],
+                    resources=[
+                        "arn:aws:iotevents:{}:{}:input/{}".format(env_params['region'], env_params['account_id'], env_params['name'] + env_params['iotevents']['input']['input_name'])
+                    ]
+                ),
+                iam.PolicyStatement(
+                    actions=[
+                        "iotanalytics:BatchPutMessage"
+                    ],
+                    resources=[
+                        "arn:aws:iotanalytics:{}:{}:channel/{}".format(env_params['region'], env_params['account_id'], env_params['name'] + env_params['iotanalytics']['channel']['sensor_data_channel_name'])
+                    ]
+                )
+            ]
+        )
+        unbatch_sensordata_lambda_policy = iam.Policy(self, "UnbatchSensorDataLambdaPolicy",
+            document=unbatch_sensordata_lambda_policy_document
+        )
+        
         # Policy for lambda container that rotates certificates
         rotation_lambda_container_policy_document = iam.PolicyDocument(
             statements=[
@@ -445,6 +482,7 @@ class IamStack(Construct):
         self.ota_update_role= ota_update_role
         self.ota_update_lambda_policy= ota_update_lambda_policy
         self.thing_firmware_update_lambda_policy= thing_firmware_update_lambda_policy
+        self.unbatch_sensordata_lambda_policy= unbatch_sensordata_lambda_policy
         self.rotation_lambda_container_policy= rotation_lambda_container_policy
         self.cert_creation_lambda_container_policy= cert_creation_lambda_container_policy
         self.iot_jitp_template_role= iot_jitp_template_role
@@ -9,6 +9,23 @@ from aws_cdk import (
 from constructs import Construct
 import json
 
+# Custom metrics reported by the device (telemetry_files/metrics.py), names must match the device's registry
+DEVICE_CUSTOM_METRICS = {
+    "publish_ack_ms_p90": "number",
+    "publish_ack_ms_max": "number",
+    "publish_ack_ms_buckets": "number-list",
+    "callback_ms_p90": "number",
+    "callback_ms_max": "number",
+    "callback_ms_buckets": "number-list",
+    "job_duration_ms_p90": "number",
+    "job_duration_ms_max": "number",
+    "job_duration_ms_buckets": "number-list",
+    "publish_failures": "number",
+    "reconnects": "number",
+    "spool_pending_bytes": "number",
+    "spool_dropped_records": "number"
+}
+
 class IotDeviceDefenderStack(Construct):
     def __init__(self, scope: Construct, construct_id: str, 
                     dd_sns_publish_role: iam.Role, 
@@ -48,6 +65,15 @@ class IotDeviceDefenderStack(Construct):
         # Add dependency
         dd_scheduled_audit.node.add_dependency(custom_resource)
         
+        # Create DD Custom Metrics for the device's self-telemetry
+        dd_custom_metrics = []
+        for metric_name, metric_type in DEVICE_CUSTOM_METRICS.items():
+            dd_custom_metrics.append(iot.CfnCustomMetric(self, "DDCustomMetric_" + metric_name,
+                metric_name= metric_name,
+                metric_type= metric_type,
+                display_name= "Sprinkler " + metric_name.replace("_", " ")
+            ))
+        
         # Create DD ML Security Profile
         
         dd_ml_security_profile = iot.CfnSecurityProfile(self, "DDMlSecurityProfile",
@@ -94,6 +120,11 @@ class IotDeviceDefenderStack(Construct):
                     suppress_alerts=False
                 )
             ],
+            # Keep the device's numeric custom metrics for the console and Fleet Hub
+            additional_metrics_to_retain_v2= [
+                iot.CfnSecurityProfile.MetricToRetainProperty(metric= metric_name)
+                for metric_name, metric_type in DEVICE_CUSTOM_METRICS.items() if metric_type == "number"
+            ],
             alert_targets = {
                 "SNS": iot.CfnSecurityProfile.AlertTargetProperty(
                     alert_target_arn=dd_defend_topic.topic_arn,
@@ -113,6 +144,8 @@ class IotDeviceDefenderStack(Construct):
         )
         # Add dependency
         dd_ml_security_profile.node.add_dependency(custom_resource)
+        for dd_custom_metric in dd_custom_metrics:
+            dd_ml_security_profile.node.add_dependency(dd_custom_metric)
         
         # Create DD Mitigation Action
         dd_mitigation_action = iot.CfnMitigationAction(self, "DDMitigationAction",
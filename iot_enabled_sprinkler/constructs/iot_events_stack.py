@@ -7,6 +7,7 @@ from aws_cdk import (
 )
 import aws_cdk as cdk
 from constructs import Construct
+import json
 
 class IotEventsStack(Construct):
     
@@ -36,12 +37,99 @@ class IotEventsStack(Construct):
                     },
                     {
                         "jsonPath":"sensorReportedMoisturePercentage"
+                    },
+                    {
+                        "jsonPath":"sampleCount"
                     }
                 ]
             }
         )
         
         
+        # Build the detector states from the same definition the device uses for local watering decisions
+        with open('device_files/devices/sample_device/detector_model.json', 'r') as f:
+            detector_definition = json.load(f)
+        
+        counter_variable = detector_definition['counter_variable']
+        # Deadband reports stand for several readings, so the counter advances by the reported sample count
+        counter_increment = "$input.{}.{}".format(iot_events_input.input_name, detector_definition['sample_count_attribute'])
+        reading_events = detector_definition['reading_events']
+        sprinkler_topics = {
+            "on": sprinkler_on_topic,
+            "off": sprinkler_off_topic
+        }
+        states_by_name = {state['state_name']: state for state in detector_definition['states']}
+        
+        detector_states = []
+        for state in detector_definition['states']:
+            next_sprinkler_state = states_by_name[state['next_state']]['sprinkler_state']
+            detector_states.append(
+                iotevents.CfnDetectorModel.StateProperty(
+                    state_name=state['state_name'],
+                    on_enter=iotevents.CfnDetectorModel.OnEnterProperty(
+                        events=[
+                            iotevents.CfnDetectorModel.EventProperty(
+                                event_name="InitializeInputValue",
+                                condition="true",
+                                actions=[
+                                    iotevents.CfnDetectorModel.ActionProperty(
+                                        set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
+                                            variable_name=counter_variable,
+                                            value="0"
+                                        )
+                                    )
+                                ]
+                            )
+                        ]
+                    ),
+                    on_input=iotevents.CfnDetectorModel.OnInputProperty(
+                        events=[
+                            iotevents.CfnDetectorModel.EventProperty(
+                                event_name=reading_events[state['count_reading']],
+                                condition='$input.{}.sensorReportedState == "{}"'.format(iot_events_input.input_name, state['count_reading']),
+                                actions=[
+                                    iotevents.CfnDetectorModel.ActionProperty(
+                                        set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
+                                            variable_name=counter_variable,
+                                            value="$variable.{} + {}".format(counter_variable, counter_increment)
+                                        )
+                                    )
+                                ]
+                            ),
+                            iotevents.CfnDetectorModel.EventProperty(
+                                event_name=reading_events[state['reset_reading']],
+                                condition='$input.{}.sensorReportedState == "{}"'.format(iot_events_input.input_name, state['reset_reading']),
+                                actions=[
+                                    iotevents.CfnDetectorModel.ActionProperty(
+                                        set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
+                                            variable_name=counter_variable,
+                                            value="0"
+                                        )
+                                    )
+                                ]
+                            ),
+                        ],
+                        transition_events=[
+                            iotevents.CfnDetectorModel.TransitionEventProperty(
+                                event_name=state['transition_event'],
+                                condition="$variable.{} > {}".format(counter_variable, detector_definition['debounce_threshold']),
+                                next_state=state['next_state'],
+                                actions=[
+                                    iotevents.CfnDetectorModel.ActionProperty(
+                                        sns=iotevents.CfnDetectorModel.SnsProperty(
+                                            target_arn=sprinkler_topics[next_sprinkler_state].topic_arn
+                                        )
+                                    )
+                                ]
+                            )
+                        ]
+                    ),
+                    on_exit=iotevents.CfnDetectorModel.OnExitProperty(
+                        events=[]
+                    )
+                )
+            )
+        
         # Create detector model
         iot_events_detector_model = iotevents.CfnDetectorModel(self, "IotEventsDetectorModel",
             detector_model_name= env_params['name'] + env_params['iotevents']['detector_model']['detector_model_name'],
@@ -50,147 +138,8 @@ class IotEventsStack(Construct):
             evaluation_method= "BATCH",
             key= "deviceID",
             detector_model_definition= iotevents.CfnDetectorModel.DetectorModelDefinitionProperty(
-                initial_state_name="SprinklerOff",
-                states=[
-                    iotevents.CfnDetectorModel.StateProperty(
-                        state_name="SprinklerOff",
-                        on_enter=iotevents.CfnDetectorModel.OnEnterProperty(
-                            events=[
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="InitializeInputValue",
-                                    condition="true",
-                                    actions=[
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="0"
-                                            )
-                                        )
-                                    ]
-                                )
-                            ]
-                        ),
-                        on_input=iotevents.CfnDetectorModel.OnInputProperty(
-                            events=[
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="NormalToError",
-                                    condition='$input.{}.sensorReportedState == "dry"'.format(iot_events_input.input_name),
-                                    actions=[
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="$variable.InputValue + 1"
-                                            )
-                                        )
-                                    ]
-                                ),
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="ErrorToNormal",
-                                    condition='$input.{}.sensorReportedState == "hydrated"'.format(iot_events_input.input_name),
-                                    actions=[
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="0"
-                                            )
-                                        )
-                                    ]
-                                ),
-                            ],
-                            transition_events=[
-                                iotevents.CfnDetectorModel.TransitionEventProperty(
-                                    event_name="OnTransition",
-                                    condition="$variable.InputValue > 4",
-                                    next_state="SprinklerOn",
-                                    actions=[
-                                        # iotevents.CfnDetectorModel.ActionProperty(
-                                        #     lambda_=iotevents.CfnDetectorModel.LambdaProperty(
-                                        #         function_arn=sprinkler_on_lambda.function_arn,
-                                        #     )
-                                        # ),
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            sns=iotevents.CfnDetectorModel.SnsProperty(
-                                                target_arn=sprinkler_on_topic.topic_arn
-                                            )
-                                        )
-                                    ]
-                                )
-                            ]
-                        ),
-                        on_exit=iotevents.CfnDetectorModel.OnExitProperty(
-                            events=[]
-                        )
-                    ),
-                    iotevents.CfnDetectorModel.StateProperty(
-                        state_name="SprinklerOn",
-                        on_enter=iotevents.CfnDetectorModel.OnEnterProperty(
-                            events=[
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="InitializeInputValue",
-                                    condition="true",
-                                    actions= [
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="0"
-                                            )
-                                        )
-                                    ]
-                                )
-                            ]
-                        ),
-                        on_input=iotevents.CfnDetectorModel.OnInputProperty(
-                            events=[
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="ErrorToNormal",
-                                    condition='$input.{}.sensorReportedState == "hydrated"'.format(iot_events_input.input_name),
-                                    actions=[
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="$variable.InputValue + 1"
-                                            )
-                                        )
-                                    ]
-                                ),
-                                iotevents.CfnDetectorModel.EventProperty(
-                                    event_name="NormalToError",
-                                    condition='$input.{}.sensorReportedState == "dry"'.format(iot_events_input.input_name),
-                                    actions=[
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            set_variable=iotevents.CfnDetectorModel.SetVariableProperty(
-                                                variable_name="InputValue",
-                                                value="0"
-                                            )
-                                        )
-                                    ]
-                                ),
-                            ],
-                            transition_events=[
-                                iotevents.CfnDetectorModel.TransitionEventProperty(
-                                    event_name="OffTransition",
-                                    condition="$variable.InputValue > 4",
-                                    next_state="SprinklerOff",
-                                    actions=[
-                                        # iotevents.CfnDetectorModel.ActionProperty(
-                                        #     lambda_=iotevents.CfnDetectorModel.LambdaProperty(
-                                        #         function_arn=sprinkler_off_lambda.function_arn,
-                                        #     )
-                                        # ),
-                                        iotevents.CfnDetectorModel.ActionProperty(
-                                            sns=iotevents.CfnDetectorModel.SnsProperty(
-                                                target_arn=sprinkler_off_topic.topic_arn
-                                            )
-                                        )
-                                    ]
-                                )
-                            ],
-                        ),
-                        on_exit=iotevents.CfnDetectorModel.OnExitProperty(
-                            events=[]
-                        )
-                    )
-                ]
+                initial_state_name=detector_definition['initial_state'],
+                states=detector_states
             )
         )
         # Add dependency
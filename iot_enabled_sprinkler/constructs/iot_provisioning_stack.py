@@ -43,10 +43,12 @@ class IotProvisioningStack(Construct):
                     ],
                     "Resource": [
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/sensordata/*",
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/diagnostics/*",
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/defender/metrics/json",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/shadow/update",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/shadow/get",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/certificate/rotation/complete",
-                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/customCa/certificate/create/initiate",
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/customCa/certificate/create/initiate"
                     ]
                 },
                 {
@@ -57,6 +59,7 @@ class IotProvisioningStack(Construct):
                     "Resource": [
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/${iot:Connection.Thing.ThingName}/shadow/update/delta",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/${iot:Connection.Thing.ThingName}/shadow/get/accepted",
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/${iot:Connection.Thing.ThingName}/shadow/get/rejected",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/${iot:Connection.Thing.ThingName}/customCa/certificate/create/complete"
                     ]
                 },
@@ -68,12 +71,55 @@ class IotProvisioningStack(Construct):
                     "Resource": [
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/shadow/update/delta",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/shadow/get/accepted",
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}/shadow/get/rejected",
                         "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}/customCa/certificate/create/complete"
                     ]
                 }
             ]
         }
         
+        # Certificate rotation over the device's own connection (rotate_over_device_connection in
+        # parameters.json) needs CreateKeysAndCertificate and the rotation template's RegisterThing.
+        # Only the JSON request and response topics of that template are allowed, never the claim
+        # provisioning template, and none at all when rotation uses a claim certificate session.
+        if env_params['template']['rotate_over_device_connection']:
+            rotation_topics = [
+                "$aws/certificates/create/json",
+                "$aws/provisioning-templates/" + env_params['name'] + env_params['template']['rotation_template_name'] + "/provision/json"
+            ]
+            group_policy_document["Statement"] += [
+                {
+                    "Effect": "Allow",
+                    "Action": [
+                        "iot:Publish"
+                    ],
+                    "Resource": [
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/" + topic
+                        for topic in rotation_topics
+                    ]
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": [
+                        "iot:Subscribe"
+                    ],
+                    "Resource": [
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/" + topic + "/" + result
+                        for topic in rotation_topics for result in ("accepted", "rejected")
+                    ]
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": [
+                        "iot:Receive"
+                    ],
+                    "Resource": [
+                        "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/" + topic + "/" + result
+                        for topic in rotation_topics for result in ("accepted", "rejected")
+                    ]
+                }
+            ]
+        
         # Create Thing Policy
         group_policy = iot.CfnPolicy(self, "GroupPolicy",
             policy_document=group_policy_document,
@@ -216,10 +262,62 @@ class IotProvisioningStack(Construct):
             policy_name= env_params['name'] + env_params['group_policy']['iot_jobs_policy_name']
         )
         
+        # Policy for gateways (iot_gateway.py) that drive zone things named <gateway>_<zone> over one connection.
+        # The wildcard subscriptions are allowed, but only messages of the gateway's own zones are received.
+        gateway_zone_topic = "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/$aws/things/${iot:Connection.Thing.ThingName}_*"
+        gateway_policy_document = {
+          "Version": "2012-10-17",
+          "Statement": [
+            {
+              "Effect": "Allow",
+              "Action": [
+                "iot:Publish"
+              ],
+              "Resource": [
+                "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topic/${iot:Connection.Thing.ThingName}_*/sensordata/*",
+                gateway_zone_topic + "/shadow/update",
+                gateway_zone_topic + "/shadow/get",
+                gateway_zone_topic + "/jobs/start-next",
+                gateway_zone_topic + "/jobs/*/update"
+              ]
+            },
+            {
+              "Effect": "Allow",
+              "Action": [
+                "iot:Subscribe"
+              ],
+              "Resource": [
+                "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/+/shadow/update/delta",
+                "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/+/shadow/get/accepted",
+                "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/+/jobs/notify-next",
+                "arn:aws:iot:" + env_params['region'] + ":" + env_params['account_id'] + ":topicfilter/$aws/things/+/jobs/start-next/accepted"
+              ]
+            },
+            {
+              "Effect": "Allow",
+              "Action": [
+                "iot:Receive"
+              ],
+              "Resource": [
+                gateway_zone_topic + "/shadow/update/delta",
+                gateway_zone_topic + "/shadow/get/accepted",
+                gateway_zone_topic + "/jobs/notify-next",
+                gateway_zone_topic + "/jobs/start-next/accepted"
+              ]
+            }
+          ]
+        }
+        # Create Gateway Policy, attached to gateway certificates by hand (see README)
+        gateway_policy = iot.CfnPolicy(self, "GatewayPolicy",
+            policy_document=gateway_policy_document,
+            policy_name= env_params['name'] + env_params['group_policy']['gateway_policy_name']
+        )
+        
         self.provisioning_template= provisioning_template
         self.claim_policy= claim_policy
         self.group_policy= group_policy
         self.quarantine_group_policy= quarantine_group_policy
         self.certificate_rotation_template= certificate_rotation_template
         self.iot_jobs_policy= iot_jobs_policy
+        self.gateway_policy= gateway_policy
         
\ No newline at end of file
@@ -20,6 +20,7 @@ class IotRulesEngineStack(Construct):
                 cert_rotation_complete_lambda: _lambda.Function,
                 thing_firmware_update_lambda: _lambda.Function,
                 device_cert_rotation_container: _lambda.Function,
+                unbatch_sensordata_lambda: _lambda.Function,
                 env_params: dict, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
         
@@ -43,6 +44,44 @@ class IotRulesEngineStack(Construct):
         # Add dependency
         soil_moisture_events_sensordata_rule.node.add_dependency(iot_events_input)
         
+        # Batched readings are expanded by a Lambda that feeds both IoT Events and IoT Analytics
+        soil_moisture_batch_sensordata_rule = iot.CfnTopicRule(self, "SoilMoistureBatchSensorData",
+            rule_name= env_params['name'] + env_params['iot_rules_engine']['soil_moisture_batch_sensordata_rule_name'],
+            topic_rule_payload= iot.CfnTopicRule.TopicRulePayloadProperty(
+                sql= "SELECT * FROM '+/sensordata/soil_moisture/batch'",
+                aws_iot_sql_version="2016-03-23",
+                actions= [
+                    iot.CfnTopicRule.ActionProperty(
+                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                            function_arn= unbatch_sensordata_lambda.function_arn
+                        )
+                    )
+                ],
+                rule_disabled= False
+            )
+        )
+        # Add dependency
+        soil_moisture_batch_sensordata_rule.node.add_dependency(unbatch_sensordata_lambda)
+        
+        # Binary encoded readings are passed to the same Lambda as base64, with the device ID taken from the topic
+        soil_moisture_binary_sensordata_rule = iot.CfnTopicRule(self, "SoilMoistureBinarySensorData",
+            rule_name= env_params['name'] + env_params['iot_rules_engine']['soil_moisture_binary_sensordata_rule_name'],
+            topic_rule_payload= iot.CfnTopicRule.TopicRulePayloadProperty(
+                sql= "SELECT encode(*, 'base64') AS data, topic(1) AS deviceID FROM '+/sensordata/soil_moisture/bin'",
+                aws_iot_sql_version="2016-03-23",
+                actions= [
+                    iot.CfnTopicRule.ActionProperty(
+                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                            function_arn= unbatch_sensordata_lambda.function_arn
+                        )
+                    )
+                ],
+                rule_disabled= False
+            )
+        )
+        # Add dependency
+        soil_moisture_binary_sensordata_rule.node.add_dependency(unbatch_sensordata_lambda)
+        
         soil_moisture_analytics_sensordata_rule= iot.CfnTopicRule(self, "SoilMoistureAnalyticsSensorData",
             rule_name= env_params['name'] + env_params['iot_rules_engine']['soil_moisture_analytics_sensordata_rule_name'],
             topic_rule_payload= iot.CfnTopicRule.TopicRulePayloadProperty(
@@ -6,6 +6,7 @@ from aws_cdk import (
     aws_sqs as sqs,
     aws_s3_notifications as s3_notify,
     RemovalPolicy,
+    Duration,
     aws_cloudformation as cloudformation
 )
 from constructs import Construct
@@ -21,6 +22,7 @@ class LambdaStack(Construct):
                 ota_update_role: iam.Role,
                 devices_bucket: s3.Bucket,
                 thing_firmware_update_lambda_policy: iam.Policy,
+                unbatch_sensordata_lambda_policy: iam.Policy,
                 **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
         
@@ -128,10 +130,15 @@ class LambdaStack(Construct):
             runtime=_lambda.Runtime.PYTHON_3_9,
             code=_lambda.Code.from_asset('lambda/ota_update'),
             handler='lambda_function.lambda_handler',
+            # Building the delta from the previous image reads both images into memory
+            timeout=Duration.minutes(5),
+            memory_size=1024,
             environment= {
                 "SIGNER_PROFILE_NAME":  env_params['name'] + env_params['iot_jobs']['signer_profile_name'],
                 "DEVICES_GROUP_ARN": "arn:aws:iot:{}:{}:thinggroup/{}".format(env_params['region'], env_params['account_id'], env_params['name'] + env_params['static_thing_group']['group_name']),
-                "ROLE_ARN": ota_update_role.role_arn
+                "ROLE_ARN": ota_update_role.role_arn,
+                "DELTA_ENABLED": str(env_params['iot_jobs']['ota_delta_enabled']).lower(),
+                "DELTA_MAX_RATIO": str(env_params['iot_jobs']['ota_delta_max_ratio'])
             }
         )
         ota_update_lambda.role.attach_inline_policy(ota_update_lambda_policy)
@@ -153,6 +160,23 @@ class LambdaStack(Construct):
         thing_firmware_update_lambda.role.attach_inline_policy(thing_firmware_update_lambda_policy)
         thing_firmware_update_lambda.grant_invoke(iam.ServicePrincipal('iot.amazonaws.com'))
         
+        # Lambda that expands batched and binary encoded soil moisture messages for IoT Events and IoT Analytics
+        unbatch_sensordata_lambda = _lambda.Function(self, 'UnbatchSensorDataLambda',
+            description= "Decodes and unbatches soil moisture messages into IoT Events and IoT Analytics",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            code=_lambda.Code.from_asset('lambda/unbatch_sensordata'),
+            handler='lambda_function.lambda_handler',
+            # A 128 KB binary batch holds about 16000 readings, sent to IoT Events 10 per call.
+            # A timeout halfway through would make the rule retry and replay counted readings.
+            timeout=Duration.minutes(2),
+            environment= {
+                "INPUT_NAME": env_params['name'] + env_params['iotevents']['input']['input_name'],
+                "CHANNEL_NAME": env_params['name'] + env_params['iotanalytics']['channel']['sensor_data_channel_name']
+            }
+        )
+        unbatch_sensordata_lambda.role.attach_inline_policy(unbatch_sensordata_lambda_policy)
+        unbatch_sensordata_lambda.grant_invoke(iam.ServicePrincipal('iot.amazonaws.com'))
+        
         self.pre_provisioning_lambda= pre_provisioning_lambda
         self.sprinkler_off_lambda= sprinkler_off_lambda
         self.sprinkler_on_lambda= sprinkler_on_lambda
@@ -160,4 +184,5 @@ class LambdaStack(Construct):
         self.cert_rotation_initiate_lambda= cert_rotation_initiate_lambda
         self.cert_rotation_complete_lambda= cert_rotation_complete_lambda
         self.thing_firmware_update_lambda= thing_firmware_update_lambda
-        self.ota_update_lambda= ota_update_lambda
\ No newline at end of file
+        self.ota_update_lambda= ota_update_lambda
+        self.unbatch_sensordata_lambda= unbatch_sensordata_lambda
\ No newline at end of file
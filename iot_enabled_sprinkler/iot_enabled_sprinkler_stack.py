@@ -44,7 +44,8 @@ class IotEnabledSprinklerStack(Stack):
             ota_update_lambda_policy= iam_stack.ota_update_lambda_policy,
             ota_update_role= iam_stack.ota_update_role,
             devices_bucket= s3_stack.devices_bucket,
-            thing_firmware_update_lambda_policy= iam_stack.thing_firmware_update_lambda_policy
+            thing_firmware_update_lambda_policy= iam_stack.thing_firmware_update_lambda_policy,
+            unbatch_sensordata_lambda_policy= iam_stack.unbatch_sensordata_lambda_policy
         )
         
         lambda_container_stack= LambdaContainerStack(
@@ -92,7 +93,8 @@ class IotEnabledSprinklerStack(Stack):
             sprinkler_on_channel= iot_analytics_stack.sprinkler_on_channel,
             cert_rotation_complete_lambda= lambda_stack.cert_rotation_complete_lambda,
             thing_firmware_update_lambda= lambda_stack.thing_firmware_update_lambda,
-            device_cert_rotation_container= lambda_container_stack.device_cert_rotation_container
+            device_cert_rotation_container= lambda_container_stack.device_cert_rotation_container,
+            unbatch_sensordata_lambda= lambda_stack.unbatch_sensordata_lambda
         )
         
         iot_jobs_stack= IotJobsStack(
@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Binary delta between two firmware images, applied on the device by
+ota_files/firmware_delta.py. The patch format must match on both sides.
+
+Patch layout:
+    | magic "IESD" | format version (1 byte) | base size (8 bytes) | target size (8 bytes) |
+    | base SHA-256 (32 bytes) | target SHA-256 (32 bytes) | zlib stream of operations |
+Operations:
+    | "C" | base offset (8 bytes) | length (4 bytes) |   copy bytes from the base image
+    | "I" | length (4 bytes) | data |                   insert new bytes
+    | "E" |                                             end of patch
+
+Matching works like rsync: the base image is indexed by a rolling checksum of
+fixed-size blocks, the target is scanned one byte at a time, and every block
+found in the base is extended as far as the bytes keep matching. Zip entries
+that did not change between releases are found even when they moved.
+'''
+
+
+import hashlib
+import struct
+import zlib
+
+MAGIC = b'IESD'
+FORMAT_VERSION = 1
+HEADER_FORMAT = struct.Struct('>4sBQQ32s32s')
+COPY_FORMAT = struct.Struct('>QI')
+INSERT_FORMAT = struct.Struct('>I')
+OP_COPY, OP_INSERT, OP_END = b'C', b'I', b'E'
+MAX_INSERT_BYTES = 1048576
+CHECKSUM_MODULUS = 1 << 16
+
+
+def rolling_checksum(data):
+    a = sum(data) % CHECKSUM_MODULUS
+    b = sum((len(data) - i) * byte for i, byte in enumerate(data)) % CHECKSUM_MODULUS
+    return a, b
+
+
+def index_blocks(base, block_bytes):
+    index = {}
+    for offset in range(0, len(base) - block_bytes + 1, block_bytes):
+        a, b = rolling_checksum(base[offset:offset + block_bytes])
+        index.setdefault(a | (b << 16), []).append(offset)
+    return index
+
+
+def match_length(base, base_offset, target, target_offset, block_bytes):
+    # Extend a match by whole blocks while they are equal, then byte by byte
+    length = 0
+    while (target_offset + length + block_bytes <= len(target) and base_offset + length + block_bytes <= len(base) and
+           target[target_offset + length:target_offset + length + block_bytes] ==
+           base[base_offset + length:base_offset + length + block_bytes]):
+        length += block_bytes
+    while (target_offset + length < len(target) and base_offset + length < len(base) and
+           target[target_offset + length] == base[base_offset + length]):
+        length += 1
+    return length
+
+
+def diff(base, target, block_bytes=4096):
+    # Yields ("copy", offset, length) and ("insert", start, end) operations that rebuild target from base
+    index = index_blocks(base, block_bytes)
+    literal_start = 0
+    position = 0
+    a, b = rolling_checksum(target[0:block_bytes]) if len(target) >= block_bytes else (0, 0)
+    while position + block_bytes <= len(target):
+        match = None
+        for offset in index.get(a | (b << 16), ()):
+            if base[offset:offset + block_bytes] == target[position:position + block_bytes]:
+                match = offset
+                break
+        if match is not None:
+            length = match_length(base, match, target, position, block_bytes)
+            if literal_start < position:
+                yield ("insert", literal_start, position)
+            yield ("copy", match, length)
+            position += length
+            literal_start = position
+            if position + block_bytes <= len(target):
+                a, b = rolling_checksum(target[position:position + block_bytes])
+            continue
+        if position + block_bytes < len(target):
+            removed, added = target[position], target[position + block_bytes]
+            a = (a - removed + added) % CHECKSUM_MODULUS
+            b = (b - block_bytes * removed + a) % CHECKSUM_MODULUS
+        position += 1
+    if literal_start < len(target):
+        yield ("insert", literal_start, len(target))
+
+
+def create_patch(base_path, target_path, patch_path, block_bytes=4096):
+    # Returns the size of the patch in bytes
+    with open(base_path, 'rb') as f:
+        base = f.read()
+    with open(target_path, 'rb') as f:
+        target = f.read()
+
+    compressor = zlib.compressobj(9)
+    with open(patch_path, 'wb') as patch:
+        patch.write(HEADER_FORMAT.pack(MAGIC, FORMAT_VERSION, len(base), len(target),
+                                       hashlib.sha256(base).digest(), hashlib.sha256(target).digest()))
+        for operation, first, second in diff(base, target, block_bytes):
+            if operation == "copy":
+                patch.write(compressor.compress(OP_COPY + COPY_FORMAT.pack(first, second)))
+                continue
+            for start in range(first, second, MAX_INSERT_BYTES):
+                data = target[start:min(second, start + MAX_INSERT_BYTES)]
+                patch.write(compressor.compress(OP_INSERT + INSERT_FORMAT.pack(len(data))))
+                patch.write(compressor.compress(data))
+        patch.write(compressor.compress(OP_END))
+        patch.write(compressor.flush())
+        return patch.tell()
@@ -6,14 +6,59 @@ import json
 import boto3
 from uuid import uuid4
 import os
+import re
+from firmware_delta import create_patch
 
 iot = boto3.client('iot')
+s3 = boto3.client('s3')
+
+FIRMWARE_PREFIX = "firmware_files/firmware_v"
+DELTA_PREFIX = "firmware_files/deltas/"
+
+def version_key(key):
+    # "firmware_files/firmware_v13.3.4.zip" -> (13, 3, 4), None for other names
+    match = re.search(r'firmware_v([0-9.]+)\.zip$', key)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.group(1).strip('.').split('.') if part)
+
+def previous_firmware_key(bucket, key):
+    # Highest version below the uploaded one, the version devices are most likely running
+    current = version_key(key)
+    previous = None
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=FIRMWARE_PREFIX):
+        for item in page.get('Contents', []):
+            candidate = version_key(item['Key'])
+            if candidate is not None and candidate < current and (previous is None or candidate > version_key(previous)):
+                previous = item['Key']
+    return previous
+
+def create_delta_file(bucket, previous_key, key, max_ratio, block_bytes):
+    # Uploads firmware_v<old>_to_v<new>.patch next to the images, None if a delta would not pay off
+    base_path = '/tmp/base.zip' # nosec
+    target_path = '/tmp/target.zip' # nosec
+    patch_path = '/tmp/firmware.patch' # nosec
+    s3.download_file(bucket, previous_key, base_path)
+    s3.download_file(bucket, key, target_path)
+    patch_size = create_patch(base_path, target_path, patch_path, block_bytes)
+    target_size = os.path.getsize(target_path)
+    print("Delta from {} is {} bytes, full image is {} bytes".format(previous_key, patch_size, target_size))
+    if patch_size > target_size * max_ratio:
+        return None
+    patchName = "firmware_v{}_to_v{}.patch".format(
+        previous_key.split('firmware_v')[-1].replace('.zip', ''), key.split('firmware_v')[-1].replace('.zip', ''))
+    with open(patch_path, 'rb') as f:
+        response = s3.put_object(Bucket=bucket, Key=DELTA_PREFIX + patchName, Body=f)
+    return patchName, response['VersionId']
 
 def lambda_handler(event, context):
     
     DEVICES_GROUP_ARN= os.environ.get('DEVICES_GROUP_ARN')
     ROLE_ARN= os.environ.get('ROLE_ARN')
     SIGNER_PROFILE_NAME= os.environ.get('SIGNER_PROFILE_NAME')
+    DELTA_ENABLED= os.environ.get('DELTA_ENABLED', 'true') == 'true'
+    DELTA_MAX_RATIO= float(os.environ.get('DELTA_MAX_RATIO', '0.5'))
+    DELTA_BLOCK_BYTES= int(os.environ.get('DELTA_BLOCK_BYTES', '4096'))
     
     for record in event['Records']:
         key= record['s3']['object']['key']
@@ -26,6 +71,50 @@ def lambda_handler(event, context):
         otaUpdateId= 'IotEnabledSprinklers_OTA_UPDATE_'+str(uuid4())[:8]
         print("OTA UPDATE ID: "+ otaUpdateId)
         
+        # The full image stays the first file, update_thing_firmware_version reads the version from it
+        codeSigning= {
+            "startSigningJobParameter":{
+                "signingProfileName": SIGNER_PROFILE_NAME,
+                "destination": {
+                    "s3Destination": {
+                        "bucket": bucket,
+                        "prefix": folder+"SignedImages/"
+                    }
+                }
+            }
+        }
+        files= [
+            {
+                "fileName": fileName,
+                "fileLocation": {
+                    "s3Location": {
+                        "bucket": bucket,
+                        "key": key,
+                        "version": version
+                    }
+                },
+                "codeSigning": codeSigning
+            }
+        ]
+        
+        # Devices on the previous version download only the delta and rebuild the full image
+        previousKey= previous_firmware_key(bucket, key) if DELTA_ENABLED else None
+        delta= create_delta_file(bucket, previousKey, key, DELTA_MAX_RATIO, DELTA_BLOCK_BYTES) if previousKey else None
+        if delta:
+            patchName, patchVersion= delta
+            print("Adding delta file: "+ patchName)
+            files.append({
+                "fileName": patchName,
+                "fileLocation": {
+                    "s3Location": {
+                        "bucket": bucket,
+                        "key": DELTA_PREFIX + patchName,
+                        "version": patchVersion
+                    }
+                },
+                "codeSigning": codeSigning
+            })
+        
         response = iot.create_ota_update(
             otaUpdateId= otaUpdateId,
             description='IotEnabledSprinklers Firmware Update IoT Job',
@@ -39,28 +128,7 @@ def lambda_handler(event, context):
             awsJobPresignedUrlConfig={
                 'expiresInSec': 3600
             },
-            files=[
-              {
-                "fileLocation": {
-                  "s3Location": {
-                    "bucket": bucket,
-                    "key": key,
-                    "version": version
-                  }
-                },
-                "codeSigning":{
-                  "startSigningJobParameter":{
-                    "signingProfileName": SIGNER_PROFILE_NAME,
-                    "destination": {
-                      "s3Destination": {
-                        "bucket": bucket,
-                        "prefix": folder+"SignedImages/"
-                      }
-                    }
-                  }
-                }  
-              }
-            ],
+            files= files,
             roleArn= ROLE_ARN
         )  
         print()
@@ -0,0 +1,149 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+SAMPLE EVENT
+{
+    "sensorType": "SoilMoistureSensor",
+    "deviceID": "AWS_9875",
+    "readings": [
+        [1700000000000, 31, "hydrated", 1],
+        [1700000002000, 27, "dry", 1]
+    ]
+}
+
+SAMPLE EVENT (gateways batching several zones on '+/sensordata/soil_moisture/batch')
+{
+    "sensorType": "SoilMoistureSensor",
+    "deviceID": "AWS_9875",
+    "devices": [
+        {"deviceID": "AWS_9875_zone1", "readings": [[1700000000000, 31, "hydrated", 1]]},
+        {"deviceID": "AWS_9875_zone2", "readings": [[1700000000000, 27, "dry", 1]]}
+    ]
+}
+
+SAMPLE EVENT (binary payloads from '+/sensordata/soil_moisture/bin')
+{
+    "deviceID": "AWS_9875",
+    "data": "<base64 encoded payload>"
+}
+
+WHAT IT DOES:
+1. Receives a batched soil moisture message from the '+/sensordata/soil_moisture/batch' rule,
+   or a binary encoded message from the '+/sensordata/soil_moisture/bin' rule which is decoded first
+2. Expands it into one message per reading, per zone for gateway messages, in the same format as '+/sensordata/soil_moisture'
+3. Sends each device's readings to the IoT Events input in order, up to 10 per call,
+   so the detector model debounce counter sees the same sequence as unbatched devices
+4. Sends the readings to the IoT Analytics sensor data channel in a single call
+'''
+
+
+import json
+import boto3
+import os
+import base64
+import struct
+import time
+from datetime import datetime, timezone
+
+iot_events_data = boto3.client('iotevents-data')
+iot_analytics = boto3.client('iotanalytics')
+
+# IoT Analytics BatchPutMessage accepts at most 100 messages per call
+ANALYTICS_BATCH_SIZE = 100
+# IoT Events BatchPutMessage accepts at most 10 messages per call
+EVENTS_BATCH_SIZE = 10
+
+# Binary wire format, must match telemetry_files/encoding.py on the device
+SCHEMA_READING = 1
+SCHEMA_BATCH = 2
+READING_FORMAT = struct.Struct('>BBbH')
+BATCH_HEADER_FORMAT = struct.Struct('>BHq')
+BATCH_ROW_FORMAT = struct.Struct('>IBbH')
+STATES = ["hydrated", "dry"]
+
+def decode_payload(data):
+    # Returns the readings of a binary payload as [timestamp_ms, percentage, state, sampleCount] rows
+    version = data[0]
+    if version == SCHEMA_READING:
+        _, state, moisturePercentage, sampleCount = READING_FORMAT.unpack_from(data)
+        return [[int(time.time() * 1000), moisturePercentage, STATES[state], sampleCount]]
+    if version == SCHEMA_BATCH:
+        _, count, baseTimestamp = BATCH_HEADER_FORMAT.unpack_from(data)
+        readings= []
+        for i in range(count):
+            offset, state, moisturePercentage, sampleCount = BATCH_ROW_FORMAT.unpack_from(
+                data, BATCH_HEADER_FORMAT.size + i * BATCH_ROW_FORMAT.size)
+            readings.append([baseTimestamp + offset, moisturePercentage, STATES[state], sampleCount])
+        return readings
+    raise ValueError("Unknown sensor data schema version {}".format(version))
+
+def unbatch_device(deviceID, sensorType, readings, inputName):
+    # Sends one device's readings to IoT Events in order, returns its IoT Analytics messages
+    eventsMessages= []
+    analyticsMessages= []
+    for reading in sorted(readings, key=lambda reading: reading[0]):
+        timestamp, moisturePercentage, state = reading[:3]
+        message= {
+            "sensorType": sensorType,
+            "deviceID": deviceID,
+            "sensorReportedState": state,
+            "sensorReportedMoisturePercentage": moisturePercentage,
+            "sampleCount": reading[3] if len(reading) > 3 else 1
+        }
+        messageId= "{}-{}".format(deviceID, timestamp)
+
+        eventsMessages.append({
+            'messageId': messageId,
+            'inputName': inputName,
+            'payload': json.dumps(message).encode('utf-8'),
+            'timestamp': {
+                'timeInMillis': timestamp
+            }
+        })
+
+        # Same RealTime format as the SoilMoistureAnalyticsSensorData rule, but from the reading's own timestamp
+        message['RealTime']= datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+0000'
+        analyticsMessages.append({
+            'messageId': messageId,
+            'payload': json.dumps(message).encode('utf-8')
+        })
+
+    # Oldest readings first, each call carries the next readings in timestamp order
+    for i in range(0, len(eventsMessages), EVENTS_BATCH_SIZE):
+        response = iot_events_data.batch_put_message(messages=eventsMessages[i:i + EVENTS_BATCH_SIZE])
+        if response['BatchPutMessageErrorEntries']:
+            print(response['BatchPutMessageErrorEntries'])
+    return analyticsMessages
+
+def lambda_handler(event, context):
+
+    INPUT_NAME= os.environ.get('INPUT_NAME')
+    CHANNEL_NAME= os.environ.get('CHANNEL_NAME')
+
+    deviceID= event['deviceID']
+    if 'data' in event:
+        event['sensorType']= "SoilMoistureSensor"
+        event['readings']= decode_payload(base64.b64decode(event['data']))
+    # Gateway messages carry the readings of each zone, other devices only their own
+    devices= event.get('devices', [{"deviceID": deviceID, "readings": event.get('readings', [])}])
+
+    analyticsMessages= []
+    for device in devices:
+        analyticsMessages.extend(unbatch_device(device['deviceID'], event['sensorType'], device['readings'], INPUT_NAME))
+
+    for i in range(0, len(analyticsMessages), ANALYTICS_BATCH_SIZE):
+        response = iot_analytics.batch_put_message(
+            channelName= CHANNEL_NAME,
+            messages= analyticsMessages[i:i + ANALYTICS_BATCH_SIZE]
+        )
+        if response['batchPutMessageErrorEntries']:
+            print(response['batchPutMessageErrorEntries'])
+
+    print("Unbatched {} readings for {} devices from {}".format(len(analyticsMessages), len(devices), deviceID))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Unbatched {} readings'.format(len(analyticsMessages)))
+    }
@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Microbenchmark of the device's per-reading publish path.
+
+WHAT IT DOES:
+1. Runs the payload and log line of a JSON reading the way publish() used to
+   build them (a dict per reading, json.dumps twice, string concatenation)
+   and the way it builds them now (ReadingPayloadCache)
+2. Runs both with the spool append, against a spool in a temporary folder
+3. Prints CPU microseconds per publish, and the peak bytes allocated during
+   a publish, measured with tracemalloc in a separate pass
+
+Log lines are written to a discarded stream, so terminal speed does not count.
+
+Usage (from the project root):
+    python3 local_test_bed/bench_publish.py --count 20000
+'''
+
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join('device_files', 'devices', 'sample_device'))
+from telemetry_files.encoding import json_reading_encoder, ReadingPayloadCache
+from telemetry_files.spool import TelemetrySpool
+
+DEVICE_NAME = "sample_device"
+TOPIC = "{}/sensordata/soil_moisture".format(DEVICE_NAME)
+
+
+def readings(count):
+    # Same shape as simulated_sensor_readings(), a sweep between dry and hydrated
+    sweep = list(range(100, -1, -1)) + list(range(0, 101))
+    return [(sweep[i % len(sweep)], "dry" if sweep[i % len(sweep)] <= 30 else "hydrated") for i in range(count)]
+
+
+def previous_publish(append, log_readings):
+    def publish(percentage, state):
+        message = {
+            "sensorType": "SoilMoistureSensor",
+            "deviceID": DEVICE_NAME,
+            "sensorReportedState": state,
+            "sensorReportedMoisturePercentage": percentage,
+            "sampleCount": 1,
+        }
+        append(TOPIC, json.dumps(message))
+        if log_readings:
+            print("\n=========> Spooled: '" + json.dumps(message) + "' for the topic: '" + TOPIC + "'")
+    return publish
+
+
+def current_publish(append, log_readings):
+    json_readings = ReadingPayloadCache(json_reading_encoder("SoilMoistureSensor", DEVICE_NAME))
+
+    def publish(percentage, state):
+        payload = json_readings.encode(state, percentage, 1)
+        append(TOPIC, payload)
+        if log_readings:
+            print("\n=========> Spooled: '{}' for the topic: '{}'".format(payload.decode('utf-8'), TOPIC))
+    return publish
+
+
+def measure(publish, samples):
+    # The first sweep fills the payload cache, as on a running device
+    for percentage, state in samples[:202]:
+        publish(percentage, state)
+    cpu_started = time.process_time()
+    for percentage, state in samples:
+        publish(percentage, state)
+    cpu_us = (time.process_time() - cpu_started) * 1e6 / len(samples)
+
+    # Peak of the memory allocated during each call, in a separate pass since tracing slows it down
+    traced = samples[:2000]
+    allocated_bytes = 0
+    tracemalloc.start()
+    for percentage, state in traced:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        publish(percentage, state)
+        allocated_bytes += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return cpu_us, allocated_bytes / len(traced)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-publish CPU and allocations of the device publish path.")
+    parser.add_argument('--count', type=int, default=20000, help="Readings per run.")
+    parser.add_argument('--no_log', action='store_true', help="Run with log_readings off.")
+    args = parser.parse_args()
+
+    samples = readings(args.count)
+    log_readings = not args.no_log
+    print("{:<30} {:>12} {:>18}".format("publish path", "CPU us/call", "peak bytes/call"))
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool = TelemetrySpool(spool_dir, max_bytes=1048576)
+        runs = [
+            ("previous, payload only", previous_publish(lambda topic, payload: None, log_readings)),
+            ("current, payload only", current_publish(lambda topic, payload: None, log_readings)),
+            ("previous, with spool", previous_publish(spool.append, log_readings)),
+            ("current, with spool", current_publish(spool.append, log_readings)),
+        ]
+        for name, publish in runs:
+            with open(os.devnull, 'w') as discarded, redirect_stdout(discarded):
+                cpu_us, allocated_bytes = measure(publish, samples)
+            print("{:<30} {:>12.2f} {:>18.0f}".format(name, cpu_us, allocated_bytes))
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Local stand-in for the S3 presigned firmware URL of an OTA job.
+
+WHAT IT DOES:
+1. Serves the files of a directory over HTTP, with single "bytes=<start>-" and
+   "bytes=<start>-<end>" Range requests answered with 206 Partial Content
+2. With --drop_after_bytes, closes every response after that many bytes, to
+   emulate a flaky link and exercise the device's resumable download
+3. Prints the size and SHA-256 of each file at startup, for the job document
+'''
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+import argparse
+import hashlib
+import os
+import re
+
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d*)$')
+CHUNK_BYTES = 65536
+
+
+def make_firmware_handler(directory, drop_after_bytes):
+    class FirmwareHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Query strings stand in for the presigned URL signature and are ignored
+            path = os.path.join(directory, os.path.basename(unquote(urlparse(self.path).path)))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            remaining = end - start + 1
+            budget = drop_after_bytes or remaining
+            with open(path, 'rb') as f:
+                f.seek(start)
+                while remaining > 0 and budget > 0:
+                    chunk = f.read(min(CHUNK_BYTES, remaining, budget))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    budget -= len(chunk)
+            if remaining:
+                print("Dropped {} after {} bytes".format(os.path.basename(path), end - start + 1 - remaining))
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            return
+
+    return FirmwareHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local HTTP server for OTA firmware images, with Range support.")
+    parser.add_argument('--directory', required=True, help="Directory with the firmware images.")
+    parser.add_argument('--host', default='localhost', help="Interface to listen on.")
+    parser.add_argument('--port', type=int, default=8090, help="HTTP port.")
+    parser.add_argument('--drop_after_bytes', type=int, default=0,
+                        help="Close every response after this many bytes. 0 sends complete responses.")
+    args = parser.parse_args()
+
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        if os.path.isfile(path):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                    digest.update(chunk)
+            print("http://{}:{}/{} filesize: {} sha256: {}".format(
+                args.host, args.port, name, os.path.getsize(path), digest.hexdigest()))
+
+    server = ThreadingHTTPServer((args.host, args.port), make_firmware_handler(args.directory, args.drop_after_bytes))
+    print("Firmware server listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Firmware server stopped")
@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Runs a Lambda handler from the lambda/ folder locally, with its iot-data calls
+pointed at local_broker.py.
+
+Usage (from the project root, with local_broker.py running):
+    python3 local_test_bed/invoke_lambda.py --function iot_enabled_sprinkler_publish_on \
+        --event local_test_bed/events/detector_event.json
+'''
+
+
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+parser = argparse.ArgumentParser(description="Invoke a project Lambda handler against the local broker.")
+parser.add_argument('--function', required=True, help="Folder name under lambda/, e.g. iot_enabled_sprinkler_publish_on")
+parser.add_argument('--event', required=True, help="Path to the JSON event to invoke the handler with.")
+parser.add_argument('--iot_data_url', default='http://localhost:8080', help="URL of the local iot-data API.")
+args = parser.parse_args()
+
+# boto3 picks these up when the handler module creates its clients
+os.environ['AWS_ENDPOINT_URL_IOT_DATA'] = args.iot_data_url
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'local')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'local')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+spec = importlib.util.spec_from_file_location(
+    'lambda_function', os.path.join('lambda', args.function, 'lambda_function.py'))
+lambda_function = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(lambda_function)
+
+with open(args.event) as f:
+    event = json.load(f)
+
+started = time.perf_counter()
+response = lambda_function.lambda_handler(event, None)
+print("Response: {}".format(json.dumps(response)))
+print("Handler duration: {:.1f} ms".format((time.perf_counter() - started) * 1000))
@@ -0,0 +1,443 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+'''
+Local stand-in for AWS IoT Core, for offline tests and benchmarks.
+
+WHAT IT DOES:
+1. Runs a small MQTT 3.1.1 broker (QoS 0 and 1, wildcards, keep alive) over
+   TLS with client certificates, so iot_sprinkler.py can connect unmodified with
+   mtls_from_path by pointing --endpoint at this machine
+2. Emulates the Device Shadow topics $aws/things/<name>/shadow/get and
+   $aws/things/<name>/shadow/update, including accepted, documents and delta responses
+3. Emulates the Jobs topics used by iotjobs.IotJobsClient: start-next,
+   <jobId>/update and notify-next
+4. Serves the iot-data HTTP API (publish, get/update thing shadow) so the
+   publish_on/publish_off Lambdas can run against it through boto3
+5. Accepts new jobs on POST /jobs/<thingName> with the job document as body
+
+This is a test tool: sessions are always clean, QoS 1 messages are not
+retransmitted and nothing is persisted.
+'''
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote, parse_qs
+import argparse
+import asyncio
+import copy
+import json
+import ssl
+import struct
+import threading
+import time
+from uuid import uuid4
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+TERMINAL_JOB_STATUSES = ("SUCCEEDED", "FAILED", "REJECTED", "REMOVED", "CANCELED", "TIMED_OUT")
+
+
+def encode_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+
+def encode_packet(packet_type, flags, body):
+    length = len(body)
+    header = bytearray([(packet_type << 4) | flags])
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    # Wildcards at the first level never match $ topics
+    if topic.startswith('$') and filter_levels[0] in ('+', '#'):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def merge_state(target, update):
+    # Shadow merge semantics: nested objects merge, null removes a key
+    for key, value in update.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_state(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def state_delta(desired, reported):
+    delta = {}
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(reported.get(key), dict):
+            nested = state_delta(value, reported[key])
+            if nested:
+                delta[key] = nested
+        elif reported.get(key) != value:
+            delta[key] = value
+    return delta
+
+
+class ClientSession:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self.next_packet_id = 1
+        self.keep_alive = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def send_publish(self, topic, payload, qos):
+        body = encode_string(topic)
+        if qos:
+            body += struct.pack('>H', self.next_packet_id)
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+        self.send(encode_packet(PUBLISH, qos << 1, body + payload))
+
+
+class ShadowEmulator:
+    def __init__(self, broker):
+        self.broker = broker
+        self.shadows = {}
+
+    def document(self, thing_name):
+        return self.shadows.setdefault(thing_name, {"desired": {}, "reported": {}, "version": 0})
+
+    def get(self, thing_name, client_token=None):
+        shadow = self.document(thing_name)
+        state = {"desired": shadow["desired"], "reported": shadow["reported"]}
+        delta = state_delta(shadow["desired"], shadow["reported"])
+        if delta:
+            state["delta"] = delta
+        response = {"state": state, "metadata": {}, "version": shadow["version"], "timestamp": int(time.time())}
+        if client_token:
+            response["clientToken"] = client_token
+        return response
+
+    def update(self, thing_name, request):
+        shadow = self.document(thing_name)
+        previous = {"state": copy.deepcopy({"desired": shadow["desired"], "reported": shadow["reported"]}),
+                    "version": shadow["version"]}
+        for section in ("desired", "reported"):
+            if isinstance(request.get("state", {}).get(section), dict):
+                merge_state(shadow[section], request["state"][section])
+        shadow["version"] += 1
+        now = int(time.time())
+
+        prefix = "$aws/things/{}/shadow/update".format(thing_name)
+        accepted = {"state": request.get("state", {}), "metadata": {}, "version": shadow["version"], "timestamp": now}
+        if request.get("clientToken"):
+            accepted["clientToken"] = request["clientToken"]
+        self.broker.route(prefix + "/accepted", json.dumps(accepted).encode('utf-8'))
+
+        current = {"state": copy.deepcopy({"desired": shadow["desired"], "reported": shadow["reported"]}),
+                   "version": shadow["version"]}
+        self.broker.route(prefix + "/documents", json.dumps(
+            {"previous": previous, "current": current, "timestamp": now}).encode('utf-8'))
+
+        # Like IoT Core, only send a delta when the update touched the desired state
+        delta = state_delta(shadow["desired"], shadow["reported"])
+        if delta and "desired" in request.get("state", {}):
+            self.broker.route(prefix + "/delta", json.dumps(
+                {"version": shadow["version"], "timestamp": now, "state": delta, "metadata": {}}).encode('utf-8'))
+        return accepted
+
+    def handle(self, topic, payload):
+        # $aws/things/<thingName>/shadow/<get|update>
+        levels = topic.split('/')
+        thing_name, operation = levels[2], levels[4]
+        request = json.loads(payload) if payload else {}
+        if operation == "get":
+            response = self.get(thing_name, request.get("clientToken"))
+            self.broker.route(topic + "/accepted", json.dumps(response).encode('utf-8'))
+        elif operation == "update":
+            self.update(thing_name, request)
+
+
+class JobsEmulator:
+    def __init__(self, broker):
+        self.broker = broker
+        self.jobs = {}
+
+    def add_job(self, thing_name, job_document, job_id=None):
+        job_id = job_id or "local-" + str(uuid4())[:8]
+        now = int(time.time())
+        queue = self.jobs.setdefault(thing_name, [])
+        queue.append({"jobId": job_id, "thingName": thing_name, "jobDocument": job_document, "status": "QUEUED",
+                      "queuedAt": now, "lastUpdatedAt": now, "versionNumber": 1, "executionNumber": 1})
+        if len(queue) == 1:
+            self.notify_next(thing_name)
+        return job_id
+
+    def next_execution(self, thing_name):
+        queue = self.jobs.get(thing_name, [])
+        return queue[0] if queue else None
+
+    def notify_next(self, thing_name):
+        event = {"timestamp": int(time.time())}
+        execution = self.next_execution(thing_name)
+        if execution:
+            event["execution"] = execution
+        self.broker.route("$aws/things/{}/jobs/notify-next".format(thing_name), json.dumps(event).encode('utf-8'))
+
+    def handle(self, topic, payload):
+        # $aws/things/<thingName>/jobs/start-next or $aws/things/<thingName>/jobs/<jobId>/update
+        levels = topic.split('/')
+        thing_name = levels[2]
+        request = json.loads(payload) if payload else {}
+        response = {"timestamp": int(time.time())}
+        if request.get("clientToken"):
+            response["clientToken"] = request["clientToken"]
+
+        if levels[4] == "start-next":
+            execution = self.next_execution(thing_name)
+            if execution:
+                execution["status"] = "IN_PROGRESS"
+                execution["startedAt"] = execution.get("startedAt", response["timestamp"])
+                response["execution"] = execution
+            self.broker.route(topic + "/accepted", json.dumps(response).encode('utf-8'))
+        elif len(levels) == 6 and levels[5] == "update":
+            job_id = levels[4]
+            queue = self.jobs.get(thing_name, [])
+            execution = next((job for job in queue if job["jobId"] == job_id), None)
+            if execution is None:
+                rejected = dict(response, code="ResourceNotFound", message="Job {} not found".format(job_id))
+                self.broker.route(topic + "/rejected", json.dumps(rejected).encode('utf-8'))
+                return
+            execution["status"] = request.get("status", execution["status"])
+            execution["statusDetails"] = request.get("statusDetails", execution.get("statusDetails", {}))
+            execution["lastUpdatedAt"] = response["timestamp"]
+            execution["versionNumber"] += 1
+            if request.get("includeJobExecutionState"):
+                response["executionState"] = {"status": execution["status"], "statusDetails": execution["statusDetails"],
+                                              "versionNumber": execution["versionNumber"]}
+            self.broker.route(topic + "/accepted", json.dumps(response).encode('utf-8'))
+            if execution["status"] in TERMINAL_JOB_STATUSES:
+                queue.remove(execution)
+                self.notify_next(thing_name)
+
+
+class LocalBroker:
+    def __init__(self):
+        self.sessions = {}
+        self.shadows = ShadowEmulator(self)
+        self.jobs = JobsEmulator(self)
+        self.loop = None
+        self.messages_routed = 0
+
+    def route(self, topic, payload, qos=1):
+        self.messages_routed += 1
+        for session in list(self.sessions.values()):
+            granted = max((sub_qos for topic_filter, sub_qos in session.subscriptions.items()
+                           if topic_matches(topic_filter, topic)), default=None)
+            if granted is not None:
+                session.send_publish(topic, payload, min(qos, granted))
+
+    def on_publish(self, topic, payload, qos):
+        if topic.startswith("$aws/things/") and "/shadow/" in topic and topic.split('/')[4] in ("get", "update") \
+                and len(topic.split('/')) == 5:
+            self.shadows.handle(topic, payload)
+        elif topic.startswith("$aws/things/") and "/jobs/" in topic and not topic.endswith(("/accepted", "/rejected")):
+            self.jobs.handle(topic, payload)
+        else:
+            self.route(topic, payload, qos)
+
+    async def read_packet(self, reader, keep_alive):
+        # Clients must send something every 1.5 keep alive periods
+        timeout = keep_alive * 1.5 if keep_alive else None
+        first = await asyncio.wait_for(reader.readexactly(1), timeout)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b''
+        return first[0] >> 4, first[0] & 0x0F, body
+
+    async def handle_client(self, reader, writer):
+        session = ClientSession(reader, writer)
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader, session.keep_alive)
+                if packet_type == CONNECT:
+                    self.on_connect(session, body)
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack_from('>H', body)[0]
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = struct.unpack_from('>H', body, offset)[0]
+                        offset += 2
+                        session.send(encode_packet(PUBACK, 0, struct.pack('>H', packet_id)))
+                    self.on_publish(topic, body[offset:], qos)
+                elif packet_type == SUBSCRIBE:
+                    self.on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id = struct.unpack_from('>H', body)[0]
+                    offset = 2
+                    while offset < len(body):
+                        topic_length = struct.unpack_from('>H', body, offset)[0]
+                        session.subscriptions.pop(body[offset + 2:offset + 2 + topic_length].decode('utf-8'), None)
+                        offset += 2 + topic_length
+                    session.send(encode_packet(UNSUBACK, 0, struct.pack('>H', packet_id)))
+                elif packet_type == PINGREQ:
+                    session.send(encode_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            if session.client_id and self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+                print("Client '{}' disconnected".format(session.client_id))
+            writer.close()
+
+    def on_connect(self, session, body):
+        offset = 2 + struct.unpack_from('>H', body)[0]
+        offset += 2  # protocol level and connect flags
+        session.keep_alive = struct.unpack_from('>H', body, offset)[0]
+        offset += 2
+        client_id_length = struct.unpack_from('>H', body, offset)[0]
+        session.client_id = body[offset + 2:offset + 2 + client_id_length].decode('utf-8') or str(uuid4())
+        # A new connection with the same client ID takes over, like IoT Core
+        previous = self.sessions.get(session.client_id)
+        if previous is not None:
+            previous.writer.close()
+        self.sessions[session.client_id] = session
+        session.send(encode_packet(CONNACK, 0, b'\x00\x00'))
+        print("Client '{}' connected".format(session.client_id))
+
+    def on_subscribe(self, session, body):
+        packet_id = struct.unpack_from('>H', body)[0]
+        offset = 2
+        granted = bytearray()
+        while offset < len(body):
+            topic_length = struct.unpack_from('>H', body, offset)[0]
+            topic_filter = body[offset + 2:offset + 2 + topic_length].decode('utf-8')
+            qos = min(body[offset + 2 + topic_length], 1)
+            session.subscriptions[topic_filter] = qos
+            granted.append(qos)
+            offset += 3 + topic_length
+        session.send(encode_packet(SUBACK, 0, struct.pack('>H', packet_id) + bytes(granted)))
+
+    def call(self, fn, *args):
+        # Run broker state changes from the HTTP thread on the broker loop
+        future = asyncio.run_coroutine_threadsafe(self._call(fn, *args), self.loop)
+        return future.result(timeout=10)
+
+    async def _call(self, fn, *args):
+        return fn(*args)
+
+
+def make_http_handler(broker):
+    class IotDataHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def do_GET(self):
+            levels = urlparse(self.path).path.strip('/').split('/')
+            if len(levels) == 3 and levels[0] == 'things' and levels[2] == 'shadow':
+                response = broker.call(broker.shadows.get, unquote(levels[1]))
+                self._reply(200, json.dumps(response).encode('utf-8'))
+            else:
+                self._reply(404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            levels = url.path.strip('/').split('/')
+            body = self._body()
+            if levels[0] == 'topics':
+                topic = unquote(url.path[len('/topics/'):])
+                qos = int(parse_qs(url.query).get('qos', ['0'])[0])
+                broker.call(broker.on_publish, topic, body, qos)
+                self._reply(200)
+            elif len(levels) == 3 and levels[0] == 'things' and levels[2] == 'shadow':
+                response = broker.call(broker.shadows.update, unquote(levels[1]), json.loads(body))
+                self._reply(200, json.dumps(response).encode('utf-8'))
+            elif len(levels) == 2 and levels[0] == 'jobs':
+                job_id = broker.call(broker.jobs.add_job, unquote(levels[1]), json.loads(body))
+                self._reply(200, json.dumps({"jobId": job_id}).encode('utf-8'))
+            else:
+                self._reply(404)
+
+        def log_message(self, format, *args):
+            return
+
+    return IotDataHandler
+
+
+async def main(args):
+    broker = LocalBroker()
+    broker.loop = asyncio.get_running_loop()
+
+    ssl_context = None
+    if args.cert:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.cert, args.key)
+        if args.ca:
+            # Mutual TLS, like IoT Core
+            ssl_context.load_verify_locations(args.ca)
+            ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+    for job in args.job:
+        thing_name, path = job.split('=', 1)
+        with open(path) as f:
+            broker.jobs.add_job(thing_name, json.load(f))
+
+    http_server = ThreadingHTTPServer((args.host, args.http_port), make_http_handler(broker))
+    threading.Thread(target=http_server.serve_forever, name='iot_data_http', daemon=True).start()
+
+    server = await asyncio.start_server(broker.handle_client, args.host, args.port, ssl=ssl_context)
+    print("MQTT broker listening on {}:{} ({}), iot-data API on http://{}:{}".format(
+        args.host, args.port, "mTLS" if ssl_context else "plain TCP", args.host, args.http_port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local MQTT broker with Device Shadow and Jobs emulation.")
+    parser.add_argument('--host', default='localhost', help="Interface to listen on.")
+    parser.add_argument('--port', type=int, default=8883, help="MQTT port.")
+    parser.add_argument('--http_port', type=int, default=8080, help="Port of the iot-data HTTP API.")
+    parser.add_argument('--cert', help="Server certificate, enables TLS.")
+    parser.add_argument('--key', help="Server private key.")
+    parser.add_argument('--ca', help="CA that signed the client certificates, enables mutual TLS.")
+    parser.add_argument('--job', action='append', default=[],
+                        help="Queue a job at startup, as <thingName>=<path to job document>. Can be repeated.")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("Broker stopped")
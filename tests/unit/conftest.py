@@ -0,0 +1,9 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+# Device helpers are imported the same way iot_sprinkler.py imports them, from the device folder
+DEVICE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'device_files', 'devices', 'sample_device')
+sys.path.insert(0, os.path.abspath(DEVICE_DIR))
@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from telemetry_files.adaptive_interval import AdaptiveInterval
+
+
+def test_rejects_zero_gain_and_keeps_settings():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    with pytest.raises(ValueError):
+        interval.configure({"gain": 0})
+    assert interval.settings() == {"min_interval": 1, "max_interval": 300, "gain": 4}
+    # Still usable afterwards
+    assert interval.update(50, 27, False, now=0) == 300
+
+
+def test_rejects_min_above_max_and_keeps_settings():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    with pytest.raises(ValueError):
+        interval.configure({"min_interval": 400})
+    with pytest.raises(ValueError):
+        interval.configure({"min_interval": -5})
+    with pytest.raises(ValueError):
+        interval.configure({"gain": "4"})
+    assert interval.settings() == {"min_interval": 1, "max_interval": 300, "gain": 4}
+
+
+def test_accepts_partial_settings():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    interval.configure({"max_interval": 600, "gain": 2.5})
+    assert interval.settings() == {"min_interval": 1, "max_interval": 600, "gain": 2.5}
+
+
+def feed(interval, readings, trigger=27, watering=False, seconds_to_trigger=None):
+    # readings are (now, percentage), returns the interval after the last one
+    for now, percentage in readings:
+        result = interval.update(percentage, trigger, watering, now=now, seconds_to_trigger=seconds_to_trigger)
+    return result
+
+
+def test_watering_uses_min_interval():
+    interval = AdaptiveInterval(2, 300, gain=4)
+    assert feed(interval, [(0, 30), (10, 40), (20, 50)], watering=True) == 2
+
+
+def test_forecast_sets_interval_before_trigger():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    # The forecast wins over the slope of the window
+    assert feed(interval, [(0, 60), (10, 59)], seconds_to_trigger=400) == pytest.approx(100)
+
+
+def test_slope_toward_trigger():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    # -0.1 points per second, 31 points above the trigger: 310 s left, a quarter of it
+    assert feed(interval, [(0, 60), (10, 59), (20, 58)]) == pytest.approx(77.5)
+
+
+def test_slope_away_from_trigger():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    # Rising 0.1 points per second, 1/gain points take 2.5 s
+    assert feed(interval, [(0, 40), (10, 41), (20, 42)]) == pytest.approx(2.5)
+
+
+def test_stable_reading_uses_max_interval():
+    interval = AdaptiveInterval(1, 300, gain=4)
+    assert feed(interval, [(0, 50), (10, 50), (20, 50)]) == 300
+
+
+def test_interval_is_clamped():
+    interval = AdaptiveInterval(5, 120, gain=4)
+    # 13 points above the trigger at -10 points per second would give 0.325 s
+    assert feed(interval, [(0, 60), (1, 50), (2, 40)]) == 5
+    interval = AdaptiveInterval(5, 120, gain=4)
+    assert feed(interval, [(0, 60), (10, 59.9)], seconds_to_trigger=100000) == 120
@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from telemetry_files.calibration import CalibrationTable, evaluate_curve, probe_curve
+
+ADC_MAX = 1023
+
+
+def test_default_curve_is_linear_between_hydrated_and_dry():
+    assert probe_curve(None, 300, 600) == {"type": "linear", "hydrated": 300, "dry": 600}
+    curve = {"type": "piecewise", "points": [[300, 100], [600, 0]]}
+    assert probe_curve(curve, 300, 600) is curve
+
+
+def test_linear_curve_and_clamping():
+    table = CalibrationTable(ADC_MAX)
+    table.set_curve(0, probe_curve(None, 300, 600))
+    assert table.percentage(300) == 100
+    assert table.percentage(450) == 50
+    assert table.percentage(600) == 0
+    # Flat beyond both ends
+    assert table.percentage(0) == 100
+    assert table.percentage(ADC_MAX) == 0
+    # Raw values outside of the ADC range use the nearest entry
+    assert table.percentage(-50) == 100
+    assert table.percentage(5000) == 0
+
+
+def test_piecewise_curve():
+    table = CalibrationTable(ADC_MAX)
+    table.set_curve(0, {"type": "piecewise", "points": [[510, 20], [300, 100], [420, 55], [600, 0]]})
+    assert table.percentage(300) == 100
+    assert table.percentage(360) == 77
+    assert table.percentage(420) == 55
+    assert table.percentage(465) == 37
+    assert table.percentage(510) == 20
+    assert table.percentage(600) == 0
+    assert table.percentage(700) == 0
+
+
+def test_polynomial_curve_is_clamped():
+    table = CalibrationTable(ADC_MAX)
+    # 200 - raw / 3, above 100 below raw 300 and below 0 above raw 600
+    table.set_curve(0, {"type": "polynomial", "coefficients": [200, -1 / 3]})
+    assert table.percentage(0) == 100
+    assert table.percentage(300) == 100
+    assert table.percentage(450) == 50
+    assert table.percentage(600) == 0
+    assert table.percentage(ADC_MAX) == 0
+
+
+@pytest.mark.parametrize("curve", [
+    {"type": "spline"},
+    {"type": "linear", "hydrated": 300, "dry": 300},
+    {"type": "linear", "hydrated": 300},
+    {"type": "piecewise", "points": [[300, 100]]},
+    {"type": "polynomial", "coefficients": []},
+])
+def test_invalid_curve_keeps_previous_table(curve):
+    table = CalibrationTable(ADC_MAX)
+    linear = probe_curve(None, 300, 600)
+    table.set_curve(0, linear)
+    with pytest.raises((KeyError, TypeError, ValueError)):
+        table.set_curve(0, curve)
+    assert table.curves[0] == linear
+    assert table.percentage(450) == 50
+    assert table.percentages([450]) == [50]
+
+
+def test_table_only_rebuilt_when_curve_changes():
+    table = CalibrationTable(ADC_MAX)
+    assert table.set_curve(0, probe_curve(None, 300, 600))
+    assert not table.set_curve(0, probe_curve(None, 300, 600))
+    assert table.set_curve(0, probe_curve(None, 300, 700))
+
+
+def test_percentages_per_probe():
+    table = CalibrationTable(ADC_MAX, probe_count=2)
+    assert table.configure([probe_curve(None, 300, 600), probe_curve(None, 100, 300)])
+    assert table.percentages([450, 200]) == [50, 50]
+    assert table.percentages([299.6, 400]) == [100, 0]
+
+
+def test_evaluate_curve_covers_every_raw_value():
+    row = evaluate_curve({"type": "linear", "hydrated": 0, "dry": ADC_MAX}, ADC_MAX)
+    assert len(row) == ADC_MAX + 1
+    assert row[0] == 100 and row[-1] == 0
@@ -0,0 +1,98 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from runtime_files.connection_swap import switch_connection
+
+
+class FakeBroker:
+    # One connection per client ID: connecting drops the connection that held the session
+    def __init__(self, certificate, refused=(), failing_subscribes=()):
+        self.certificate = certificate
+        self.refused = set(refused)
+        self.failing_subscribes = set(failing_subscribes)
+        self.session = None
+        self.subscribed = []
+        self.closed = []
+        self.built = []
+
+    def build(self):
+        connection = "connection-{}-{}".format(len(self.built), self.certificate[0])
+        self.built.append((connection, self.certificate[0]))
+        return connection
+
+    def certificate_of(self, connection):
+        return dict(self.built)[connection]
+
+    def connect(self, connection):
+        if self.certificate_of(connection) in self.refused:
+            raise Exception("certificate refused")
+        self.session = connection
+
+    def subscribe(self, connection):
+        if self.certificate_of(connection) in self.failing_subscribes:
+            raise Exception("subscribe timed out")
+        self.subscribed.append(connection)
+
+    def close(self, connection):
+        self.closed.append(connection)
+        if self.session == connection:
+            self.session = None
+
+    def restore_previous(self):
+        self.certificate[0] = "old"
+
+
+def swap(broker, old_connection):
+    return switch_connection(old_connection, broker.build, broker.connect, broker.subscribe,
+                             broker.close, broker.restore_previous)
+
+
+def started_broker(**kwargs):
+    # The device runs on the old certificate, and the new one was just written to disk
+    broker = FakeBroker(["old"], **kwargs)
+    old_connection = broker.build()
+    broker.connect(old_connection)
+    broker.certificate[0] = "new"
+    return broker, old_connection
+
+
+def test_swap_to_new_certificate():
+    broker, old_connection = started_broker()
+    connection, swapped = swap(broker, old_connection)
+    assert swapped
+    assert broker.certificate_of(connection) == "new"
+    assert broker.session == connection
+    assert broker.subscribed == [connection]
+    assert broker.closed == [old_connection]
+
+
+def test_refused_certificate_keeps_old_connection():
+    broker, old_connection = started_broker(refused=["new"])
+    connection, swapped = swap(broker, old_connection)
+    assert not swapped
+    assert connection == old_connection
+    assert broker.session == old_connection
+    assert old_connection not in broker.closed
+    assert broker.certificate == ["old"]
+
+
+def test_failure_after_takeover_reconnects_with_previous_certificate():
+    # The new certificate connects, which drops the old connection, then its subscriptions fail
+    broker, old_connection = started_broker(failing_subscribes=["new"])
+    connection, swapped = swap(broker, old_connection)
+    assert not swapped
+    assert connection != old_connection
+    assert broker.certificate == ["old"]
+    assert broker.certificate_of(connection) == "old"
+    assert broker.session == connection
+    assert broker.subscribed == [connection]
+    assert broker.closed[:2] == [old_connection, "connection-1-new"]
+
+
+def test_previous_certificate_failing_too_raises():
+    broker, old_connection = started_broker(failing_subscribes=["new", "old"])
+    with pytest.raises(Exception, match="subscribe timed out"):
+        swap(broker, old_connection)
+    assert broker.session is None
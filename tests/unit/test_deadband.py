@@ -0,0 +1,51 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+
+from conftest import DEVICE_DIR
+from decision_files.watering_detector import WateringDetector, load_definition
+from telemetry_files.deadband import DeadbandFilter
+
+DEFINITION = load_definition(os.path.join(DEVICE_DIR, 'detector_model.json'))
+TRIGGER_PERCENTAGE = 27
+
+
+def transitions(readings, deadband_percentage):
+    # Reading indexes at which a detector switches, fed every reading and fed the deadband reports
+    per_reading = WateringDetector(DEFINITION)
+    reported = WateringDetector(DEFINITION)
+    deadband = DeadbandFilter(deadband_percentage, max_silence_seconds=3600,
+                              debounce_threshold=DEFINITION['debounce_threshold'])
+    per_reading_switches, reported_switches = [], []
+    for index, percentage in enumerate(readings):
+        state = "dry" if percentage <= TRIGGER_PERCENTAGE else "hydrated"
+        if per_reading.on_reading(state) is not None:
+            per_reading_switches.append(index)
+        sample_count = deadband.should_report(percentage, state, now=index)
+        if sample_count is not None and reported.on_reading(state, sample_count) is not None:
+            reported_switches.append(index)
+    return per_reading_switches, reported_switches
+
+
+def test_steady_run_switches_on_the_same_reading():
+    readings = [60] * 10 + [20] * 12 + [60] * 12
+    per_reading, reported = transitions(readings, deadband_percentage=3)
+    assert per_reading == [14, 26]
+    assert reported == per_reading
+
+
+def test_reports_within_the_run_do_not_delay_the_switch():
+    # A flip to dry, three readings moving 2 points each, then a steady 20%
+    readings = [60] * 5 + [26, 24, 22, 20] + [20] * 10
+    per_reading, reported = transitions(readings, deadband_percentage=1)
+    assert per_reading == [9]
+    assert reported == per_reading
+
+
+def test_steady_readings_are_still_suppressed():
+    deadband = DeadbandFilter(5, max_silence_seconds=3600, debounce_threshold=4)
+    reports = [deadband.should_report(60, "hydrated", now=index) for index in range(20)]
+    # The first reading, then one report each time the detector would have switched
+    assert [index for index, sample_count in enumerate(reports) if sample_count is not None] == [0, 4, 9, 14, 19]
+    assert sum(sample_count for sample_count in reports if sample_count is not None) == 20
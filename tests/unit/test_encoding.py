@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import importlib.util
+import json
+import os
+import struct
+
+import pytest
+
+from telemetry_files.encoding import encode_batch, encode_reading
+
+# The Lambda creates its boto3 clients at import, which only needs a region
+pytest.importorskip('boto3')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+LAMBDA_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'lambda', 'unbatch_sensordata', 'lambda_function.py')
+spec = importlib.util.spec_from_file_location('unbatch_sensordata', LAMBDA_PATH)
+unbatch_sensordata = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(unbatch_sensordata)
+
+
+@pytest.mark.parametrize("state,percentage,sample_count", [
+    ("hydrated", 55, 1),
+    ("dry", 0, 3),
+    # The percentage is signed, a probe reading past its dry value gives a negative one
+    ("dry", -128, 1),
+    ("hydrated", 127, 65535),
+])
+def test_single_reading_round_trip(state, percentage, sample_count):
+    readings = unbatch_sensordata.decode_payload(encode_reading(state, percentage, sample_count))
+    assert len(readings) == 1
+    _, decoded_percentage, decoded_state, decoded_sample_count = readings[0]
+    assert (decoded_state, decoded_percentage, decoded_sample_count) == (state, percentage, sample_count)
+
+
+def test_single_reading_out_of_range_is_refused():
+    with pytest.raises(struct.error):
+        encode_reading("dry", -129)
+    with pytest.raises(struct.error):
+        encode_reading("hydrated", 128)
+
+
+def test_batch_round_trip():
+    readings = [
+        [1700000000000, 31, "hydrated", 1],
+        [1700000002000, 27, "dry", 4],
+        [1700000004000, -5, "dry", 1],
+        # Offsets from the base timestamp go up to 2^32 - 1 ms
+        [1700000000000 + 2 ** 32 - 1, 100, "hydrated", 2],
+    ]
+    batch = {"sensorType": "SoilMoistureSensor", "deviceID": "AWS_9875", "readings": readings}
+    assert unbatch_sensordata.decode_payload(encode_batch(batch)) == readings
+
+
+def test_largest_batch_round_trip():
+    # The reading count is 2 bytes
+    readings = [[1700000000000 + i, i % 101, "dry" if i % 2 else "hydrated", 1] for i in range(65535)]
+    payload = encode_batch({"readings": readings})
+    assert len(payload) == 11 + 8 * 65535
+    assert unbatch_sensordata.decode_payload(payload) == readings
+
+
+def test_layouts_match():
+    from telemetry_files import encoding
+    for name in ("READING_FORMAT", "BATCH_HEADER_FORMAT", "BATCH_ROW_FORMAT"):
+        assert getattr(encoding, name).format == getattr(unbatch_sensordata, name).format
+    assert (encoding.SCHEMA_READING, encoding.SCHEMA_BATCH) == (unbatch_sensordata.SCHEMA_READING,
+                                                               unbatch_sensordata.SCHEMA_BATCH)
+    assert [state for state, _ in sorted(encoding.STATE_CODES.items(), key=lambda item: item[1])] == \
+        unbatch_sensordata.STATES
+
+
+@pytest.mark.parametrize("minutes_to_dry", [None, 0, 0.4, 10080])
+def test_json_reading_matches_json_dumps(minutes_to_dry):
+    from telemetry_files.encoding import json_reading_encoder
+    message = {
+        "sensorType": "SoilMoistureSensor",
+        "deviceID": "AWS_9875",
+        "sensorReportedState": "dry",
+        "sensorReportedMoisturePercentage": -3,
+        "sampleCount": 1
+    }
+    if minutes_to_dry is not None:
+        # Past due forecasts are sent as 0, fractions are cut to whole minutes
+        message["minutesToDry"] = int(minutes_to_dry)
+    payload = json_reading_encoder("SoilMoistureSensor", "AWS_9875")("dry", -3, 1, minutes_to_dry)
+    assert payload == json.dumps(message).encode('utf-8')
@@ -0,0 +1,53 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import importlib.util
+import os
+import random
+import zlib
+
+import pytest
+
+from ota_files.firmware_delta import PatchError, PatchStream, apply_patch
+
+# The patch is made by the ota_update Lambda's own module, so both sides of the format are tested together
+LAMBDA_DELTA_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'lambda', 'ota_update', 'firmware_delta.py')
+spec = importlib.util.spec_from_file_location('lambda_firmware_delta', LAMBDA_DELTA_PATH)
+lambda_firmware_delta = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(lambda_firmware_delta)
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_patch_rebuilds_target(tmp_path):
+    rng = random.Random(7)
+    base = bytes(rng.getrandbits(8) for _ in range(200000))
+    target = base[:50000] + bytes(rng.getrandbits(8) for _ in range(3000)) + base[60000:] + b'tail'
+    base_path = write(tmp_path / 'base.bin', base)
+    target_path = write(tmp_path / 'target.bin', target)
+    patch_path = str(tmp_path / 'update.patch')
+    lambda_firmware_delta.create_patch(base_path, target_path, patch_path)
+
+    # A small chunk size makes the stream refill many times in the middle of operations
+    output_path = str(tmp_path / 'rebuilt.bin')
+    assert apply_patch(base_path, patch_path, output_path, chunk_bytes=512) == hashlib.sha256(target).digest()
+    with open(output_path, 'rb') as f:
+        assert f.read() == target
+
+
+def test_patch_stream_reads_exact_sizes(tmp_path):
+    data = bytes(range(256)) * 64
+    path = write(tmp_path / 'ops.z', zlib.compress(data))
+    with open(path, 'rb') as f:
+        stream = PatchStream(f, chunk_bytes=7)
+        pieces = [stream.read(size) for size in [1, 12, 4, 1000, 3] * 3]
+        assert b''.join(pieces) == data[:sum(len(piece) for piece in pieces)]
+        assert all(isinstance(piece, bytes) for piece in pieces)
+        stream.read(len(data) - sum(len(piece) for piece in pieces))
+        with pytest.raises(PatchError):
+            stream.read(1)
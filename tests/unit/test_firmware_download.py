@@ -0,0 +1,139 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('requests')
+from ota_files.firmware_download import FirmwareDownloader, FirmwareVerificationError  # noqa: E402
+
+# Downloads are served by the local test bed firmware server, the stand-in for the presigned S3 URL
+SERVER_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'local_test_bed', 'firmware_server.py')
+spec = importlib.util.spec_from_file_location('firmware_server', SERVER_PATH)
+firmware_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(firmware_server)
+
+IMAGE_BYTES = 300001
+DROP_AFTER_BYTES = 100000
+
+
+class NoDelay:
+    def next_delay(self):
+        return 0
+
+    def reset(self):
+        pass
+
+
+@pytest.fixture
+def image(tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    data = random.Random(19).randbytes(IMAGE_BYTES)
+    (served / 'firmware.bin').write_bytes(data)
+    return served, data, hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(directory, drop_after_bytes=0):
+        # Same handler as running firmware_server.py with --drop_after_bytes
+        server = ThreadingHTTPServer(('localhost', 0),
+                                     firmware_server.make_firmware_handler(str(directory), drop_after_bytes))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://localhost:{}/firmware.bin?X-Amz-Signature=test'.format(server.server_address[1])
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def downloader(**kwargs):
+    return FirmwareDownloader(chunk_bytes=8192, request_timeout=5, backoff=NoDelay(), **kwargs)
+
+
+def test_download_resumes_after_dropped_connections(tmp_path, image, serve):
+    served, data, sha256 = image
+    url = serve(served, DROP_AFTER_BYTES)
+    path = str(tmp_path / 'firmware.bin')
+    progress = []
+    firmware = downloader(progress_fn=lambda done, total: progress.append(done))
+    assert firmware.download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=sha256) == sha256
+    # Each request is dropped after DROP_AFTER_BYTES and the next one resumes with a Range request
+    assert firmware.attempts > IMAGE_BYTES // DROP_AFTER_BYTES
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+    assert progress[-1] == IMAGE_BYTES
+
+
+def test_download_resumes_from_sidecar_on_next_run(tmp_path, image, serve):
+    served, data, sha256 = image
+    url = serve(served, DROP_AFTER_BYTES)
+    path = str(tmp_path / 'firmware.bin')
+    # The first job run gives up after the first dropped connection
+    with pytest.raises(IOError):
+        downloader(max_retries=0).download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=sha256)
+    # A chunk cut short by the drop is not written, the rest of what arrived is kept
+    kept_bytes = os.path.getsize(path + '.part')
+    assert 0 < kept_bytes <= DROP_AFTER_BYTES
+    with open(path + '.part.json') as f:
+        assert json.load(f) == {'imageId': 'image-1'}
+
+    # The next run picks up the partial file of the same image
+    firmware = downloader()
+    assert firmware.download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=sha256) == sha256
+    assert firmware.resumed_bytes == kept_bytes
+    with open(path, 'rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == sha256
+
+
+def test_partial_file_of_other_image_is_discarded(tmp_path, image, serve):
+    served, data, sha256 = image
+    url = serve(served)
+    path = str(tmp_path / 'firmware.bin')
+    (tmp_path / 'firmware.bin.part').write_bytes(b'\xff' * 5000)
+    (tmp_path / 'firmware.bin.part.json').write_text(json.dumps({'imageId': 'image-0'}))
+    firmware = downloader()
+    assert firmware.download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=sha256) == sha256
+    assert firmware.resumed_bytes == 0
+
+
+def test_size_mismatch_is_rejected(tmp_path, image, serve):
+    served, data, sha256 = image
+    url = serve(served, DROP_AFTER_BYTES)
+    path = str(tmp_path / 'firmware.bin')
+    with pytest.raises(FirmwareVerificationError, match='size'):
+        downloader().download(url, path, IMAGE_BYTES - 10, 'image-1')
+    # A rejected image is not resumed or installed
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_hash_mismatch_is_rejected(tmp_path, image, serve):
+    served, data, sha256 = image
+    url = serve(served, DROP_AFTER_BYTES)
+    path = str(tmp_path / 'firmware.bin')
+    with pytest.raises(FirmwareVerificationError, match='SHA-256'):
+        downloader().download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=hashlib.sha256(b'other').hexdigest())
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+
+    # The next attempt starts from zero and installs the right image
+    firmware = downloader()
+    assert firmware.download(url, path, IMAGE_BYTES, 'image-1', expected_sha256=sha256) == sha256
+    assert firmware.resumed_bytes == 0
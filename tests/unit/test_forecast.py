@@ -0,0 +1,109 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+
+import pytest
+
+from telemetry_files.forecast import DryForecaster
+
+
+def feed(forecaster, percentages, interval=60, start=1000.0):
+    for i, percentage in enumerate(percentages):
+        forecaster.add(percentage, now=start + i * interval)
+
+
+def test_linear_decay():
+    # 60% dropping 0.1 point per minute
+    forecaster = DryForecaster(window=30, model="linear")
+    feed(forecaster, [60 - 0.1 * i for i in range(10)])
+    # 59.1% now, 29.1 points above the trigger
+    assert forecaster.minutes_to(30) == pytest.approx(291, abs=0.01)
+    assert forecaster.minutes_to(59.1) == pytest.approx(0, abs=0.01)
+    assert forecaster.minutes_to(70) == 0.0
+
+
+def test_linear_decay_past_the_window():
+    # The sliding window drops the old readings and rebuilds its sums every pass
+    forecaster = DryForecaster(window=5, model="linear")
+    feed(forecaster, [60 - 0.1 * i for i in range(23)])
+    assert forecaster.count == 5
+    assert forecaster.minutes_to(30) == pytest.approx((57.8 - 30) / 0.1, abs=0.01)
+
+
+def test_exponential_decay():
+    rate = 1e-4  # per second
+    forecaster = DryForecaster(window=30, model="exponential")
+    feed(forecaster, [80 * math.exp(-rate * 60 * i) for i in range(20)])
+    newest = 19 * 60
+    expected = (math.log(80) - rate * newest - math.log(20)) / rate / 60
+    assert forecaster.minutes_to(20) == pytest.approx(expected, rel=1e-6)
+
+
+def test_exponential_decay_is_not_linear():
+    # The same readings through the linear model are off by hours
+    rate = 1e-4
+    percentages = [80 * math.exp(-rate * 60 * i) for i in range(20)]
+    linear = DryForecaster(model="linear")
+    exponential = DryForecaster(model="exponential")
+    feed(linear, percentages)
+    feed(exponential, percentages)
+    assert exponential.minutes_to(20) - linear.minutes_to(20) > 60
+
+
+def test_min_samples_and_span():
+    forecaster = DryForecaster(min_samples=5, min_span_seconds=60)
+    feed(forecaster, [60, 59.9, 59.8, 59.7])
+    assert forecaster.minutes_to(30) is None
+    forecaster.add(59.6, now=1000 + 4 * 60)
+    assert forecaster.minutes_to(30) is not None
+
+    # Enough readings, but all within a few seconds
+    forecaster = DryForecaster(min_samples=5, min_span_seconds=60)
+    feed(forecaster, [60, 59.9, 59.8, 59.7, 59.6, 59.5], interval=10)
+    assert forecaster.minutes_to(30) is None
+
+
+def test_no_forecast_while_not_drying():
+    forecaster = DryForecaster()
+    feed(forecaster, [50] * 10)
+    assert forecaster.minutes_to(30) is None
+    forecaster = DryForecaster()
+    feed(forecaster, [50 + 0.1 * i for i in range(10)])
+    assert forecaster.minutes_to(30) is None
+
+
+def test_forecast_beyond_max_minutes():
+    forecaster = DryForecaster(max_minutes=100)
+    feed(forecaster, [60 - 0.1 * i for i in range(10)])
+    assert forecaster.minutes_to(30) is None
+    assert forecaster.minutes_to(50) == pytest.approx(91, abs=0.01)
+
+
+def test_watering_resets_window():
+    forecaster = DryForecaster()
+    feed(forecaster, [60 - 0.1 * i for i in range(10)])
+    forecaster.add(59, watering=True, now=2000)
+    assert forecaster.count == 0
+    assert forecaster.minutes_to(30) is None
+    # The next drying period starts from scratch
+    feed(forecaster, [80 - 0.2 * i for i in range(10)], start=3000)
+    assert forecaster.count == 10
+    assert forecaster.minutes_to(30) == pytest.approx((78.2 - 30) / 0.2, abs=0.01)
+
+
+def test_moisture_jump_resets_window():
+    forecaster = DryForecaster(reset_rise=5)
+    feed(forecaster, [60 - 0.1 * i for i in range(10)])
+    # A rise within reset_rise is noise and stays in the window
+    forecaster.add(63, now=1000 + 10 * 60)
+    assert forecaster.count == 11
+    # Rain: the jumping reading starts the new window
+    forecaster.add(75, now=1000 + 11 * 60)
+    assert forecaster.count == 1
+    assert forecaster.minutes_to(30) is None
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        DryForecaster(model="logistic")
@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from runtime_files.gateway import Zone, ZoneRouter
+from telemetry_files.calibration import CalibrationTable
+
+
+def zone():
+    return Zone("AWS_9875", "zone1", 300, 600, 27, CalibrationTable(1023, 1), 0)
+
+
+def test_apply_parameters_rebuilds_table():
+    z = zone()
+    z.apply_parameters({"abs_hydrated_state_value": 200, "abs_dry_state_value": 800})
+    assert z.moisture_percentage(200) == 100
+    assert z.moisture_percentage(500) == 50
+    assert z.parameters()["abs_dry_state_value"] == 800
+
+
+@pytest.mark.parametrize("values", [
+    {"abs_hydrated_state_value": 250, "calibration": {"type": "piecewise", "points": [[300, 100]]}},
+    {"abs_hydrated_state_value": 250, "calibration": {"type": "spline"}},
+    {"abs_hydrated_state_value": 250, "sprinkler_trigger_percentage": "30"},
+    # Hydrated and dry values that make the default linear curve invalid
+    {"abs_hydrated_state_value": 600},
+])
+def test_invalid_parameters_leave_zone_unchanged(values):
+    z = zone()
+    before = z.parameters()
+    with pytest.raises(ValueError):
+        z.apply_parameters(values)
+    assert z.parameters() == before
+    assert z.moisture_percentage(300) == 100
+    assert z.moisture_percentage(450) == 50
+
+
+def test_router_matches_own_zones_only():
+    z = zone()
+    router = ZoneRouter([z])
+    assert router.zone_for_topic("$aws/things/AWS_9875_zone1/shadow/update/delta") is z
+    assert router.zone_for_topic("$aws/things/AWS_9875_zone2/shadow/update/delta") is None
+    assert router.zone_for_topic("AWS_9875_zone1/sensordata/soil_moisture") is None
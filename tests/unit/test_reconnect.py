@@ -0,0 +1,18 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from runtime_files.reconnect import reconnect_timeouts
+
+
+def test_reconnect_timeouts_within_bounds():
+    for _ in range(100):
+        jittered_min, jittered_max = reconnect_timeouts(2, 128)
+        assert 2 <= jittered_min <= 4
+        assert jittered_max == 128
+
+
+def test_reconnect_timeouts_accept_float_bounds():
+    for _ in range(100):
+        jittered_min, jittered_max = reconnect_timeouts(1.5, 2.5)
+        assert isinstance(jittered_min, int) and isinstance(jittered_max, int)
+        assert 1 <= jittered_min <= jittered_max == 2
@@ -0,0 +1,148 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from telemetry_files.spool import SEGMENT_SUFFIX, SpoolDrainer, TelemetrySpool
+
+TOPIC = "AWS_9875/sensordata/soil_moisture"
+# Header, topic and a 10 byte payload
+RECORD_BYTES = 6 + len(TOPIC) + 10
+
+
+def payload(index):
+    return "reading{:03d}".format(index).encode('utf-8')
+
+
+def drain(spool):
+    records = []
+    while True:
+        record = spool.peek()
+        if record is None:
+            return records
+        records.append(record[1])
+        spool.commit()
+
+
+def segment_files(spool_dir):
+    return sorted(name for name in os.listdir(spool_dir) if name.endswith(SEGMENT_SUFFIX))
+
+
+def test_peek_returns_the_same_record_until_commit(tmp_path):
+    spool = TelemetrySpool(str(tmp_path))
+    spool.append(TOPIC, payload(0))
+    spool.append(TOPIC, payload(1).decode('utf-8'))
+    assert spool.peek() == (TOPIC, payload(0))
+    assert spool.peek() == (TOPIC, payload(0))
+    spool.commit()
+    assert spool.peek() == (TOPIC, payload(1))
+    spool.commit()
+    assert spool.peek() is None
+    assert spool.pending_bytes() == 0
+    spool.close()
+
+
+def test_cursor_survives_reopen(tmp_path):
+    spool = TelemetrySpool(str(tmp_path))
+    for index in range(3):
+        spool.append(TOPIC, payload(index))
+    spool.peek()
+    spool.commit()
+    # Peeked but not acknowledged, sent again after a restart
+    spool.peek()
+    spool.close()
+
+    reopened = TelemetrySpool(str(tmp_path))
+    assert drain(reopened) == [payload(1), payload(2)]
+    reopened.close()
+
+
+def test_segments_roll_and_are_removed_once_read(tmp_path):
+    spool = TelemetrySpool(str(tmp_path), max_bytes=100 * RECORD_BYTES, segment_bytes=2 * RECORD_BYTES)
+    for index in range(5):
+        spool.append(TOPIC, payload(index))
+    assert len(segment_files(str(tmp_path))) == 3
+    assert spool.pending_bytes() == 5 * RECORD_BYTES
+    assert drain(spool) == [payload(index) for index in range(5)]
+    # Only the segment being written is left
+    assert len(segment_files(str(tmp_path))) == 1
+    spool.close()
+
+    reopened = TelemetrySpool(str(tmp_path), max_bytes=100 * RECORD_BYTES, segment_bytes=2 * RECORD_BYTES)
+    assert reopened.peek() is None
+    reopened.close()
+
+
+def test_drop_oldest_keeps_latest_readings(tmp_path):
+    spool = TelemetrySpool(str(tmp_path), max_bytes=4 * RECORD_BYTES, segment_bytes=2 * RECORD_BYTES,
+                           drop_policy="drop_oldest")
+    for index in range(6):
+        assert spool.append(TOPIC, payload(index))
+    assert spool.dropped_records == 2
+    assert drain(spool) == [payload(index) for index in range(2, 6)]
+    spool.close()
+
+
+def test_drop_newest_keeps_backlog(tmp_path):
+    spool = TelemetrySpool(str(tmp_path), max_bytes=4 * RECORD_BYTES, segment_bytes=2 * RECORD_BYTES,
+                           drop_policy="drop_newest")
+    results = [spool.append(TOPIC, payload(index)) for index in range(6)]
+    assert results == [True] * 4 + [False] * 2
+    assert spool.dropped_records == 2
+    assert drain(spool) == [payload(index) for index in range(4)]
+    spool.close()
+
+
+def test_unknown_drop_policy(tmp_path):
+    with pytest.raises(ValueError):
+        TelemetrySpool(str(tmp_path), drop_policy="drop_random")
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_drainer_commits_only_after_puback(tmp_path):
+    spool = TelemetrySpool(str(tmp_path))
+    spool.append(TOPIC, payload(0))
+    spool.append(TOPIC, payload(1))
+    publishes = []
+
+    def publish(topic, data):
+        future = Future()
+        publishes.append((data, future))
+        return future
+
+    connected = threading.Event()
+    connected.set()
+    drainer = SpoolDrainer(spool, publish, connected, drain_rate=0, ack_timeout=5)
+    drainer.start()
+    try:
+        wait_until(lambda: len(publishes) == 1)
+        assert publishes[0][0] == payload(0)
+        assert spool.pending_bytes() == 2 * RECORD_BYTES
+
+        # A failed publish leaves the record in the spool and it is sent again
+        publishes[0][1].set_exception(Exception("connection lost"))
+        wait_until(lambda: len(publishes) == 2)
+        assert publishes[1][0] == payload(0)
+        assert spool.pending_bytes() == 2 * RECORD_BYTES
+
+        publishes[1][1].set_result(None)
+        wait_until(lambda: len(publishes) == 3)
+        assert publishes[2][0] == payload(1)
+        assert spool.pending_bytes() == RECORD_BYTES
+        publishes[2][1].set_result(None)
+        wait_until(lambda: spool.pending_bytes() == 0)
+    finally:
+        drainer.stop()
+        drainer.join(timeout=5)
+        spool.close()
@@ -0,0 +1,193 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import random
+import re
+
+import pytest
+
+from conftest import DEVICE_DIR
+from decision_files.watering_detector import WateringDetector, load_definition
+
+REPO_DIR = os.path.abspath(os.path.join(DEVICE_DIR, '..', '..', '..'))
+DEFINITION = load_definition(os.path.join(DEVICE_DIR, 'detector_model.json'))
+INPUT_NAME = "SprinklerDetectorModelInput"
+
+
+def generated_definition():
+    # The detector model IotEventsStack builds from detector_model.json, in its CloudFormation form
+    counter = DEFINITION['counter_variable']
+
+    def set_counter(value):
+        return [{"SetVariable": {"VariableName": counter, "Value": value}}]
+
+    def reading(reading_state):
+        return '$input.{}.sensorReportedState == "{}"'.format(INPUT_NAME, reading_state)
+
+    states = []
+    for state in DEFINITION['states']:
+        states.append({
+            "StateName": state['state_name'],
+            "OnEnter": {"Events": [
+                {"EventName": "InitializeInputValue", "Condition": "true", "Actions": set_counter("0")}]},
+            "OnInput": {
+                "Events": [
+                    {"EventName": DEFINITION['reading_events'][state['count_reading']],
+                     "Condition": reading(state['count_reading']),
+                     "Actions": set_counter("$variable.{} + $input.{}.{}".format(
+                         counter, INPUT_NAME, DEFINITION['sample_count_attribute']))},
+                    {"EventName": DEFINITION['reading_events'][state['reset_reading']],
+                     "Condition": reading(state['reset_reading']),
+                     "Actions": set_counter("0")},
+                ],
+                "TransitionEvents": [
+                    {"EventName": state['transition_event'],
+                     "Condition": "$variable.{} > {}".format(counter, DEFINITION['debounce_threshold']),
+                     "NextState": state['next_state']}],
+            },
+        })
+    return {"InitialStateName": DEFINITION['initial_state'], "States": states}
+
+
+def debounce_rules(definition):
+    # Conditions, variable updates and transitions of each state, without the SNS actions
+    def updates(events):
+        return [(event['Condition'], [(action['SetVariable']['VariableName'], action['SetVariable']['Value'])
+                                      for action in event['Actions'] if 'SetVariable' in action])
+                for event in events]
+    return (definition['InitialStateName'],
+            {state['StateName']: (updates(state['OnEnter']['Events']),
+                                  updates(state['OnInput']['Events']),
+                                  [(transition['Condition'], transition['NextState'])
+                                   for transition in state['OnInput']['TransitionEvents']])
+             for state in definition['States']})
+
+
+def evaluate(expression, variables, payload):
+    # IoT Events expressions of the detector model, as Python
+    expression = re.sub(r'\$variable\.(\w+)', lambda m: repr(variables[m.group(1)]), expression)
+    expression = re.sub(r'\$input\.{}\.(\w+)'.format(INPUT_NAME), lambda m: repr(payload[m.group(1)]), expression)
+    return eval(re.sub(r'\btrue\b', 'True', expression), {'__builtins__': {}})
+
+
+class CloudDetector:
+    # Runs a detector model the way IoT Events does with evaluation_method="BATCH":
+    # every event condition is evaluated before the actions run, then the transitions
+    def __init__(self, definition):
+        self.states = {state['StateName']: state for state in definition['States']}
+        self.variables = {}
+        self._enter(definition['InitialStateName'], {})
+
+    def _run(self, events, payload):
+        fired = [event for event in events if evaluate(event['Condition'], self.variables, payload)]
+        updates = [(action['SetVariable']['VariableName'],
+                    evaluate(action['SetVariable']['Value'], self.variables, payload))
+                   for event in fired for action in event['Actions'] if 'SetVariable' in action]
+        self.variables.update(updates)
+
+    def _enter(self, state_name, payload):
+        self.state_name = state_name
+        self._run(self.states[state_name]['OnEnter']['Events'], payload)
+
+    def on_input(self, payload):
+        state = self.states[self.state_name]
+        self._run(state['OnInput']['Events'], payload)
+        for transition in state['OnInput']['TransitionEvents']:
+            if evaluate(transition['Condition'], self.variables, payload):
+                self._enter(transition['NextState'], payload)
+                return transition['NextState']
+        return None
+
+
+def sprinkler_state(state_name):
+    return {state['state_name']: state['sprinkler_state'] for state in DEFINITION['states']}[state_name]
+
+
+def run_both(readings):
+    # (device, cloud) sprinkler switches for each (reading state, sample count)
+    device = WateringDetector(DEFINITION)
+    cloud = CloudDetector(generated_definition())
+    device_switches, cloud_switches = [], []
+    for reading_state, sample_count in readings:
+        device_switches.append(device.on_reading(reading_state, sample_count))
+        next_state = cloud.on_input({"sensorReportedState": reading_state, "sampleCount": sample_count})
+        cloud_switches.append(sprinkler_state(next_state) if next_state else None)
+        assert device.state_name == cloud.state_name
+        assert device.counter == cloud.variables[DEFINITION['counter_variable']]
+    assert device_switches == cloud_switches
+    return device_switches
+
+
+def test_generated_definition_matches_stack(monkeypatch):
+    cdk = pytest.importorskip('aws_cdk')
+    from aws_cdk import assertions, aws_iam as iam, aws_sns as sns
+    monkeypatch.syspath_prepend(REPO_DIR)
+    # The stack reads detector_model.json relative to the CDK app folder
+    monkeypatch.chdir(REPO_DIR)
+    from iot_enabled_sprinkler.constructs.iot_events_stack import IotEventsStack
+
+    stack = cdk.Stack(cdk.App(), "Test")
+    IotEventsStack(stack, "IotEvents",
+                   env_params={'name': '', 'iotevents': {'input': {'input_name': INPUT_NAME},
+                                                         'detector_model': {'detector_model_name': "Detector"}}},
+                   iot_events_execution_role=iam.Role(stack, "Role",
+                                                      assumed_by=iam.ServicePrincipal("iotevents.amazonaws.com")),
+                   sprinkler_off_topic=sns.Topic(stack, "OffTopic"),
+                   sprinkler_on_topic=sns.Topic(stack, "OnTopic"),
+                   sprinkler_off_lambda=None, sprinkler_on_lambda=None)
+    models = assertions.Template.from_stack(stack).find_resources("AWS::IoTEvents::DetectorModel")
+    synthesized = next(iter(models.values()))['Properties']['DetectorModelDefinition']
+    assert debounce_rules(synthesized) == debounce_rules(generated_definition())
+
+
+def test_single_readings_debounce():
+    # The counter has to go past debounce_threshold: 5 dry readings switch the sprinkler on
+    threshold = DEFINITION['debounce_threshold']
+    switches = run_both([("dry", 1)] * (threshold + 1))
+    assert switches == [None] * threshold + ["on"]
+
+
+def test_sample_count_weighted_debounce():
+    threshold = DEFINITION['debounce_threshold']
+    # One deadband report standing for enough readings switches right away
+    assert run_both([("dry", threshold + 1)]) == ["on"]
+    # Reports add up their sample counts
+    assert run_both([("dry", 3), ("dry", threshold - 2)]) == [None, "on"]
+    # A report up to the threshold alone does not switch
+    assert run_both([("dry", threshold)]) == [None]
+
+
+def test_reset_reading_clears_counter():
+    threshold = DEFINITION['debounce_threshold']
+    switches = run_both([("dry", threshold), ("hydrated", 1), ("dry", threshold), ("dry", 1)])
+    assert switches == [None, None, None, "on"]
+
+
+def test_state_transitions():
+    threshold = DEFINITION['debounce_threshold']
+    readings = ([("dry", 1)] * (threshold + 1) +
+                # Watering: dry readings now reset the counter and hydrated ones count
+                [("hydrated", threshold), ("dry", 1), ("hydrated", threshold), ("hydrated", 1)] +
+                # The counter starts over in the new state
+                [("dry", threshold + 1)])
+    switches = run_both(readings)
+    assert switches == [None] * threshold + ["on", None, None, None, "off", "on"]
+
+
+def test_random_readings_match_cloud_detector():
+    rng = random.Random(21)
+    readings = [(rng.choice(["dry", "hydrated"]), rng.choice([1, 1, 1, 2, 3, 7])) for _ in range(1000)]
+    assert any(run_both(readings))
+
+
+def test_sync_follows_cloud_detector():
+    detector = WateringDetector(DEFINITION)
+    detector.on_reading("dry", 3)
+    detector.sync("off")
+    # Already in the requested state, the counter is kept
+    assert detector.counter == 3
+    detector.sync("on")
+    assert detector.sprinkler_state == "on"
+    assert detector.counter == 0
+    assert detector.on_reading("hydrated", DEFINITION['debounce_threshold'] + 1) == "off"